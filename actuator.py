@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import collections
+import logging
+import math
+import threading
+import time
+
+# PWM frame rate, pwmSetClock(192)/pwmSetRange(2000) give 20ms periods
+DEFAULT_CONTROL_RATE = 50
+
+# per-thread CPU clock, Python 3.6 only has the per-process one
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+# A decoded goggle_direction message. last_seen is the goggles' epoch
+# milliseconds, the angles are radians.
+Pose = collections.namedtuple('Pose', ['last_seen', 'roll', 'pitch', 'yaw'])
+
+
+class PoseMailbox(object):
+  """Single-slot mailbox where the newest pose wins.
+
+  Transport callbacks put() decoded poses and return straight away, the
+  actuator take()s whatever is newest. A pose that is still waiting when a
+  newer one arrives is superseded and dropped, so the servos never work
+  through a backlog. Poses older than the newest seen head.last_seen are
+  rejected as stale.
+  """
+
+  def __init__(self):
+    self._cond = threading.Condition(threading.Lock())
+    self._pose = None
+    self._last_seen = None
+    self._closed = False
+    self.deposited = 0
+    self.superseded = 0
+    self.stale = 0
+
+  def put(self, pose):
+    """Deposit a pose. Returns False if it is older than the newest seen."""
+    with self._cond:
+      if self._last_seen is not None and pose.last_seen < self._last_seen:
+        self.stale += 1
+        return False
+      if self._pose is not None:
+        self.superseded += 1
+      self._pose = pose
+      self._last_seen = pose.last_seen
+      self.deposited += 1
+      self._cond.notify()
+    return True
+
+  def take(self, timeout=None):
+    """Remove and return the newest pose, or None on timeout or close."""
+    with self._cond:
+      if self._pose is None and not self._closed:
+        self._cond.wait(timeout)
+      pose = self._pose
+      self._pose = None
+      return pose
+
+  def close(self):
+    """Wake up any waiting taker for shutdown."""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def stats(self):
+    with self._cond:
+      return {'deposited': self.deposited,
+              'superseded': self.superseded,
+              'stale': self.stale}
+
+
+class Actuator(threading.Thread):
+  """Dedicated thread applying each newest pose from a PoseMailbox.
+
+  pose_angles(pose) returns one angle per axis in axes, the actuator thread
+  is the only place servo hardware is written from. With a predictor, poses
+  are extrapolated by the actuator delay before they are applied. With
+  actuate_times, a histogram per axis, every servo write is timed. With a
+  LatencyTracer, the head.last_seen of every pose is traced once it is
+  written to the servos.
+  """
+
+  def __init__(self, mailbox, axes, pose_angles, predictor=None, actuate_times=None,
+               tracer=None, name='actuator'):
+    super().__init__(name=name, daemon=True)
+    self.mailbox = mailbox
+    self.axes = axes
+    self.pose_angles = pose_angles
+    self.predictor = predictor
+    self.actuate_times = actuate_times
+    self.tracer = tracer
+    self.applied = 0
+    self.errors = 0
+    # monotonic time the first pose was applied, for time to first actuation
+    self.first_applied = None
+    self._stopped = threading.Event()
+
+  def run(self):
+    logger = logging.getLogger(__name__)
+    while not self._stopped.is_set():
+      pose = self.mailbox.take()
+      if pose is None:
+        continue
+      last_seen = pose.last_seen
+      try:
+        if self.predictor is not None:
+          self.predictor.update(pose)
+          pose = self.predictor.predict()
+        actuate_times = self.actuate_times
+        for i, (axis, angle) in enumerate(zip(self.axes, self.pose_angles(pose))):
+          if actuate_times is None:
+            axis.set_angle(angle)
+          else:
+            start = time.perf_counter()
+            axis.set_angle(angle)
+            actuate_times[i].observe(time.perf_counter() - start)
+        if self.tracer is not None:
+          self.tracer.observe(last_seen)
+        if self.first_applied is None:
+          self.first_applied = time.monotonic()
+        self.applied += 1
+      except Exception as e:
+        self.errors += 1
+        logger.error('Failed to set tilt/pan: {}'.format(e))
+
+  def swap_axes(self, axes):
+    """Replaces the axes, e.g. recalibrated ones, in a single assignment.
+
+    The actuator thread reads self.axes once per pose or tick, so it works
+    with either the old or the new axes, never a mix.
+    """
+    if len(axes) != len(self.axes):
+      raise ValueError('Expected {} axes, got {}'.format(len(self.axes), len(axes)))
+    self.axes = list(axes)
+
+  def stop(self):
+    self._stopped.set()
+    self.mailbox.close()
+
+  def stats(self):
+    stats = {'applied': self.applied, 'errors': self.errors}
+    if self.predictor is not None:
+      stats.update(self.predictor.stats())
+    return stats
+
+
+class ControlLoop(Actuator):
+  """Fixed-rate actuator ticking on the monotonic clock at the PWM frame rate.
+
+  Every tick takes the newest pose, if any arrived, as the target and moves
+  each axis towards it by at most axis.max_slew radians per second. Servo
+  writes therefore happen once per 20ms frame at most, no matter how fast
+  messages arrive. With a predictor the target is extrapolated afresh on
+  every tick, so the servos keep following the head between messages.
+
+  Instrumented with tick count, wake-up jitter (lateness of the tick against
+  its schedule), missed deadlines (ticks finishing after the next tick was
+  due, those frames are skipped rather than caught up) and CPU time spent in
+  ticks.
+  """
+
+  def __init__(self, mailbox, axes, pose_angles, predictor=None, actuate_times=None,
+               tracer=None, rate=DEFAULT_CONTROL_RATE, name='control'):
+    super().__init__(mailbox, axes, pose_angles, predictor=predictor,
+                     actuate_times=actuate_times, tracer=tracer, name=name)
+    self.period = 1.0 / rate
+    self.targets = None
+    self.angles = [None] * len(axes)
+    self.ticks = 0
+    self.missed = 0
+    self.jitter_max = 0.0
+    self.jitter_sum = 0.0
+    self.cpu_time = 0.0
+
+  def run(self):
+    clock = time.monotonic
+    period = self.period
+    next_tick = clock() + period
+    while not self._stopped.is_set():
+      delay = next_tick - clock()
+      if delay > 0:
+        time.sleep(delay)
+      jitter = clock() - next_tick
+      self.ticks += 1
+      self.jitter_sum += jitter
+      if jitter > self.jitter_max:
+        self.jitter_max = jitter
+
+      cpu_start = thread_time()
+      self.tick()
+      self.cpu_time += thread_time() - cpu_start
+
+      next_tick += period
+      now = clock()
+      if now > next_tick:
+        self.missed += 1
+        # skip to the next frame boundary instead of bursting to catch up
+        next_tick += math.ceil((now - next_tick) / period) * period
+
+  def tick(self):
+    """Moves the axes one frame towards the newest target."""
+    pose = self.mailbox.take(0)
+    predictor = self.predictor
+    try:
+      if pose is not None:
+        if predictor is not None:
+          predictor.update(pose)
+        else:
+          self.targets = self.pose_angles(pose)
+        if self.first_applied is None:
+          self.first_applied = time.monotonic()
+        self.applied += 1
+      if predictor is not None and predictor.received is not None:
+        self.targets = self.pose_angles(predictor.predict())
+    except Exception as e:
+      self.errors += 1
+      logging.getLogger(__name__).error('Failed to set tilt/pan: {}'.format(e))
+    if self.targets is None:
+      return
+    period = self.period
+    angles = self.angles
+    actuate_times = self.actuate_times
+    for i, (axis, target) in enumerate(zip(self.axes, self.targets)):
+      angle = angles[i]
+      if angle is None:
+        angle = axis.angle()
+      if angle is not None and axis.max_slew > 0:
+        step = axis.max_slew * period
+        if target > angle + step:
+          target = angle + step
+        elif target < angle - step:
+          target = angle - step
+      # a failed write, e.g. an I2C error, must not end the control thread
+      try:
+        if actuate_times is None:
+          axis.set_angle(target)
+        else:
+          start = time.perf_counter()
+          axis.set_angle(target)
+          actuate_times[i].observe(time.perf_counter() - start)
+      except Exception as e:
+        self.errors += 1
+        logging.getLogger(__name__).error('Failed to set {}: {}'.format(axis.name, e))
+        continue
+      angles[i] = target
+    # the first frame towards a new pose, slew limited or not
+    if pose is not None and self.tracer is not None:
+      self.tracer.observe(pose.last_seen)
+
+  def stats(self):
+    ticks = self.ticks or 1
+    stats = super().stats()
+    stats.update({'ticks': self.ticks, 'missed': self.missed,
+                  'jitter_mean_ms': 1000.0 * self.jitter_sum / ticks,
+                  'jitter_max_ms': 1000.0 * self.jitter_max,
+                  'cpu_per_tick_us': 1e6 * self.cpu_time / ticks})
+    return stats
+
+
+def create_actuator(mailbox, axes, pose_angles, control_rate=DEFAULT_CONTROL_RATE,
+                    predictor=None, actuate_times=None, tracer=None):
+  """Returns a ControlLoop at control_rate Hz, or an event-driven Actuator for 0."""
+  if control_rate > 0:
+    return ControlLoop(mailbox, axes, pose_angles, predictor=predictor,
+                       actuate_times=actuate_times, tracer=tracer, rate=control_rate)
+  return Actuator(mailbox, axes, pose_angles, predictor=predictor,
+                  actuate_times=actuate_times, tracer=tracer)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import logging
+import multiprocessing
+import os
+import signal
+
+from actuator import DEFAULT_CONTROL_RATE, create_actuator
+from calibration import recalibrate
+from latencytracer import LatencyTracer
+from logqueue import forward_logging, log_to_queue
+from metrics import Histogram
+from predictor import PosePredictor
+from pwmbackend import backend_config, create_backend
+from servoaxis import ServoAxis
+from shmslot import SharedPoseSlot
+
+# seconds between copies of the actuator stats into the shared block
+STATS_INTERVAL = 0.1
+# seconds the actuator process gets to stop before it is terminated
+STOP_TIMEOUT = 5.0
+
+
+class ActuatorProcess(object):
+  """Runs the actuator of a rig in its own process, pinned to a CPU.
+
+  The network process deposits poses into slot, a SharedPoseSlot, and the
+  actuator process takes them and drives the PWM backend of section, so
+  receive, decode and the GIL of the transport threads never delay a servo
+  write. Stands in for the actuator in the network process: start, stop,
+  stats, first_applied, swap_axes and recalibrate. axes are the network
+  process' copies, for recording and telemetry, they write nothing. The
+  actuator process logs through this process' logging configuration.
+
+  pose_angles has to be a module level function, the process is spawned.
+  """
+
+  def __init__(self, slot, axes, section, pose_angles, cpu=None, name='actuator'):
+    self.slot = slot
+    self.axes = list(axes)
+    self.section = dict(section)
+    self.predictor = PosePredictor.from_config(self.section)
+    # the ControlLoop's tick period, None for the event-driven Actuator
+    rate = float(self.section.get('control_rate', DEFAULT_CONTROL_RATE))
+    self.period = 1.0 / rate if rate > 0 else None
+    context = multiprocessing.get_context('spawn')
+    self._conn, child_conn = context.Pipe()
+    self._log_queue = context.Queue()
+    self._log_listener = None
+    self.process = context.Process(target=run, name=name, daemon=True,
+                                   args=(slot.name, slot.cond, self.section, pose_angles, cpu,
+                                         child_conn, self._log_queue,
+                                         logging.getLogger().getEffectiveLevel()))
+
+  @property
+  def first_applied(self):
+    return self.slot.first_applied
+
+  def start(self):
+    self._log_listener = forward_logging(self._log_queue)
+    self.process.start()
+
+  def swap_axes(self, axes):
+    self.axes = list(axes)
+
+  def recalibrate(self, section):
+    """Recalibrates the actuator process from a new [io] style section."""
+    self.section = dict(section)
+    self._conn.send(('recalibrate', self.section))
+
+  def stop(self):
+    self.slot.close()
+    if self.process.is_alive():
+      try:
+        self._conn.send(('stop', None))
+      except OSError:
+        pass
+      self.process.join(STOP_TIMEOUT)
+      if self.process.is_alive():
+        logging.getLogger(__name__).warning('Terminating the actuator process')
+        self.process.terminate()
+        self.process.join()
+    # after the records logged on the way out
+    if self._log_listener is not None:
+      self._log_listener.stop()
+      self._log_listener = None
+
+  def stats(self):
+    stats = self.slot.actuator_stats(self.period is not None, self.predictor is not None)
+    stats['exitcode'] = self.process.exitcode
+    return stats
+
+
+def run(slot_name, cond, section, pose_angles, cpu, conn, log_queue, log_level):
+  """Entry point of the actuator process."""
+  # Ctrl-C goes to the whole process group, the network process stops this one
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  log_to_queue(log_queue, log_level)
+  logger = logging.getLogger(__name__)
+  if cpu is not None:
+    try:
+      os.sched_setaffinity(0, {cpu})
+    except (AttributeError, OSError) as e:
+      logger.warning('Actuator process not pinned to CPU {}: {}'.format(cpu, e))
+  slot = SharedPoseSlot(slot_name, cond)
+  name, options = backend_config(section)
+  backend = create_backend(name, **options)
+  axes = [ServoAxis.from_config(axis, section, backend.write) for axis in ('tilt', 'pan')]
+  backend.setup([axis.pin for axis in axes])
+  for axis in axes:
+    axis.set_pulse_width(150)
+  # the network process exposes these, they count in the shared block
+  slot.bind_latency(Histogram('crossprocess'))
+  actuate_times = slot.bind_actuate([Histogram('actuate_' + axis.name) for axis in axes])
+  actuator = create_actuator(slot, axes, pose_angles,
+                             float(section.get('control_rate', DEFAULT_CONTROL_RATE)),
+                             PosePredictor.from_config(section), actuate_times,
+                             slot.bind_tracer(LatencyTracer()))
+  actuator.start()
+  logger.info('Actuator process {} on CPU {}, {}'.format(os.getpid(), cpu, type(backend).__name__))
+  try:
+    while True:
+      if conn.poll(STATS_INTERVAL):
+        message, section = conn.recv()
+        if message == 'stop':
+          break
+        if message == 'recalibrate':
+          try:
+            recalibrate(actuator, backend, section)
+          except Exception as e:
+            logger.error('Invalid calibration, keeping the old one: {}'.format(e))
+      slot.publish_stats(actuator)
+  except EOFError:
+    # the network process is gone
+    pass
+  finally:
+    actuator.stop()
+    actuator.join(STOP_TIMEOUT)
+    slot.publish_stats(actuator)
+    backend.close()
+    slot.release()
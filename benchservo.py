@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Microbenchmarks for the per-message decode and actuation hot path.
+
+Runs the stages of __subscriber_callback/__decode_message against a
+RecordingBackend, so no Pi, wiringpi or cloud client is needed:
+
+  decode    posewire.decode of a goggle_direction JSON envelope
+  decodebin posewire.decode of the same pose in the binary format
+  sequence  Sequencer dedup and head.last_seen check, PoseMailbox.put
+  actuate   ServoAxis.set_angle for tilt and pan
+  sysfs     the same through SysfsPwmBackend on a temporary sysfs layout
+  ack       message.ack() on a stand-in Pub/Sub message
+  metrics   the per-message counter and stage histogram updates
+  pipeline  all of the above for one message, taken through the mailbox
+
+For each stage it reports ns/message, and allocations/message as the net
+change in allocated memory blocks, which is 0 for a hot path that does not
+retain anything. CPython has no counter of short-lived allocations, so the
+peak transient bytes traced while handling a message are reported as well.
+
+Results are stored per machine and version in a JSON file (benchmarks.json
+next to this script by default) and compared with the newest stored result
+of another version, so regressions show up between versions.
+
+  python3 benchservo.py [-n MESSAGES] [--check]
+"""
+
+import argparse
+import ast
+import gc
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from actuator import Pose, PoseMailbox
+from metrics import PipelineMetrics
+from posewire import decode, encode_binary, encode_json
+from sequencer import Sequencer
+from pwmbackend import RecordingBackend, SysfsPwmBackend
+from servoaxis import DEFAULT_PINS, ServoAxis
+
+
+class FakeMessage(object):
+  """Stand-in for a pubsub_v1 subscriber message."""
+
+  __slots__ = ('data', 'acked')
+
+  def __init__(self, data):
+    self.data = data
+    self.acked = 0
+
+  def ack(self):
+    self.acked += 1
+
+
+def get_version():
+  # same as setup.py, without importing subservo and its cloud client
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'subservo.py')
+  with open(path) as input_file:
+    for line in input_file:
+      if line.startswith('__version__'):
+        return ast.parse(line).body[0].value.s
+  return 'unknown'
+
+
+def make_payloads(count):
+  """goggle_direction messages sweeping slowly through yaw and pitch."""
+  start = 1557746562000
+  return [encode_json(Pose(start + i * 10, 0.0,
+                           0.5 * math.sin(i / 50.0), 1.2 * math.sin(i / 80.0)))
+          for i in range(count)]
+
+
+def make_stages(count):
+  """Returns a reset function and (stage name, function(i)) pairs handling message i."""
+  payloads = make_payloads(count)
+  poses = [decode(payload) for payload in payloads]
+  binary_payloads = [encode_binary(pose) for pose in poses]
+  messages = [FakeMessage(payload) for payload in payloads]
+  backend = RecordingBackend(capacity=2 * count)
+  tilt_axis = ServoAxis.from_config('tilt', {}, backend.write)
+  pan_axis = ServoAxis.from_config('pan', {}, backend.write)
+  sequence_mailbox = PoseMailbox()
+  pipeline_mailbox = PoseMailbox()
+  sequence_sequencer = Sequencer()
+  pipeline_sequencer = Sequencer()
+  pipeline_metrics = PipelineMetrics(axes=[tilt_axis, pan_axis])
+  # regular files stand in for the sysfs attributes, the pwrite calls are the same
+  sysfs_root = tempfile.TemporaryDirectory()
+  sysfs_backend = SysfsPwmBackend(root=sysfs_root.name)
+  for channel in (0, 1):
+    os.makedirs(os.path.join(sysfs_root.name, 'pwmchip0', 'pwm{}'.format(channel)))
+  sysfs_backend.setup([DEFAULT_PINS['tilt'], DEFAULT_PINS['pan']])
+  sysfs_tilt_axis = ServoAxis.from_config('tilt', {}, sysfs_backend.write)
+  sysfs_pan_axis = ServoAxis.from_config('pan', {}, sysfs_backend.write)
+  latencies = [i * 1e-6 for i in range(count)]
+
+  def decode_stage(i):
+    decode(payloads[i])
+
+  def decodebin(i):
+    decode(binary_payloads[i])
+
+  def sequence(i):
+    if not sequence_sequencer.is_duplicate(i) and sequence_sequencer.advance(poses[i].last_seen):
+      sequence_mailbox.put(poses[i])
+
+  def actuate(i):
+    pose = poses[i]
+    tilt_axis.set_angle(pose.pitch)
+    pan_axis.set_angle(pose.yaw)
+
+  def sysfs(i):
+    pose = poses[i]
+    sysfs_tilt_axis.set_angle(pose.pitch)
+    sysfs_pan_axis.set_angle(pose.yaw)
+
+  def ack(i):
+    messages[i].ack()
+
+  def metrics(i):
+    latency = latencies[i]
+    pipeline_metrics.received.inc()
+    pipeline_metrics.decode.observe(latency)
+    pipeline_metrics.sequence.observe(latency)
+    pipeline_metrics.actuate[0].observe(latency)
+    pipeline_metrics.actuate[1].observe(latency)
+    pipeline_metrics.ack.observe(latency)
+
+  def pipeline(i):
+    message = messages[i]
+    if pipeline_sequencer.is_duplicate(i):
+      return
+    pose = decode(message.data)
+    if pipeline_sequencer.advance(pose.last_seen):
+      pipeline_mailbox.put(pose)
+    message.ack()
+    pose = pipeline_mailbox.take(0)
+    tilt_axis.set_angle(pose.pitch)
+    pan_axis.set_angle(pose.yaw)
+
+  def reset():
+    for mailbox in (sequence_mailbox, pipeline_mailbox):
+      mailbox.__init__()
+    for sequencer in (sequence_sequencer, pipeline_sequencer):
+      sequencer.__init__()
+    for axis in (tilt_axis, pan_axis, sysfs_tilt_axis, sysfs_pan_axis):
+      axis.last_pw = None
+    backend.clear()
+
+  return reset, [('decode', decode_stage), ('decodebin', decodebin), ('sequence', sequence), ('actuate', actuate),
+                 ('sysfs', sysfs), ('ack', ack), ('metrics', metrics), ('pipeline', pipeline)]
+
+
+def run_stage(reset, stage, count, repeat):
+  """Returns (ns/message, allocated blocks/message, peak transient bytes)."""
+  indices = range(count)
+  best = None
+  gc.disable()
+  try:
+    for _ in range(repeat):
+      reset()
+      start = time.perf_counter()
+      for i in indices:
+        stage(i)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+
+    reset()
+    blocks = sys.getallocatedblocks()
+    for i in indices:
+      stage(i)
+    blocks = sys.getallocatedblocks() - blocks
+
+    reset()
+    tracemalloc.start()
+    traced = tracemalloc.get_traced_memory()[0]
+    for i in indices:
+      stage(i)
+    peak = tracemalloc.get_traced_memory()[1] - traced
+    tracemalloc.stop()
+  finally:
+    gc.enable()
+  return best * 1e9 / count, blocks / float(count), peak
+
+
+def load_results(path):
+  try:
+    with open(path, 'r') as results_file:
+      return json.load(results_file)
+  except (IOError, ValueError):
+    return {}
+
+
+def previous_version(machine_results, version):
+  others = [(entry['timestamp'], other) for other, entry in machine_results.items()
+            if other != version]
+  return max(others)[1] if others else None
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the servo message hot path.')
+  parser.add_argument('-n', '--messages', type=int, default=20000,
+                      help='messages per run')
+  parser.add_argument('-r', '--repeat', type=int, default=5,
+                      help='runs per stage, the fastest is reported')
+  parser.add_argument('--results', default=os.path.join(
+                      os.path.dirname(os.path.abspath(__file__)), 'benchmarks.json'),
+                      help='JSON file the results are stored in')
+  parser.add_argument('--no-save', action='store_true',
+                      help='do not store the results')
+  parser.add_argument('--threshold', type=float, default=10.0,
+                      help='slowdown in percent reported as a regression')
+  parser.add_argument('--check', action='store_true',
+                      help='exit with status 1 on a regression')
+  args = parser.parse_args()
+
+  version = get_version()
+  machine = '{}-{}'.format(platform.machine(), platform.python_version())
+  results = load_results(args.results)
+  machine_results = results.setdefault(machine, {})
+  baseline_version = previous_version(machine_results, version)
+  baseline = machine_results[baseline_version]['stages'] if baseline_version else {}
+
+  print('subservo {} on {}, {} messages'.format(version, machine, args.messages))
+  if baseline_version:
+    print('compared with {}'.format(baseline_version))
+  print('{:<10} {:>12} {:>12} {:>14} {:>10}'.format(
+        'stage', 'ns/msg', 'allocs/msg', 'peak B', 'change'))
+  reset, stages = make_stages(args.messages)
+  stage_results = {}
+  regressions = []
+  for name, stage in stages:
+    ns, allocs, peak = run_stage(reset, stage, args.messages, args.repeat)
+    stage_results[name] = {'ns_per_message': ns, 'allocs_per_message': allocs,
+                           'peak_bytes': peak}
+    change = ''
+    if name in baseline:
+      percent = 100.0 * (ns / baseline[name]['ns_per_message'] - 1.0)
+      change = '{:+.1f}%'.format(percent)
+      if percent > args.threshold:
+        regressions.append(name)
+        change += ' !'
+    print('{:<10} {:>12.0f} {:>12.2f} {:>14.0f} {:>10}'.format(name, ns, allocs, peak, change))
+
+  if not args.no_save:
+    machine_results[version] = {'timestamp': time.time(), 'messages': args.messages,
+                                'stages': stage_results}
+    with open(args.results, 'w') as results_file:
+      json.dump(results, results_file, indent=2, sort_keys=True)
+  if regressions:
+    print('Regression over {}% in: {}'.format(args.threshold, ', '.join(regressions)))
+    if args.check:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""End-to-end latency of the three pose transports.
+
+Sends goggle_direction poses through each transport from this process and
+times each one from the send until the decoded pose is deposited in the
+actuator mailbox, both on this machine's clock:
+
+  udp     UdpPoseReceiver with HMAC over loopback, run it on the Pi for the
+          Wi-Fi hop use --udp-listen/--udp-target on both ends
+  pubsub  publish and streaming pull through Google Pub/Sub, --project and
+          --topic, works against the emulator with PUBSUB_EMULATOR_HOST set
+  mqtt    publish and subscribe through an MQTT broker, --mqtt-host. The IoT
+          Core bridge cannot echo commands back to the sender, so this is
+          a plain broker such as mosquitto standing in for it
+
+Transports whose options or client libraries are missing are skipped.
+
+  python3 benchtransport.py [-n MESSAGES] [--rate HZ] [--project P --topic T] [--mqtt-host H:P]
+"""
+
+import argparse
+import binascii
+import math
+import os
+import time
+
+from actuator import Pose, PoseMailbox
+from metrics import Registry
+from posewire import decode, encode_binary
+from pwmbackend import RecordingBackend
+from rig import Rig
+from servoaxis import ServoAxis
+from udptransport import UdpPoseReceiver, UdpPoseSender, parse_address
+
+
+class TimingMailbox(PoseMailbox):
+  """PoseMailbox recording the time since each pose was sent, by last_seen."""
+
+  def __init__(self, sent):
+    super().__init__()
+    self.sent = sent
+    self.latencies = []
+
+  def put(self, pose):
+    self.latencies.append(time.perf_counter() - self.sent[pose.last_seen])
+    return super().put(pose)
+
+
+def make_payloads(count):
+  """Binary poses numbered by last_seen, so each can be matched to its send time."""
+  return [encode_binary(Pose(i, 0.0, 0.5 * math.sin(i / 50.0), 1.2 * math.sin(i / 80.0)))
+          for i in range(count)]
+
+
+def send_all(send, sent, payloads, rate):
+  """Sends payloads at rate per second, recording each send time in sent."""
+  period = 1.0 / rate
+  next_send = time.perf_counter()
+  for i, payload in enumerate(payloads):
+    delay = next_send - time.perf_counter()
+    if delay > 0:
+      time.sleep(delay)
+    sent[i] = time.perf_counter()
+    send(payload)
+    next_send += period
+
+
+def wait_for(mailbox, count, timeout):
+  deadline = time.monotonic() + timeout
+  while len(mailbox.latencies) < count and time.monotonic() < deadline:
+    time.sleep(0.05)
+
+
+def run_udp(args, payloads, mailbox):
+  key = binascii.unhexlify(args.udp_key)
+  backend = RecordingBackend()
+  rig = Rig('bench', backend, ServoAxis.from_config('tilt', {}, backend.write),
+            ServoAxis.from_config('pan', {}, backend.write),
+            lambda pose: (pose.pitch, pose.yaw), registry=Registry())
+  # decode and sequencing as in udpservo, the pose ends up in the timing mailbox
+  rig.mailbox = mailbox
+  receiver = UdpPoseReceiver.from_config({'listen': args.udp_listen, 'key': args.udp_key}, rig)
+  receiver.start()
+  sender = UdpPoseSender(key, parse_address(args.udp_target))
+  try:
+    send_all(sender.send, mailbox.sent, payloads, args.rate)
+    wait_for(mailbox, len(payloads), args.timeout)
+  finally:
+    sender.close()
+    receiver.stop()
+
+
+def run_pubsub(args, payloads, mailbox):
+  from google.cloud import pubsub_v1
+  from subscribersettings import SubscriberSettings
+
+  # one message per publish request, batching would add its own delay
+  publisher = pubsub_v1.PublisherClient(
+              batch_settings=pubsub_v1.types.BatchSettings(max_messages=1))
+  subscriber = pubsub_v1.SubscriberClient()
+  topic_path = publisher.topic_path(args.project, args.topic)
+  subscription_path = subscriber.subscription_path(args.project, args.topic + '-bench')
+  try:
+    subscriber.create_subscription(name=subscription_path, topic=topic_path)
+  except Exception:
+    # it exists already
+    pass
+  settings = SubscriberSettings.from_config({})
+
+  def callback(message):
+    message.ack()
+    mailbox.put(decode(message.data))
+
+  future = subscriber.subscribe(subscription_path, callback=callback,
+                                flow_control=settings.flow_control(),
+                                scheduler=settings.scheduler())
+  try:
+    send_all(lambda payload: publisher.publish(topic_path, payload), mailbox.sent,
+             payloads, args.rate)
+    wait_for(mailbox, len(payloads), args.timeout)
+  finally:
+    future.cancel()
+
+
+def run_mqtt(args, payloads, mailbox):
+  import paho.mqtt.client as mqtt
+
+  topic = '/devices/bench/commands'
+  client = mqtt.Client()
+  client.on_message = lambda client, userdata, message: mailbox.put(decode(message.payload))
+  client.connect(*parse_address(args.mqtt_host))
+  client.subscribe(topic, qos=0)
+  client.loop_start()
+  # let the subscription settle before timing
+  time.sleep(1)
+  try:
+    send_all(lambda payload: client.publish(topic, payload, qos=0), mailbox.sent,
+             payloads, args.rate)
+    wait_for(mailbox, len(payloads), args.timeout)
+  finally:
+    client.disconnect()
+    client.loop_stop()
+
+
+def percentile(ordered, fraction):
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare pose transport latencies.')
+  parser.add_argument('-n', '--messages', type=int, default=1000,
+                      help='poses sent per transport')
+  parser.add_argument('--rate', type=float, default=100.0,
+                      help='poses sent per second')
+  parser.add_argument('--timeout', type=float, default=10.0,
+                      help='seconds to wait for the last poses to arrive')
+  parser.add_argument('--udp-listen', default='127.0.0.1:5005')
+  parser.add_argument('--udp-target', default='127.0.0.1:5005')
+  parser.add_argument('--udp-key', default=binascii.hexlify(os.urandom(32)).decode('ascii'),
+                      help='hex HMAC key, random by default')
+  parser.add_argument('--project', help='Pub/Sub project')
+  parser.add_argument('--topic', help='Pub/Sub topic')
+  parser.add_argument('--mqtt-host', help='MQTT broker host:port')
+  args = parser.parse_args()
+
+  transports = [('udp', run_udp)]
+  if args.project and args.topic:
+    transports.append(('pubsub', run_pubsub))
+  if args.mqtt_host:
+    transports.append(('mqtt', run_mqtt))
+
+  payloads = make_payloads(args.messages)
+  print('{} poses at {} Hz'.format(args.messages, args.rate))
+  print('{:<8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'transport', 'received', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+  for name, run in transports:
+    mailbox = TimingMailbox([None] * args.messages)
+    try:
+      run(args, payloads, mailbox)
+    except ImportError as e:
+      print('{:<8} skipped, {}'.format(name, e))
+      continue
+    ordered = sorted(mailbox.latencies)
+    if not ordered:
+      print('{:<8} {:>9}'.format(name, 0))
+      continue
+    print('{:<8} {:>9} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+          name, len(ordered), 1000 * percentile(ordered, 0.5), 1000 * percentile(ordered, 0.9),
+          1000 * percentile(ordered, 0.99), 1000 * ordered[-1]))
+
+
+if __name__ == '__main__':
+  main()
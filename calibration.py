@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import configparser
+import logging
+import os
+import threading
+
+from servoaxis import ServoAxis
+
+# seconds between checks of the config file
+WATCH_INTERVAL = 1.0
+
+
+def recalibrate(actuator, backend, section):
+  """Swaps axes calibrated from an [io] style section into a running actuator.
+
+  New ServoAxis objects are built from section for the actuator's axes and
+  replace them in one assignment, the actuator thread picks them up with
+  its next pose or tick. Mailbox and sequencing are not touched, so no pose
+  is dropped. Pins that changed are set up on the backend first.
+
+  Returns:
+    The new axes, in the order of actuator.axes.
+  Raises:
+    ValueError, ZeroDivisionError: If section holds an invalid calibration,
+      the actuator keeps its axes then.
+  """
+  old_axes = actuator.axes
+  axes = [ServoAxis.from_config(axis.name, section, backend.write) for axis in old_axes]
+  moved = [axis.pin for axis, old_axis in zip(axes, old_axes) if axis.pin != old_axis.pin]
+  if moved:
+    backend.setup(moved)
+  actuator.swap_axes(axes)
+  return axes
+
+
+def parse_config(text):
+  """Parses a config message in the parameters.conf format.
+
+  Raises:
+    configparser.Error: If text is not in the INI format.
+  """
+  config_parser = configparser.RawConfigParser()
+  config_parser.read_string(text)
+  return config_parser
+
+
+class ConfigWatcher(threading.Thread):
+  """Polls a config file and calls on_change(config_parser) when it changes.
+
+  Polling the modification time keeps it free of inotify dependencies, a
+  stat() a second is nothing next to the servo traffic.
+  """
+
+  def __init__(self, path, on_change, interval=WATCH_INTERVAL):
+    super().__init__(name='config-watch', daemon=True)
+    self.path = path
+    self.on_change = on_change
+    self.interval = interval
+    self.reloads = 0
+    self._stamp = self._stat()
+    self._stopped = threading.Event()
+
+  def _stat(self):
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      return None
+    return stat.st_mtime_ns, stat.st_size
+
+  def run(self):
+    logger = logging.getLogger(__name__)
+    while not self._stopped.wait(self.interval):
+      stamp = self._stat()
+      if stamp is None or stamp == self._stamp:
+        continue
+      self._stamp = stamp
+      logger.info('Config file {} changed, reloading'.format(self.path))
+      try:
+        config_parser = configparser.RawConfigParser()
+        config_parser.read(self.path)
+        self.on_change(config_parser)
+        self.reloads += 1
+      except Exception as e:
+        logger.error('Failed reloading {}, keeping the running config: {}'.format(self.path, e))
+
+  def stop(self):
+    self._stopped.set()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Always-on flight recorder of the poses a service received.
+
+Every decoded pose is appended to a fixed-size ring of binary records in a
+memory-mapped file, so the last capacity poses survive a crash or restart
+and can be looked at after a laggy session in the field:
+
+  python3 flightrecorder.py dump poses.rec
+  python3 flightrecorder.py replay poses.rec [--speed 4] [--backend recording]
+
+replay feeds the recorded poses through decode, sequencing and the actuator
+again, at the recorded pace divided by --speed, 0 for as fast as possible.
+The poses map to tilt and pan as in the service that recorded them, noted
+in the file, or as --mapping says.
+"""
+
+import argparse
+import collections
+import configparser
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+# defaults for the [recorder] config
+DEFAULTS = {
+  # ring file, relative to the service, {device} is replaced by the device id, empty to disable
+  'path': 'poses-{device}.rec',
+  'capacity': 65536,
+}
+
+# File header, little-endian, 32 bytes:
+#   8s  magic
+#   I   record size
+#   I   capacity in records
+#   Q   records written so far, the ring index is this modulo capacity
+#   B   pose to tilt and pan mapping, see MAPPINGS, 0 if not known
+#   7x  reserved
+MAGIC = b'POSEREC1'
+HEADER = struct.Struct('<8sIIQB7x')
+MAPPING_OFFSET = 24
+MAPPING = struct.Struct('<B')
+COUNT_OFFSET = 16
+COUNT = struct.Struct('<Q')
+# Record, little-endian, 36 bytes:
+#   d   receive time, epoch seconds
+#   q   head.last_seen, epoch milliseconds
+#   fff roll, pitch, yaw in radians
+#   hh  tilt and pan pulse widths the pose maps to
+#   I   flags
+RECORD = struct.Struct('<dqfffhhI')
+# the pose was older than the newest seen and not actuated
+FLAG_OUT_OF_SEQUENCE = 0x1
+
+Record = collections.namedtuple('Record', ['received', 'last_seen', 'roll', 'pitch', 'yaw',
+                                           'tilt_pw', 'pan_pw', 'flags'])
+
+
+def pitch_yaw_angles(pose):
+  # mqttservo and udpservo
+  return (pose.pitch, pose.yaw)
+
+
+def roll_yaw_angles(pose):
+  # subservo, tilting from the roll
+  return (-pose.roll, pose.yaw)
+
+
+# mapping name to its function, the header stores the index plus 1. Module
+# level functions, so a replay can hand them to an ActuatorProcess
+MAPPINGS = collections.OrderedDict([
+  ('pitch-yaw', pitch_yaw_angles),
+  ('roll-yaw', roll_yaw_angles),
+])
+
+
+class FlightRecorder(object):
+  """Appends pose records to a memory-mapped ring file.
+
+  record() packs straight into the mapping, the kernel writes the dirty
+  pages back in the background, so the receive path never waits for the SD
+  card. An existing ring with the same layout is continued after a restart.
+  mapping, a MAPPINGS name, notes how the service maps poses to tilt and pan.
+  """
+
+  def __init__(self, path, capacity=DEFAULTS['capacity'], mapping=None):
+    self.path = path
+    self.capacity = capacity
+    size = HEADER.size + capacity * RECORD.size
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      existing = os.fstat(fd).st_size == size
+      if not existing:
+        os.ftruncate(fd, size)
+      self.map = mmap.mmap(fd, size)
+    finally:
+      os.close(fd)
+    code = list(MAPPINGS).index(mapping) + 1 if mapping is not None else 0
+    magic, record_size, file_capacity, count, _ = HEADER.unpack_from(self.map, 0)
+    if not existing or magic != MAGIC or record_size != RECORD.size or file_capacity != capacity:
+      count = 0
+      HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, capacity, count, code)
+    else:
+      MAPPING.pack_into(self.map, MAPPING_OFFSET, code)
+    self.count = count
+    self.closed = False
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_config(cls, section, directory, device_id, mapping=None):
+    """Returns the recorder of a [recorder] config section, or None if disabled."""
+    path = section.get('path', DEFAULTS['path'])
+    if not path:
+      return None
+    return cls(os.path.join(directory, path.replace('{device}', device_id)),
+               int(section.get('capacity', DEFAULTS['capacity'])), mapping)
+
+  def record(self, received, pose, tilt_pw, pan_pw, flags=0):
+    """Appends a record, received is the epoch time the message came in."""
+    with self._lock:
+      if self.closed:
+        return
+      count = self.count
+      RECORD.pack_into(self.map, HEADER.size + (count % self.capacity) * RECORD.size,
+                       received, pose.last_seen, pose.roll, pose.pitch, pose.yaw,
+                       tilt_pw, pan_pw, flags)
+      count += 1
+      COUNT.pack_into(self.map, COUNT_OFFSET, count)
+      self.count = count
+
+  def close(self):
+    with self._lock:
+      if self.closed:
+        return
+      self.closed = True
+      self.map.flush()
+      self.map.close()
+
+
+def read_records(path):
+  """Returns the records of a ring file, oldest first, and its MAPPINGS name or None.
+
+  Raises:
+    ValueError: If path is not a flight recorder file.
+  """
+  with open(path, 'rb') as ring_file:
+    data = ring_file.read()
+  magic, record_size, capacity, count, code = HEADER.unpack_from(data, 0)
+  if magic != MAGIC or record_size != RECORD.size:
+    raise ValueError('{} is not a flight recorder file'.format(path))
+  names = list(MAPPINGS)
+  mapping = names[code - 1] if 0 < code <= len(names) else None
+  start = max(0, count - capacity)
+  return [Record._make(RECORD.unpack_from(data, HEADER.size + (i % capacity) * RECORD.size))
+          for i in range(start, count)], mapping
+
+
+def replay(records, rig, speed=1.0):
+  """Feeds records through decode, sequencing and the rig's actuator.
+
+  Records are re-encoded in the binary wire format, so decoding is part of
+  the replay. Out of sequence records are replayed too and rejected again.
+  """
+  from actuator import Pose
+  from posewire import decode, encode_binary
+
+  if not records:
+    return
+  start = time.monotonic()
+  first = records[0].received
+  for record in records:
+    if speed > 0:
+      delay = (record.received - first) / speed - (time.monotonic() - start)
+      if delay > 0:
+        time.sleep(delay)
+    rig.metrics.received.inc()
+    pose = decode(encode_binary(Pose(record.last_seen, record.roll, record.pitch, record.yaw)))
+    if rig.sequencer.advance(pose.last_seen):
+      rig.mailbox.put(pose)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Dump or replay a pose flight recorder file.')
+  subparsers = parser.add_subparsers(dest='command')
+  dump_parser = subparsers.add_parser('dump', help='print the records as CSV')
+  dump_parser.add_argument('path')
+  replay_parser = subparsers.add_parser('replay', help='replay the records through the servos')
+  replay_parser.add_argument('path')
+  replay_parser.add_argument('--speed', type=float, default=1.0,
+                             help='speed-up over the recorded pace, 0 for no delays')
+  replay_parser.add_argument('--config', default=os.path.join(
+                             os.path.dirname(os.path.abspath(__file__)), 'config/parameters.conf'),
+                             help='config with the [io] section of the rig')
+  replay_parser.add_argument('--backend', help='PWM backend overriding [io] backend, e.g. recording')
+  replay_parser.add_argument('--mapping', choices=list(MAPPINGS),
+                             help='pose to tilt and pan mapping, defaults to the recorded one')
+  args = parser.parse_args()
+
+  if args.command == 'dump':
+    print(','.join(Record._fields))
+    records, _ = read_records(args.path)
+    for record in records:
+      print('{:.6f},{},{:.6f},{:.6f},{:.6f},{},{},{}'.format(*record))
+  elif args.command == 'replay':
+    from rig import Rig
+    logging.basicConfig(level=logging.INFO)
+    config_parser = configparser.RawConfigParser()
+    config_parser.read(args.config)
+    section = dict(config_parser['io']) if config_parser.has_section('io') else {}
+    if args.backend:
+      section['backend'] = args.backend
+    records, mapping = read_records(args.path)
+    if args.mapping:
+      mapping = args.mapping
+    elif mapping is None:
+      mapping = 'pitch-yaw'
+      logging.warning('{} does not note its mapping, replaying with {}'.format(args.path, mapping))
+    rig = Rig.from_config('replay', section, MAPPINGS[mapping])
+    rig.backend.setup([rig.tilt_axis.pin, rig.pan_axis.pin])
+    rig.start()
+    try:
+      replay(records, rig, args.speed)
+      # let the actuator apply the last pose
+      time.sleep(0.1)
+    finally:
+      rig.stop()
+      rig.backend.close()
+    print('Replayed {} records: {}'.format(len(records), rig.stats()))
+  else:
+    parser.print_help()
+    sys.exit(2)
+
+
+if __name__ == '__main__':
+  main()
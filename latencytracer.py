@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import array
+import collections
+import logging
+import threading
+import time
+
+# defaults for the [latency] config
+DEFAULTS = {
+  # seconds between reports, 0 to disable
+  'interval': 10,
+  # seconds per window, the fastest message of each is taken as unqueued
+  'window': 60,
+  # windows kept for the offset and drift, i.e. a 10 minute horizon
+  'windows': 10,
+  # ms per minute the minimum delay may move before the skew is flagged as drifting
+  'drift_limit': 2.0,
+}
+# delays kept between reports, 400 poses/s at a 10s interval
+CAPACITY = 4096
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class LatencyTracer(object):
+  """Raw source to actuation delays of the poses applied, for a LatencyMonitor.
+
+  The actuator calls observe() with each pose's head.last_seen right after
+  writing it to the servos. The delay on the local clock, which includes the
+  offset between the goggles' and the Pi's clocks, goes into a ring of
+  capacity preallocated slots. Nothing else is computed on the actuator
+  thread.
+  """
+
+  def __init__(self, capacity=CAPACITY, clock=time.time):
+    self.delays = array.array('d', [0.0]) * capacity
+    # in an array, so it can be moved into a SharedPoseSlot with the delays
+    self.count = array.array('q', [0])
+    self.clock = clock
+
+  def observe(self, last_seen):
+    i = self.count[0]
+    self.delays[i % len(self.delays)] = self.clock() - last_seen / 1000.0
+    self.count[0] = i + 1
+
+  def read(self, start):
+    """Returns the delays observed from count start on, at most capacity, and the count."""
+    count = self.count[0]
+    capacity = len(self.delays)
+    return [self.delays[i % capacity] for i in range(max(start, count - capacity), count)], count
+
+
+class ClockOffset(object):
+  """Running minimum of the one-way delay, estimating the goggles' clock offset.
+
+  The fastest message of a window is taken as not queued anywhere, so its
+  delay is the clock offset plus the floor of the path. The offset is the
+  minimum over the last windows, the drift the least squares slope of
+  their minima in seconds per second.
+  """
+
+  def __init__(self, window=DEFAULTS['window'], windows=DEFAULTS['windows']):
+    self.window = window
+    self.minima = collections.deque(maxlen=windows)
+    self.started = None
+    self.current = None
+
+  def update(self, now, delays):
+    if self.started is None:
+      self.started = now
+    if delays:
+      fastest = min(delays)
+      if self.current is None or fastest < self.current:
+        self.current = fastest
+    if now - self.started >= self.window:
+      if self.current is not None:
+        self.minima.append((self.started + self.window / 2.0, self.current))
+      self.started = now
+      self.current = None
+
+  @property
+  def offset(self):
+    """Seconds to subtract from a raw delay, None before the first delay."""
+    minima = [minimum for _, minimum in self.minima]
+    if self.current is not None:
+      minima.append(self.current)
+    return min(minima) if minima else None
+
+  def projected(self, now, drift):
+    """The offset with each window minimum moved along drift to now."""
+    minima = list(self.minima)
+    if self.current is not None:
+      minima.append(((self.started + now) / 2.0, self.current))
+    if not minima:
+      return None
+    return min(minimum + drift * (now - t) for t, minimum in minima)
+
+  def drift(self):
+    """Seconds per second the window minima move, None before 3 windows."""
+    n = len(self.minima)
+    if n < 3:
+      return None
+    mean_t = sum(t for t, _ in self.minima) / n
+    mean_m = sum(m for _, m in self.minima) / n
+    variance = sum((t - mean_t) ** 2 for t, _ in self.minima)
+    if variance == 0:
+      return None
+    return sum((t - mean_t) * (m - mean_m) for t, m in self.minima) / variance
+
+
+class _Trace(object):
+
+  def __init__(self, tracer, transport, device, offset):
+    self.tracer = tracer
+    self.transport = transport
+    self.device = device
+    self.offset = offset
+    self.count = 0
+    self.drift = None
+    self.drifting = False
+
+
+class LatencyMonitor(threading.Thread):
+  """Reports source to actuation latency per transport, corrected for clock offset.
+
+  Every interval it collects the raw delays of each LatencyTracer, updates
+  that device's ClockOffset and subtracts the offset, leaving the latency
+  above the fastest message seen: queuing, decode, hand-over and actuation.
+  p50, p90 and p99 of the interval are logged and exposed per transport,
+  offset and drift per device. A drift beyond drift_limit ms per minute
+  means the clocks run apart and is flagged, the window minima are then
+  moved along the drift before taking the offset, rather than lagging
+  behind it until the old windows expire.
+  """
+
+  def __init__(self, interval=DEFAULTS['interval'], window=DEFAULTS['window'],
+               windows=DEFAULTS['windows'], drift_limit=DEFAULTS['drift_limit'], registry=None,
+               clock=time.monotonic, name='latency'):
+    super().__init__(name=name, daemon=True)
+    self.interval = interval
+    self.window = window
+    self.windows = windows
+    self.drift_limit = drift_limit
+    self.registry = registry
+    self.clock = clock
+    self.traces = []
+    # transport to the latency quantiles of the last interval, seconds
+    self.quantiles = {}
+    self._stopped = threading.Event()
+
+  @classmethod
+  def from_config(cls, section, registry=None):
+    """Returns the monitor of a [latency] config section, or None if disabled."""
+    interval = float(section.get('interval', DEFAULTS['interval']))
+    if interval <= 0:
+      return None
+    return cls(interval, float(section.get('window', DEFAULTS['window'])),
+               int(section.get('windows', DEFAULTS['windows'])),
+               float(section.get('drift_limit', DEFAULTS['drift_limit'])), registry)
+
+  def add(self, tracer, transport, device):
+    """Monitors the tracer of a device receiving over transport, before start()."""
+    trace = _Trace(tracer, transport, device, ClockOffset(self.window, self.windows))
+    self.traces.append(trace)
+    registry = self.registry
+    if registry is None:
+      return
+    if transport not in self.quantiles:
+      self.quantiles[transport] = None
+      for i, q in enumerate(QUANTILES):
+        registry.gauge_func('servo_source_latency_seconds',
+                            'Head.last_seen to servo write, corrected for the clock offset, last interval',
+                            lambda i=i: self._quantile(transport, i),
+                            {'transport': transport, 'quantile': str(q)})
+    labels = {'transport': transport, 'device': device}
+    registry.gauge_func('servo_clock_offset_seconds',
+                        'Minimum one-way delay, goggles clock offset plus the path floor',
+                        lambda: _nan(trace.offset.offset), labels)
+    registry.gauge_func('servo_clock_drift_ms_per_minute', 'Drift of the minimum one-way delay',
+                        lambda: _nan(trace.drift), labels)
+    registry.gauge_func('servo_clock_skew_drifting', '1 while the drift exceeds [latency] drift_limit',
+                        lambda: 1 if trace.drifting else 0, labels)
+
+  def _quantile(self, transport, i):
+    quantiles = self.quantiles.get(transport)
+    return quantiles[i] if quantiles else float('nan')
+
+  def run(self):
+    logger = logging.getLogger(__name__)
+    while not self._stopped.wait(self.interval):
+      try:
+        self.report()
+      except Exception as e:
+        logger.error('Failed reporting latency: {}'.format(e))
+
+  def report(self):
+    """Collects the delays since the last report and logs the latency per transport."""
+    logger = logging.getLogger(__name__)
+    now = self.clock()
+    pooled = collections.OrderedDict()
+    for trace in self.traces:
+      delays, trace.count = trace.tracer.read(trace.count)
+      trace.offset.update(now, delays)
+      drift = trace.offset.drift()
+      trace.drift = 60000.0 * drift if drift is not None else None
+      drifting = trace.drift is not None and abs(trace.drift) > self.drift_limit
+      if drifting != trace.drifting:
+        if drifting:
+          logger.warning('Clock of {} drifting {:.2f}ms per minute'.format(trace.device, trace.drift))
+        else:
+          logger.info('Clock of {} stopped drifting'.format(trace.device))
+        trace.drifting = drifting
+      offset = trace.offset.projected(now, drift) if drifting else trace.offset.offset
+      latencies = pooled.setdefault(trace.transport, [])
+      if offset is not None:
+        # never below 0, a pose faster than the estimate moves the offset next time
+        latencies.extend(max(0.0, delay - offset) for delay in delays)
+    for transport, latencies in pooled.items():
+      if not latencies:
+        self.quantiles[transport] = None
+        continue
+      latencies.sort()
+      n = len(latencies)
+      self.quantiles[transport] = [latencies[min(n - 1, int(q * n))] for q in QUANTILES]
+      logger.info('Source to servo latency over {}: p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms of {} poses'.format(
+                  transport, *([1000.0 * latency for latency in self.quantiles[transport]] + [n])))
+
+  def stats(self):
+    stats = {}
+    for transport, quantiles in self.quantiles.items():
+      if quantiles:
+        for q, latency in zip(QUANTILES, quantiles):
+          stats['{}_p{}_ms'.format(transport, int(100 * q))] = 1000.0 * latency
+    for trace in self.traces:
+      stats['{}_offset_ms'.format(trace.device)] = 1000.0 * _nan(trace.offset.offset)
+      stats['{}_drift_ms_per_minute'.format(trace.device)] = _nan(trace.drift)
+    return stats
+
+  def stop(self):
+    self._stopped.set()
+
+
+def _nan(value):
+  return float('nan') if value is None else value
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import queue
+import time
+
+# defaults for the "queue" object of config/logging.json
+DEFAULTS = {
+  'enabled': True,
+  # records waiting for the listener, further records are dropped
+  'maxsize': 10000,
+  # DEBUG records let through per second and message, 0 for no limit
+  'debug_rate': 10,
+}
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+  """QueueHandler that never blocks and leaves formatting to the listener.
+
+  The stock prepare() formats the message in the logging thread, here the
+  record goes onto the queue as is and %-style arguments are only merged
+  when the listener formats it. Records arriving while the queue is full
+  are counted in dropped instead of stalling the caller.
+  """
+
+  def __init__(self, log_queue):
+    super().__init__(log_queue)
+    self.dropped = 0
+
+  def prepare(self, record):
+    return record
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+  """Lets at most rate DEBUG records per second through for each message.
+
+  Messages are told apart by their unformatted template, so per-message
+  debug output of a hot path is sampled down instead of flooding the queue.
+  Records above DEBUG always pass.
+  """
+
+  def __init__(self, rate, clock=time.monotonic):
+    super().__init__()
+    self.rate = rate
+    self.clock = clock
+    # template -> (second the count is for, records passed in it)
+    self.windows = {}
+    self.suppressed = 0
+
+  def filter(self, record):
+    if record.levelno > logging.DEBUG or self.rate <= 0:
+      return True
+    second = int(self.clock())
+    window = self.windows.get(record.msg)
+    if window is None or window[0] != second:
+      self.windows[record.msg] = (second, 1)
+      return True
+    if window[1] < self.rate:
+      self.windows[record.msg] = (second, window[1] + 1)
+      return True
+    self.suppressed += 1
+    return False
+
+
+def configure_logging(config_dict):
+  """Configures logging from a dictConfig dict, optionally through a queue.
+
+  Unless the dict has "queue": {"enabled": false}, the handlers configured
+  on the root logger are moved behind a DroppingQueueHandler. A
+  QueueListener thread then does the formatting and the console and file
+  I/O, so a stalled SD card never blocks a servo update.
+
+  Returns:
+    The started QueueListener, stopped and flushed at exit, or None.
+  """
+  options = dict(DEFAULTS)
+  options.update(config_dict.get('queue', {}))
+  logging.config.dictConfig(config_dict)
+  if not options['enabled']:
+    return None
+
+  root = logging.getLogger()
+  handlers = list(root.handlers)
+  handler = DroppingQueueHandler(queue.Queue(int(options['maxsize'])))
+  handler.addFilter(RateLimitFilter(int(options['debug_rate'])))
+  for target in handlers:
+    root.removeHandler(target)
+  root.addHandler(handler)
+
+  listener = logging.handlers.QueueListener(handler.queue, *handlers,
+                                            respect_handler_level=True)
+  listener.start()
+  # flush what is still queued at exit
+  atexit.register(listener.stop)
+  return listener
+
+
+class ForwardingHandler(logging.Handler):
+  """Hands records from another process to the loggers of this one."""
+
+  def emit(self, record):
+    logging.getLogger(record.name).handle(record)
+
+
+def forward_logging(log_queue):
+  """Passes the records a child process puts on log_queue to this process' loggers.
+
+  The child logs through a plain QueueHandler, see log_to_queue(), its
+  records then go through the handlers configured here, e.g. the queue
+  listener and the log file of config/logging.json.
+
+  Returns:
+    The started QueueListener, stop it after the child exited.
+  """
+  listener = logging.handlers.QueueListener(log_queue, ForwardingHandler())
+  listener.start()
+  return listener
+
+
+def log_to_queue(log_queue, level):
+  """Sends all records at level or above to log_queue, in a child process.
+
+  The stock QueueHandler merges the message arguments before the record is
+  pickled onto a multiprocessing queue.
+  """
+  root = logging.getLogger()
+  for handler in list(root.handlers):
+    root.removeHandler(handler)
+  root.addHandler(logging.handlers.QueueHandler(log_queue))
+  root.setLevel(level)
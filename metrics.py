@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import array
+import bisect
+import http.server
+import logging
+import os
+import socketserver
+import threading
+
+# upper bounds in seconds of the latency histogram buckets, +Inf is implicit
+LATENCY_BUCKETS = (5e-06, 1e-05, 2.5e-05, 5e-05, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# stages of the per-message path, actuate_<axis> are added per axis
+STAGES = ('receive', 'decode', 'sequence', 'ack')
+# default for [metrics] listen, host:port or unix:<path>, empty to disable
+DEFAULT_LISTEN = '127.0.0.1:9108'
+
+
+def format_labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(key, value)
+                        for key, value in sorted(labels.items())) + '}'
+
+
+class Counter(object):
+  """Monotonic counter, inc() updates a preallocated slot."""
+
+  __slots__ = ('name', 'labels', 'slot')
+
+  def __init__(self, name, labels=None):
+    self.name = name
+    self.labels = labels or {}
+    self.slot = array.array('q', [0])
+
+  def inc(self):
+    self.slot[0] += 1
+
+  @property
+  def value(self):
+    return self.slot[0]
+
+  def samples(self):
+    yield self.name, format_labels(self.labels), self.slot[0]
+
+
+class CounterFunc(object):
+  """Counter or gauge read from function() at scrape time, for values kept elsewhere."""
+
+  __slots__ = ('name', 'labels', 'function')
+
+  def __init__(self, name, function, labels=None):
+    self.name = name
+    self.labels = labels or {}
+    self.function = function
+
+  def samples(self):
+    yield self.name, format_labels(self.labels), self.function()
+
+
+class Histogram(object):
+  """Fixed-bucket histogram of durations in seconds.
+
+  observe() bisects the bucket bounds and bumps preallocated array slots, so
+  recording keeps no new objects. Buckets are stored non-cumulative and
+  summed up when scraped.
+  """
+
+  __slots__ = ('name', 'labels', 'bounds', 'counts', 'total')
+
+  def __init__(self, name, labels=None, bounds=LATENCY_BUCKETS):
+    self.name = name
+    self.labels = labels or {}
+    self.bounds = tuple(bounds)
+    # one slot per bound plus +Inf
+    self.counts = array.array('q', [0]) * (len(self.bounds) + 1)
+    self.total = array.array('d', [0.0])
+
+  def observe(self, seconds):
+    self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+    self.total[0] += seconds
+
+  @property
+  def count(self):
+    return sum(self.counts)
+
+  def samples(self):
+    cumulative = 0
+    for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+      cumulative += count
+      labels = dict(self.labels)
+      labels['le'] = bound
+      yield self.name + '_bucket', format_labels(labels), cumulative
+    labels = format_labels(self.labels)
+    yield self.name + '_sum', labels, self.total[0]
+    yield self.name + '_count', labels, cumulative
+
+
+class Registry(object):
+  """Metrics exposed together, rendered in the Prometheus text format."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # name -> (type, help, [metrics])
+    self._families = {}
+
+  def register(self, metric, kind, help_text):
+    with self._lock:
+      family = self._families.setdefault(metric.name, (kind, help_text, []))
+      family[2].append(metric)
+    return metric
+
+  def counter(self, name, help_text, labels=None):
+    return self.register(Counter(name, labels), 'counter', help_text)
+
+  def counter_func(self, name, help_text, function, labels=None):
+    return self.register(CounterFunc(name, function, labels), 'counter', help_text)
+
+  def gauge_func(self, name, help_text, function, labels=None):
+    return self.register(CounterFunc(name, function, labels), 'gauge', help_text)
+
+  def histogram(self, name, help_text, labels=None, bounds=LATENCY_BUCKETS):
+    return self.register(Histogram(name, labels, bounds), 'histogram', help_text)
+
+  def render(self):
+    lines = []
+    with self._lock:
+      families = sorted(self._families.items())
+    for name, (kind, help_text, family) in families:
+      lines.append('# HELP {} {}'.format(name, help_text))
+      lines.append('# TYPE {} {}'.format(name, kind))
+      for metric in family:
+        for sample, labels, value in metric.samples():
+          lines.append('{}{} {}'.format(sample, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+class PipelineMetrics(object):
+  """Stage latencies and message counters of one transport to servo path.
+
+  Histograms of servo_stage_seconds per stage, actuate_<axis> timed on the
+  actuator thread, and counters for received, unknown and malformed
+  messages. labels, e.g. the device id, are added to all of them.
+  """
+
+  def __init__(self, registry=None, axes=(), labels=None):
+    if registry is None:
+      registry = Registry()
+    self.registry = registry
+    self.labels = labels or {}
+    for stage in STAGES:
+      setattr(self, stage, self._histogram(stage))
+    self.actuate = [self._histogram('actuate_' + axis.name) for axis in axes]
+    self.received = registry.counter('servo_messages_total',
+                                     'Messages received', self.labels)
+    self.unknown = registry.counter('servo_unknown_messages_total',
+                                    'Messages of another type than goggle_direction', self.labels)
+    self.malformed = registry.counter('servo_malformed_messages_total',
+                                      'Messages that could not be decoded', self.labels)
+
+  def _histogram(self, stage):
+    labels = dict(self.labels)
+    labels['stage'] = stage
+    return self.registry.histogram('servo_stage_seconds',
+                                   'Time spent per message in each stage', labels)
+
+  def sequencer(self, sequencer):
+    """Exposes the duplicate and out of sequence counts of a Sequencer."""
+    self.registry.counter_func('servo_duplicate_messages_total',
+                               'Redelivered messages dropped by message id',
+                               lambda: sequencer.duplicates, self.labels)
+    self.registry.counter_func('servo_out_of_sequence_messages_total',
+                               'Messages older than the newest seen',
+                               lambda: sequencer.reordered, self.labels)
+
+  def startup(self, actuator, started):
+    """Exposes the seconds from monotonic time started to the first pose applied.
+
+    Also the actuator's stats(): tick jitter, missed deadlines and CPU time
+    of a ControlLoop, prediction lead and error of a PosePredictor, read at
+    scrape time. An ActuatorProcess reads them from its shared slot.
+    """
+    def first_actuation():
+      if actuator.first_applied is None:
+        return float('nan')
+      return actuator.first_applied - started
+    self.registry.gauge_func('servo_first_actuation_seconds',
+                             'Seconds from start to the first pose applied, NaN before',
+                             first_actuation, self.labels)
+
+    def stat(key, scale=None):
+      if scale is None:
+        return lambda: actuator.stats()[key]
+      return lambda: scale * actuator.stats()[key]
+    registry = self.registry
+    registry.counter_func('servo_actuator_errors_total', 'Poses or servo writes that failed',
+                          stat('errors'), self.labels)
+    if getattr(actuator, 'period', None):
+      registry.counter_func('servo_control_ticks_total', 'Control loop ticks',
+                            stat('ticks'), self.labels)
+      registry.counter_func('servo_control_missed_deadlines_total',
+                            'Control loop ticks finishing after the next was due',
+                            stat('missed'), self.labels)
+      registry.gauge_func('servo_control_jitter_mean_seconds',
+                          'Mean lateness of the control loop ticks against their schedule',
+                          stat('jitter_mean_ms', 1e-3), self.labels)
+      registry.gauge_func('servo_control_jitter_max_seconds',
+                          'Largest lateness of a control loop tick against its schedule',
+                          stat('jitter_max_ms', 1e-3), self.labels)
+      registry.gauge_func('servo_control_cpu_per_tick_seconds', 'Mean CPU time of a control loop tick',
+                          stat('cpu_per_tick_us', 1e-6), self.labels)
+    if actuator.predictor is not None:
+      registry.gauge_func('servo_prediction_lead_seconds', 'Lead of the last prediction',
+                          stat('lead_ms', 1e-3), self.labels)
+      registry.gauge_func('servo_prediction_lead_mean_seconds', 'Mean lead of the predictions',
+                          stat('lead_mean_ms', 1e-3), self.labels)
+      for axis in ('roll', 'pitch', 'yaw'):
+        labels = dict(self.labels)
+        labels['axis'] = axis
+        registry.gauge_func('servo_prediction_rms_error_radians',
+                            'RMS error of the predicted against the received angles, recent poses',
+                            stat(axis + '_rms_error'), labels)
+
+  def mailbox(self, mailbox):
+    """Exposes the mailbox counts of poses dropped before actuation."""
+    self.registry.counter_func('servo_dropped_poses_total',
+                               'Poses superseded by a newer one before actuation',
+                               lambda: mailbox.superseded, self.labels)
+
+  def shared_slot(self, slot):
+    """Exposes the cross-process latency of a SharedPoseSlot.
+
+    The actuate histograms move into the slot, the actuator process times
+    the servo writes in them.
+    """
+    self.crossprocess = slot.bind_latency(self._histogram('crossprocess'))
+    slot.bind_actuate(self.actuate)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = self.server.registry.render().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # scrapes are not worth a log line each
+    pass
+
+
+class _TcpMetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def serve(registry, listen=DEFAULT_LISTEN):
+  """Serves registry over HTTP on a background thread.
+
+  Args:
+    registry: The Registry to render on GET /metrics.
+    listen: 'host:port', or 'unix:<path>' for a Unix socket, e.g. scraped
+      with curl --unix-socket <path> http://localhost/metrics.
+  Returns:
+    The server, shut down with shutdown(), or None if listen is empty.
+  """
+  logger = logging.getLogger(__name__)
+
+  if not listen:
+    return None
+  if listen.startswith('unix:'):
+    path = listen[len('unix:'):]
+    if os.path.exists(path):
+      os.unlink(path)
+    server = _UnixMetricsServer(path, _MetricsHandler)
+  else:
+    host, port = listen.rsplit(':', 1)
+    server = _TcpMetricsServer((host, int(port)), _MetricsHandler)
+  server.registry = registry
+  thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+  thread.start()
+  logger.info('Serving metrics on {}'.format(listen))
+  return server
@@ -1,47 +1,140 @@
 #!/usr/bin/env python3
 # coding=utf-8
 
+# sdnotify first, its import time is the start of time to ready and first actuation
+import sdnotify
+import concurrent.futures
 import configparser
 import json
 import logging
-import logging.config
-import math
 import os
 import sys
 import time
-import wiringpi
+
+from calibration import ConfigWatcher, parse_config
+from flightrecorder import FLAG_OUT_OF_SEQUENCE, FlightRecorder
+from latencytracer import LatencyMonitor
+from logqueue import configure_logging
+from metrics import DEFAULT_LISTEN, Registry, serve
+from mqttsession import CONNECT_TIMEOUT, Backoff, MqttSession
+from posewire import UnknownMessageType, decode
+from rig import SECTION_PREFIX, Rig, rig_sections, setup_backends
+from statetelemetry import StatePublisher
 
 import datetime
-import jwt
-import paho.mqtt.client as mqtt
-import random
-import ssl
+import threading
 
 __version__ = '0.0.1'
 
 # globals
-# default GPIO pin assignment
-tilt_servo_max_pw = 252
-tilt_servo_min_pw = 55.3
-tilt_min_angle = -1.57
-tilt_max_angle = 1.57
-tilt_ratio = 1.0
-tilt_pin = 13
-pan_servo_max_pw = 252
-pan_servo_min_pw = 55.3
-pan_min_angle = -1.57
-pan_max_angle = 1.57
-pan_ratio = 1.0
-pan_pin = 18
-
-# The initial backoff time after a disconnection occurs, in seconds.
-minimum_backoff_time = 1
-# The maximum backoff time before giving up, in seconds.
-MAXIMUM_BACKOFF_TIME = 32
-# Whether to wait with exponential backoff before publishing.
-should_backoff = False
+# jwt, paho and ssl, imported by import_transport() once the servos are centered
+jwt = None
+mqtt = None
+ssl = None
+
+# module logger for the per-message paths, looked up once
+logger = logging.getLogger(__name__)
+
+# pan/tilt heads by device id, built from the [io] and [io.<device>] config in main()
+rigs = {}
+# per-stage latencies and message counters of all rigs, served by the [metrics] endpoint
+registry = Registry()
+# recalibrations from config messages, off paho's network thread and in order
+config_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='config')
+
+# How often the listen_for_messages cb hook is called, in seconds.
+CALLBACK_INTERVAL = 1
+# Fraction of the JWT lifetime after which the client is rotated.
+ROTATION_AT = 0.9
+# How often per-device stats are logged, in seconds.
+STATS_INTERVAL = 60
+# defaults for the [mqtt] config
+MQTT_DEFAULTS = {
+  'cloud_region': 'europe-west1',
+  'registry_id': 'goggle-registry',
+  'device_id': 'orqa-goggles-prototype-0001',
+  # set to bind the [io.<device>] rigs to this gateway
+  'gateway_id': '',
+  # empty for a broker without JWT authentication
+  'private_key_file': '/config/ec2_private.pem',
+  'jwt_expires_minutes': 20,
+  # the IoT Core bridge, or a local broker such as mosquitto for soak tests
+  'mqtt_bridge_hostname': 'mqtt.googleapis.com',
+  'mqtt_bridge_port': 8883,
+  # CA certificates for TLS, empty for a plain connection
+  'ca_certs': 'roots.pem',
+  # reconnect backoff in seconds, doubling with jitter up to the maximum, retried forever
+  'minimum_backoff_time': 1,
+  'maximum_backoff_time': 32,
+}
+
+def import_transport():
+  """Imports the JWT, MQTT and TLS libraries, slow to load on a Pi."""
+  global jwt
+  global mqtt
+  global ssl
+  if mqtt is None:
+    import jwt
+    import paho.mqtt.client as mqtt
+    import ssl
+
+
+class RepeatTimer(threading.Timer):
+  """Timer thread that calls function every interval seconds until cancelled."""
+
+  def __init__(self, interval, function, args=None, kwargs=None):
+    super().__init__(interval, function, args, kwargs)
+    self.daemon = True
+
+  def run(self):
+    while not self.finished.wait(self.interval):
+      try:
+        self.function(*self.args, **self.kwargs)
+      except Exception as e:
+        logging.getLogger(__name__).error('Exception in timer {}'.format(e))
+
 
 # [START iot_mqtt_jwt]
+class TokenManager(object):
+  """Mints JWTs from a private key that is read and parsed only once.
+
+  Parsing the PEM file is the slow part of create_jwt on a Pi, signing with
+  the parsed key is left for each token.
+  """
+
+  def __init__(self, project_id, private_key_file, algorithm, expires_minutes=60):
+    logger = logging.getLogger(__name__)
+    import_transport()
+
+    self.project_id = project_id
+    self.algorithm = algorithm
+    self.expires_minutes = expires_minutes
+
+    # Read the private key file.
+    with open(private_key_file, 'r') as f:
+      private_key = f.read()
+    try:
+      self.private_key = jwt.algorithms.get_default_algorithms()[algorithm].prepare_key(private_key)
+    except Exception as e:
+      # leave the parsing to jwt.encode on every token
+      logger.info('Could not pre-parse private key: {}'.format(e))
+      self.private_key = private_key
+    logger.info('Loaded {} private key file {}'.format(algorithm, private_key_file))
+
+  def create(self):
+    """Returns a new JWT expiring in expires_minutes."""
+    now = datetime.datetime.utcnow()
+    token = {
+            # The time that the token was issued at
+            'iat': now,
+            # The time the token expires.
+            'exp': now + datetime.timedelta(minutes=self.expires_minutes),
+            # The audience field should always be set to the GCP project id.
+            'aud': self.project_id
+    }
+    return jwt.encode(token, self.private_key, algorithm=self.algorithm)
+
+
 def create_jwt(project_id, private_key_file, algorithm):
   """Creates a JWT (https://jwt.io) to establish an MQTT connection.
       Args:
@@ -51,29 +144,12 @@ def create_jwt(project_id, private_key_file, algorithm):
         algorithm: The encryption algorithm to use. Either 'RS256' or 'ES256'
       Returns:
           An MQTT generated from the given project_id and private key, which
-          expires in 20 minutes. After 20 minutes, your client will be
+          expires in 60 minutes. After 60 minutes, your client will be
           disconnected, and a new JWT will have to be generated.
       Raises:
           ValueError: If the private_key_file does not contain a known key.
       """
-  logger = logging.getLogger(__name__)
-
-  token = {
-          # The time that the token was issued at
-          'iat': datetime.datetime.utcnow(),
-          # The time the token expires.
-          'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60),
-          # The audience field should always be set to the GCP project id.
-          'aud': project_id
-  }
-
-  # Read the private key file.
-  with open(private_key_file, 'r') as f:
-    private_key = f.read()
-
-  logger.info('Creating JWT using {} from private key file {}'.format(algorithm, private_key_file))
-
-  return jwt.encode(token, private_key, algorithm=algorithm)
+  return TokenManager(project_id, private_key_file, algorithm).create()
 # [END iot_mqtt_jwt]
 
 # [START iot_mqtt_config]
@@ -82,91 +158,99 @@ def error_str(rc):
   return '{}: {}'.format(rc, mqtt.error_string(rc))
 
 
-def on_connect(unused_client, unused_userdata, unused_flags, rc):
+def on_connect(unused_client, userdata, unused_flags, rc):
   """Callback for when a device connects."""
   logger = logging.getLogger(__name__)
 
   logger.info('MQTT on_connect {}'.format(mqtt.connack_string(rc)))
-
-  # After a successful connect, reset backoff time and stop backing off.
-  global should_backoff
-  global minimum_backoff_time
-  should_backoff = False
-  minimum_backoff_time = 1
+  # the MqttSession Connection of the client moves on to subscribing
+  if userdata is not None:
+    userdata.on_connect(rc)
 
 
-def on_disconnect(unused_client, unused_userdata, rc):
+def on_disconnect(unused_client, userdata, rc):
   """Paho callback for when a device disconnects."""
   logger = logging.getLogger(__name__)
 
   logger.info('MQTT on_disconnect {}'.format(error_str(rc)))
-  # Since a disconnect occurred, the next loop iteration will wait with exponential backoff.
-  global should_backoff
-  should_backoff = True
+  # the MqttSession replaces the client after a backoff
+  if userdata is not None:
+    userdata.on_disconnect()
 
 
-def on_publish(unused_client, unused_userdata, unused_mid):
+def on_publish(unused_client, unused_userdata, mid):
   """Paho callback when a message is sent to the broker."""
-  logger = logging.getLogger(__name__)
-
-  logger.info('MQTT on_publish')
+  # every state batch ends up here, formatted by the log listener only if enabled
+  logger.debug('MQTT on_publish %s', mid)
 
 
 def on_message(unused_client, unused_userdata, message):
   """Callback when the device receives a message on a subscription."""
-  logger = logging.getLogger(__name__)
-
-  payload = str(message.payload)
-  logger.debug('Received message \'{}\' on topic \'{}\' with Qos {}'.format(
-              payload, message.topic, str(message.qos)))
-
-  __decode_message(payload)
+  # paho re-raises callback errors, ending its network thread unnoticed
+  try:
+    __handle_message(message)
+  except Exception as e:
+    logger.error('Failed handling message on topic %s: %s', message.topic, e)
+
+
+def __handle_message(message):
+  start = time.perf_counter()
+  # QoS 1 acknowledgement is handled by paho, the payload is bytes
+  payload = message.payload
+  # per-message logging is %-style, formatted by the log listener only if enabled
+  logger.debug('Received message %r on topic \'%s\' with Qos %s',
+               payload, message.topic, message.qos)
+
+  # /devices/<device id>/..., each bound device drives its own rig
+  topic = message.topic.split('/')
+  device_id = topic[2] if len(topic) > 2 else None
+  if len(topic) > 3 and topic[3] == 'config':
+    config_executor.submit(__apply_config, device_id, payload)
+    return
+  rig = rigs.get(device_id)
+  if rig is None:
+    logger.debug('No rig for topic %s', message.topic)
+    return
+  __decode_message(rig, payload)
+  rig.record(start)
 
 
-def get_client(project_id, cloud_region, registry_id, device_id, private_key_file,
-               algorithm, ca_certs, mqtt_bridge_hostname, mqtt_bridge_port):
+def create_client(project_id, cloud_region, registry_id, device_id, private_key_file,
+                  algorithm, ca_certs, token_manager=None, userdata=None):
   """Create our MQTT client. The client_id is a unique string that identifies
-  this device. For Google Cloud IoT Core, it must be in the format below."""
+  this device. For Google Cloud IoT Core, it must be in the format below.
+
+  The JWT comes from token_manager if given. The client is not connected,
+  MqttSession connects it and passes itself paho's events through userdata."""
   logger = logging.getLogger(__name__)
+  import_transport()
 
   client_id = 'projects/{}/locations/{}/registries/{}/devices/{}'.format(
               project_id, cloud_region, registry_id, device_id)
   logger.info('Device client_id is \'{}\''.format(client_id))
 
-  client = mqtt.Client(client_id=client_id)
+  client = mqtt.Client(client_id=client_id, userdata=userdata)
 
   # With Google Cloud IoT Core, the username field is ignored, and the
   # password field is used to transmit a JWT to authorize the device.
-  client.username_pw_set(username='unused',
-                         password=create_jwt(project_id, private_key_file, algorithm))
+  # A local broker without a private key gets neither.
+  if token_manager is not None:
+    client.username_pw_set(username='unused', password=token_manager.create())
+  elif private_key_file:
+    client.username_pw_set(username='unused',
+                           password=create_jwt(project_id, private_key_file, algorithm))
 
   # Enable SSL/TLS support.
-  client.tls_set(ca_certs=ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+  if ca_certs:
+    client.tls_set(ca_certs=ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
 
   # Register message callbacks. https://eclipse.org/paho/clients/python/docs/
-  # describes additional callbacks that Paho supports. In this example, the
-  # callbacks just print to standard out.
+  # describes additional callbacks that Paho supports.
   client.on_connect = on_connect
   client.on_publish = on_publish
   client.on_disconnect = on_disconnect
   client.on_message = on_message
 
-  # Connect to the Google MQTT bridge.
-  client.connect(mqtt_bridge_hostname, mqtt_bridge_port)
-
-  # This is the topic that the device will receive configuration updates on.
-  mqtt_config_topic = '/devices/{}/config'.format(device_id)
-
-  # Subscribe to the config topic.
-  client.subscribe(mqtt_config_topic, qos=1)
-
-  # The topic that the device will receive commands on.
-  mqtt_command_topic = '/devices/{}/commands/#'.format(device_id)
-
-  # Subscribe to the commands topic, QoS 1 enables message acknowledgement.
-  logger.info('Subscribing to {}'.format(mqtt_command_topic))
-  client.subscribe(mqtt_command_topic, qos=0)
-
   return client
 # [END iot_mqtt_config]
 
@@ -187,97 +271,117 @@ def attach_device(client, device_id, auth):
   # [START iot_attach_device]
   attach_topic = '/devices/{}/attach'.format(device_id)
   attach_payload = '{{"authorization" : "{}"}}'.format(auth)
-  client.publish(attach_topic, attach_payload, qos=1)
+  return client.publish(attach_topic, attach_payload, qos=1)
   # [END iot_attach_device]
 
 
+def subscription_topics(device_ids, gateway_id):
+  """Returns the (topic, qos) pairs of the devices, subscribed in one batch."""
+  topics = []
+  for device_id in device_ids:
+    # The topic devices receive configuration updates on.
+    topics.append(('/devices/{}/config'.format(device_id), 1))
+    # The topic devices receive commands on.
+    topics.append(('/devices/{}/commands/#'.format(device_id), 0))
+  if gateway_id is None:
+    # Connected as the device itself.
+    for device_id in device_ids:
+      topics.append(('/devices/{}/errors'.format(device_id), 0))
+    return topics
+
+  # The topic gateways receive configuration updates on.
+  topics.append(('/devices/{}/config'.format(gateway_id), 1))
+  # The topic gateways receive error updates on. QoS must be 0.
+  topics.append(('/devices/{}/errors'.format(gateway_id), 0))
+  return topics
+
+
 def listen_for_messages(
-      service_account_json, project_id, cloud_region, registry_id, device_id,
+      service_account_json, project_id, cloud_region, registry_id, device_ids,
       gateway_id, private_key_file, algorithm, ca_certs,
-      mqtt_bridge_hostname, mqtt_bridge_port, jwt_expires_minutes, cb=None):
-  """Listens for messages sent to the gateway and bound devices."""
+      mqtt_bridge_hostname, mqtt_bridge_port, jwt_expires_minutes, cb=None, backoff=None,
+      publisher=None):
+  """Listens for messages sent to the gateway and the bound device_ids.
+
+  With gateway_id None the only device in device_ids connects directly. An
+  MqttSession keeps the client connected, reconnecting with backoff forever.
+  Before the JWT expires a client with a fresh token is connected and
+  subscribed in the background, and only then is the old client disconnected.
+  A StatePublisher, if given, publishes through the session's client.
+  """
   # [START iot_listen_for_messages]
-  global minimum_backoff_time
-  
   logger = logging.getLogger(__name__)
 
-  jwt_iat = datetime.datetime.utcnow()
   jwt_exp_mins = jwt_expires_minutes
-  # Use gateway to connect to server
-  client = get_client(project_id, cloud_region, registry_id, gateway_id,
-                      private_key_file, algorithm, ca_certs, mqtt_bridge_hostname,
-                      mqtt_bridge_port)
-
-  attach_device(client, device_id, '')
-  logger.debug('Waiting for device to attach')
-  time.sleep(5)
+  # the key is parsed once, tokens are minted for every new client
+  token_manager = None
+  if private_key_file:
+    token_manager = TokenManager(project_id, private_key_file, algorithm, jwt_exp_mins)
+  if gateway_id is None and len(device_ids) != 1:
+    raise ValueError('{} devices need a gateway'.format(len(device_ids)))
+  client_device_id = gateway_id if gateway_id is not None else device_ids[0]
+
+  def new_client(userdata):
+    return create_client(project_id, cloud_region, registry_id, client_device_id,
+                         private_key_file, algorithm, ca_certs,
+                         token_manager=token_manager, userdata=userdata)
+
+  # paho's network thread dispatches to on_message as soon as a packet
+  # arrives, the session only connects, subscribes and replaces clients
+  session = MqttSession(new_client, mqtt_bridge_hostname, mqtt_bridge_port,
+                        subscription_topics(device_ids, gateway_id),
+                        attach_ids=device_ids if gateway_id is not None else (),
+                        attach=lambda client, device_id: attach_device(client, device_id, ''),
+                        received=lambda: sum(rig.metrics.received.value for rig in rigs.values()),
+                        registry=registry, backoff=backoff)
+  session.start()
+  if publisher is not None:
+    publisher.client_source = lambda: session.client
+    publisher.start()
+  # ready once subscribed, or offline with the servos held while the session retries
+  if session.subscribed.wait(CONNECT_TIMEOUT):
+    status = 'Connected as {}'.format(client_device_id)
+  else:
+    status = 'Offline, reconnecting as {}'.format(client_device_id)
+  logger.info('Ready after {:.2f}s'.format(sdnotify.ready(status)))
 
-  # The topic devices receive configuration updates on.
-  device_config_topic = '/devices/{}/config'.format(device_id)
-  client.subscribe(device_config_topic, qos=1)
+  def rotate_client():
+    logger.info('Rotating MQTT client before the {} minute token expires'.format(jwt_exp_mins))
+    session.rotate()
 
-  # The topic gateways receive configuration updates on.
-  gateway_config_topic = '/devices/{}/config'.format(gateway_id)
-  client.subscribe(gateway_config_topic, qos=1)
+  def callback():
+    client = session.client
+    if client is not None:
+      cb(client)
 
-  # The topic gateways receive error updates on. QoS must be 0.
-  error_topic = '/devices/{}/errors'.format(gateway_id)
-  client.subscribe(error_topic, qos=0)
-
-  while True:
-    try:
-      client.loop()
-      if cb is not None:
-        cb(client)
-
-      if should_backoff:
-        # If backoff time is too large, give up.
-        if minimum_backoff_time > MAXIMUM_BACKOFF_TIME:
-          logger.info('Exceeded maximum backoff time. Giving up')
-          break
-
-        delay = minimum_backoff_time + random.randint(0, 1000) / 1000.0
-        time.sleep(delay)
-        minimum_backoff_time *= 2
-        client.connect(mqtt_bridge_hostname, mqtt_bridge_port)
-
-      seconds_since_issue = (datetime.datetime.utcnow() - jwt_iat).seconds
-      if seconds_since_issue > 60 * jwt_exp_mins:
-        logger.info('Refreshing token after {}s'.format(seconds_since_issue))
-        jwt_iat = datetime.datetime.utcnow()
-        client = get_client(project_id, cloud_region, registry_id, gateway_id,
-                            private_key_file, algorithm, ca_certs, mqtt_bridge_hostname,
-                            mqtt_bridge_port)
-
-      time.sleep(1)
-
-    except KeyboardInterrupt:
-      detach_device(client, device_id)
-      logger.info('Keyboard interrupt')
-      raise
-    except Exception as e:
-      logger.error('Exception in listen loop {}'.format(e))
+  # housekeeping runs on timers so it never stalls inbound traffic
+  timers = [RepeatTimer(60 * jwt_exp_mins * ROTATION_AT, rotate_client)]
+  if cb is not None:
+    timers.append(RepeatTimer(CALLBACK_INTERVAL, callback))
+  for timer in timers:
+    timer.start()
 
-  logger.info('Exiting MQTT listener')
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    client = session.client
+    if gateway_id is not None and client is not None:
+      for device_id in device_ids:
+        detach_device(client, device_id)
+    logger.info('Keyboard interrupt')
+    raise
+  finally:
+    for timer in timers:
+      timer.cancel()
+    if publisher is not None:
+      publisher.stop()
+    session.stop()
+    logger.info('Exiting MQTT listener, {} reconnects, about {} messages missed'.format(
+                session.reconnects, session.missed))
   # [END iot_listen_for_messages]
 
 def main():
   # [START main]
-  global tilt_pin
-  global pan_pin
-  global tilt_ratio
-  global pan_ratio
-  global tilt_servo_max_pw
-  global tilt_servo_min_pw
-  global pan_servo_max_pw
-  global pan_servo_min_pw
-  global tilt_max_angle
-  global tilt_min_angle
-  global pan_max_angle
-  global pan_min_angle
-
-  global minimum_backoff_time
-  global MAXIMUM_BACKOFF_TIME
 
   #If the module is executed as a script __name__ will be '__main__' and sys.argv[0] will be the full path of the module.
   if __name__ == '__main__':
@@ -293,7 +397,8 @@ def main():
   #  remove("subservologging.log")
   with open(loggerconfig_file_path, 'r') as logging_configuration_file:
     config_dict = json.load(logging_configuration_file)
-  logging.config.dictConfig(config_dict)
+  # records are formatted and written by a background listener
+  configure_logging(config_dict)
   # Log that the logger was configured
   logger = logging.getLogger(__name__)
   logger.info('Logging configured')
@@ -312,24 +417,25 @@ def main():
     logger.info('Read pubsub project {}, and topic {}'.format(project_id, topic_id))
   except:
     logger.error('Exception when reading telemetry parameters from {}'.format(config_file_path))
+  mqtt_config = dict(MQTT_DEFAULTS)
+  if config_parser.has_section('mqtt'):
+    mqtt_config.update(config_parser['mqtt'])
   try:
-    config_parser.read(config_file_path)
-    tilt_pin = int(config_parser['io']['tilt_pin'])
-    pan_pin = int(config_parser['io']['pan_pin'])
-    tilt_ratio = float(config_parser['io']['tilt_ratio'])
-    pan_ratio = float(config_parser['io']['pan_ratio'])
-    tilt_servo_max_pw = float(config_parser['io']['tilt_servo_max_pw'])
-    tilt_servo_min_pw = float(config_parser['io']['tilt_servo_min_pw'])
-    pan_servo_max_pw = float(config_parser['io']['pan_servo_max_pw'])
-    pan_servo_min_pw = float(config_parser['io']['pan_servo_min_pw'])
-    tilt_max_angle = float(config_parser['io']['tilt_max_angle'])
-    tilt_min_angle = float(config_parser['io']['tilt_min_angle'])
-    pan_max_angle = float(config_parser['io']['pan_max_angle'])
-    pan_min_angle = float(config_parser['io']['pan_min_angle'])
-    logger.info('Tilt pin {}, servo ratio {}, servo max pw {}, servo min pw {}, max angle {}, min angle {}'.format(tilt_pin, tilt_ratio, tilt_servo_max_pw, tilt_servo_min_pw, tilt_max_angle, tilt_min_angle))
-    logger.info('Pan pin {}, servo ratio {}, servo max pw {}, servo min pw {}, max angle {}, min angle {}'.format(pan_pin, pan_ratio, pan_servo_max_pw, pan_servo_min_pw, pan_max_angle, pan_min_angle))
+    # rigs on the same PWM board share its backend
+    shared_backends = {}
+    for device_id, section in rig_sections(config_parser, mqtt_config['device_id']):
+      rigs[device_id] = Rig.from_config(device_id, section, __pose_angles, shared_backends,
+                                        registry)
   except:
     logger.error('Exception when reading io parameters from {}'.format(config_file_path))
+    rigs.clear()
+    rigs[mqtt_config['device_id']] = Rig.from_config(mqtt_config['device_id'], {}, __pose_angles,
+                                                     registry=registry)
+  for rig in rigs.values():
+    logger.info('{}, actuator {}, predictor {}'.format(
+                rig, type(rig.actuator).__name__, 'on' if rig.actuator.predictor else 'off'))
+    logger.info('Tilt {}'.format(rig.tilt_axis))
+    logger.info('Pan {}'.format(rig.pan_axis))
 
   # sanity check
   if 'GOOGLE_APPLICATION_CREDENTIALS' in os.environ:
@@ -339,130 +445,173 @@ def main():
     # should exit!
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/home/ubuntu/agent-key.json'
   
-  # init GPIO
-  wiringpi.wiringPiSetupGpio()
-  # set GPIO13 and GPIO18  to be PWM outputs
-  wiringpi.pinMode(tilt_pin, wiringpi.GPIO.PWM_OUTPUT)
-  wiringpi.pinMode(pan_pin, wiringpi.GPIO.PWM_OUTPUT)
-  # set PWM mode  to milliseconds
-  wiringpi.pwmSetMode(wiringpi.GPIO.PWM_MODE_MS)
-  # divide down clock for 20ms period
-  wiringpi.pwmSetClock(192)
-  wiringpi.pwmSetRange(2000)
-  # set PWM outputs to center position (1.5 ms)
-  wiringpi.pwmWrite(tilt_pin, 150)
-  wiringpi.pwmWrite(pan_pin, 150)
+  # always-on flight recorder of the received poses, one ring file per rig
+  recorder_section = config_parser['recorder'] if config_parser.has_section('recorder') else {}
+  for rig in rigs.values():
+    try:
+      rig.recorder = FlightRecorder.from_config(recorder_section, path_here, rig.device_id,
+                                                 'pitch-yaw')
+    except Exception as e:
+      logger.error('Failed opening the flight recorder of {}: {}'.format(rig, e))
+
+  # init PWM, 20ms period on the tilt and pan pins of every rig
+  backends = setup_backends(rigs.values())
+  for rig in rigs.values():
+    # set PWM outputs to center position (1.5 ms)
+    rig.tilt_axis.set_pulse_width(150)
+    rig.pan_axis.set_pulse_width(150)
+    # start the actuator, transport callbacks only decode, deposit and return
+    rig.start(sdnotify.STARTED)
+  sdnotify.status('Servos centered')
+
+  # metrics endpoint, [metrics] listen = host:port or unix:<path>, empty to disable
+  try:
+    listen = config_parser.get('metrics', 'listen', fallback=DEFAULT_LISTEN)
+    metrics_server = serve(registry, listen)
+  except Exception as e:
+    logger.error('Failed serving metrics: {}'.format(e))
+    metrics_server = None
+
+  def log_stats():
+    for rig in rigs.values():
+      logger.info('Rig {} {}'.format(rig.device_id, rig.stats()))
+  stats_timer = RepeatTimer(STATS_INTERVAL, log_stats)
+  stats_timer.start()
+
+  # head.last_seen to servo write latency, [latency] interval = 0 to disable
+  latency_monitor = LatencyMonitor.from_config(
+                    config_parser['latency'] if config_parser.has_section('latency') else {}, registry)
+  if latency_monitor is not None:
+    for rig in rigs.values():
+      latency_monitor.add(rig.tracer, 'mqtt', rig.device_id)
+    latency_monitor.start()
+
+  # apply [io] calibration changes in parameters.conf without a restart
+  def reload_config(config_parser):
+    for device_id, section in rig_sections(config_parser, mqtt_config['device_id']):
+      rig = rigs.get(device_id)
+      if rig is None:
+        logger.error('New rig {} in {} needs a restart'.format(device_id, config_file_path))
+      elif section != rig.section:
+        rig.recalibrate(section)
+        logger.info('Recalibrated {}: {}, {}'.format(rig, rig.tilt_axis, rig.pan_axis))
+  config_watcher = ConfigWatcher(config_file_path, reload_config)
+  config_watcher.start()
+
+  # where the servos point, batched to /devices/<id>/state, [state] interval = 0 to disable
+  try:
+    state_publisher = StatePublisher.from_config(
+                      config_parser['state'] if config_parser.has_section('state') else {},
+                      list(rigs.values()), registry)
+  except Exception as e:
+    logger.error('Failed setting up state telemetry: {}'.format(e))
+    state_publisher = None
 
   # MQTT
   try:
-    cloud_region = 'europe-west1'
-    registry_id = 'goggle-registry'
-    device_id = 'orqa-goggles-prototype-0001'
-    #mqtt_topic = '/devices/{}/{}'.format(device_id, 'events') #or 'state'
-    private_key_file = '/config/ec2_private.pem'
-
-    jwt_iat = datetime.datetime.utcnow()
-    jwt_exp_mins = 20
-    client = get_client(project_id, cloud_region, registry_id,
-                        device_id, private_key_file, 'RS256', #or 'ES256'
-                        'roots.pem', 'mqtt.googleapis.com', '8883') #or 443
+    # without a gateway the only device connects directly
+    gateway_id = mqtt_config['gateway_id'] or None
     listen_for_messages(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"), project_id,
-                        cloud_region, registry_id, device_id,
-                        None, private_key_file,
-                        'RS256', 'roots.pem', 'mqtt.googleapis.com',
-                        '8883', jwt_exp_mins)    
+                        mqtt_config['cloud_region'], mqtt_config['registry_id'],
+                        list(rigs), gateway_id, mqtt_config['private_key_file'],
+                        'RS256', #or 'ES256'
+                        mqtt_config['ca_certs'], mqtt_config['mqtt_bridge_hostname'],
+                        int(mqtt_config['mqtt_bridge_port']), #or 443
+                        int(mqtt_config['jwt_expires_minutes']),
+                        backoff=Backoff(float(mqtt_config['minimum_backoff_time']),
+                                        float(mqtt_config['maximum_backoff_time'])),
+                        publisher=state_publisher)
   except Exception as e:
     logger.info('Failed setting up MQTT listener: {}'.format(e))
+  finally:
+    stats_timer.cancel()
+    config_watcher.stop()
+    config_executor.shutdown()
+    if latency_monitor is not None:
+      latency_monitor.stop()
+    for rig in rigs.values():
+      rig.stop()
+    log_stats()
+    for backend in backends:
+      backend.close()
+    if metrics_server is not None:
+      metrics_server.shutdown()
   logger.info('Exiting')
   #  [END main]
 
-def __decode_message(message):
-  # [START __subscriber_callback]
-  global tilt_servo_max_pw
-  global tilt_servo_min_pw
-  global tilt_max_angle
-  global tilt_min_angle
-  global tilt_ratio
-  global tilt_pin
-  global pan_servo_max_pw
-  global pan_servo_min_pw
-  global pan_max_angle
-  global pan_min_angle
-  global pan_ratio
-  global pan_pin
-
-  logger = logging.getLogger(__name__)
-  
-  # Message format:
-  #{
-  #  "links": [],
-  #  "head": {
-  #      "links": [],
-  #      "type": "goggle_direction",
-  #      "last_seen": 1557746562 (epoch_milliseconds)
-  #  },
-  #  "body": {
-  #      "roll": 0.0,
-  #      "pitch": 0.0, (tilt)
-  #      "yaw": 0.7853981633974483 (pan)
-  #  }
-  #}
+def __apply_config(device_id, payload):
+  # [START __apply_config]
+  # IoT Core sends the current config on subscribe, empty when none was set
+  if not payload:
+    return
+  # same format as config/parameters.conf, [io] and [io.<device>] sections
   try:
-    data = json.loads(message)
-    if data['head'].get('type') != 'goggle_direction':
-      logger.debug('Unknown message type')
-      message.ack()
-      return
-  except:
-    logger.error('Could not understand message: {}'.format(message))
-    message.ack()
+    config_parser = parse_config(payload.decode('utf-8'))
+  except Exception as e:
+    logger.error('Could not understand config message: {}'.format(e))
     return
+  # a bound device's config is for its rig, the gateway's for all of them
+  targets = [rigs[device_id]] if device_id in rigs else list(rigs.values())
+  for rig in targets:
+    changes = dict(config_parser['io']) if config_parser.has_section('io') else {}
+    if config_parser.has_section(SECTION_PREFIX + rig.device_id):
+      changes.update(config_parser[SECTION_PREFIX + rig.device_id])
+    if not changes:
+      continue
+    section = dict(rig.section)
+    section.update(changes)
+    # resent on every subscribe, a rebuild would also force servo writes
+    if section == rig.section:
+      continue
+    try:
+      rig.recalibrate(section)
+      logger.info('Recalibrated {} from config message: {}, {}'.format(rig, rig.tilt_axis, rig.pan_axis))
+    except Exception as e:
+      logger.error('Invalid calibration for {} in config message, keeping the old one: {}'.format(rig.device_id, e))
+  # [END __apply_config]
+
+def __decode_message(rig, message):
+  # [START __subscriber_callback]
+  clock = time.perf_counter
+  received = time.time()
+  metrics = rig.metrics
+  metrics.received.inc()
+  # goggle_direction message, JSON or binary, see posewire.py
+  start = clock()
   try:
-    if data['head'].get('last_seen') < __decode_message.last_seen:
-      logger.debug('Skip this message - out of sequence, head: {}, last seen: {}'.format(data['head']['last_seen'], __subscriber_callback.last_seen))
-      message.ack()
-      return
-  except AttributeError:
-    logger.debug('First message since the start')
-  except KeyError:
-    logger.info('Message does not contain head.last_seen. Skip this')
-    message.ack()
+    pose = decode(message)
+  except UnknownMessageType:
+    metrics.unknown.inc()
+    logger.debug('Unknown message type')
+    return
+  except KeyError as e:
+    metrics.malformed.inc()
+    logger.info('Message does not contain %s. Skip this', e)
     return
   except:
-    logger.error('Some weird exception checking the pubsub message head.last_seen. Skip this')
-    message.ack()
+    metrics.malformed.inc()
+    logger.error('Could not understand message: %r', message)
+    return
+  decoded = clock()
+  metrics.decode.observe(decoded - start)
+  # compare and advance in one step, paho and the gateway rotation may overlap
+  if not rig.sequencer.advance(pose.last_seen):
+    logger.debug('Skip this message - out of sequence, head: %s, last seen: %s', pose.last_seen, rig.sequencer.last_seen)
+    rig.record_pose(received, pose, FLAG_OUT_OF_SEQUENCE)
     return
-  __decode_message.last_seen = data['head']['last_seen']
-  #logger.debug('Last seen {}'.format(__decode_message.last_seen))
 
-  try:
-    __set_angle(tilt_pin, data['body']['pitch'], tilt_ratio, tilt_servo_max_pw, tilt_servo_min_pw, tilt_max_angle, tilt_min_angle)
-    __set_angle(pan_pin, data['body']['yaw'], pan_ratio, pan_servo_max_pw, pan_servo_min_pw, pan_max_angle, pan_min_angle)
-  except Exception as e:
-    logger.error('Failed to set tilt/pan: {}'.format(e))
-  message.ack()
+  # hand the pose over to the rig's actuator thread, superseded poses are dropped there
+  rig.mailbox.put(pose)
+  metrics.sequence.observe(clock() - decoded)
+  # after the hand-over, the actuator does not wait for the recorder
+  rig.record_pose(received, pose)
   # [END __subscriber_callback]
 
-def __set_angle(pin, angle, ratio, max_pw, min_pw, max_angle, min_angle):
-  # [START __set_angle]
-  logger = logging.getLogger(__name__)
-
-  logger.debug('Angle {} on pin {}'.format(angle, pin))
-  if angle < min_angle:
-    angle = min_angle
-    logger.debug('Truncate angle < min')
-  elif angle > max_angle:
-    angle = max_angle
-    logger.debug('Truncate angle > max')
-
-  #angle_scaled = angle * ratio
-  #logger.debug('Angle scaled {}'.format(angle_scaled))
-  servo_delta = max_pw - min_pw
-  angle_delta = max_angle - min_angle
-  pw = ((angle - min_angle) * servo_delta / angle_delta) + min_pw
-  #logger.debug('PW {} pin {}'.format(pw, pin))
-  wiringpi.pwmWrite(pin, int(pw))
-  # [END __set_angle]
+def __pose_angles(pose):
+  # [START __pose_angles]
+  # tilt and pan angles for a pose, applied on the actuator thread
+  return (pose.pitch, pose.yaw)
+  # [END __pose_angles]
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import logging
+import random
+import threading
+import time
+
+# seconds before the first reconnect attempt and the cap of the doubling backoff
+MINIMUM_BACKOFF_TIME = 1
+MAXIMUM_BACKOFF_TIME = 32
+# fraction of each backoff delay drawn at random, so devices do not reconnect in step
+BACKOFF_JITTER = 0.5
+# seconds a connection may take from connect to CONNACK and attach PUBACKs
+CONNECT_TIMEOUT = 30
+# longest the supervisor sleeps without a paho callback, deadline or attempt due
+TICK = 1.0
+# outage durations, from 10ms to 10 minutes
+RECOVERY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+                    300.0, 600.0)
+
+
+class Backoff(object):
+  """Doubling delays from minimum to maximum with random jitter, never giving up."""
+
+  def __init__(self, minimum=MINIMUM_BACKOFF_TIME, maximum=MAXIMUM_BACKOFF_TIME,
+               jitter=BACKOFF_JITTER, random=random.random):
+    self.minimum = minimum
+    self.maximum = maximum
+    self.jitter = jitter
+    self.random = random
+    self.delay = minimum
+
+  def next(self):
+    """Returns the seconds to wait before the next attempt."""
+    delay = self.delay
+    self.delay = min(delay * 2, self.maximum)
+    return delay * (1.0 - self.jitter * self.random())
+
+  def reset(self):
+    self.delay = self.minimum
+
+
+class Connection(object):
+  """One paho client and how far it got, passed to the paho callbacks as userdata."""
+
+  CONNECTING = 'connecting'
+  ATTACHING = 'attaching'
+  SUBSCRIBED = 'subscribed'
+
+  def __init__(self, session, deadline, rotation=False):
+    self.session = session
+    self.deadline = deadline
+    # replaces a connection that is still up
+    self.rotation = rotation
+    self.phase = self.CONNECTING
+    self.client = None
+    # CONNACK return code, None until the broker answered
+    self.rc = None
+    self.disconnected = False
+    self.attachments = []
+    self.connected_at = None
+    self.received_at = 0
+
+  def on_connect(self, rc):
+    self.rc = rc
+    self.session.wake()
+
+  def on_disconnect(self):
+    self.disconnected = True
+    self.session.wake()
+
+  def failed(self):
+    return self.disconnected or (self.rc is not None and self.rc != 0)
+
+
+class MqttSession(threading.Thread):
+  """Keeps an MQTT client connected and subscribed, reconnecting forever.
+
+  A supervisor thread runs a small state machine: a connection is started
+  with connect_async, so nothing waits on the network, and goes through
+  CONNACK, the gateway attach PUBACKs and one batched SUBSCRIBE. A dropped
+  or failed connection is stopped and a new client, with a fresh JWT, is
+  started after a jittered, capped backoff. rotate() connects a new client
+  while the old one keeps receiving and swaps them once it is subscribed.
+
+  Paho's network thread keeps dispatching messages throughout and the
+  actuators hold the last pose, so an outage only stops new poses.
+
+  Args:
+    create_client: Function(userdata) returning an unconnected paho client
+      with the module callbacks, which pass paho events on to userdata.
+    host, port: The MQTT bridge.
+    topics: (topic, qos) pairs subscribed in one batch on every connect.
+    attach_ids: Devices attached to a gateway before subscribing, if any.
+    attach: Function(client, device_id) publishing the attach message of a
+      device with QoS 1 and returning paho's MQTTMessageInfo.
+    received: Function returning the messages received so far, to estimate
+      the messages missed while offline.
+    registry: The metrics Registry for the reconnect metrics, or None.
+  """
+
+  def __init__(self, create_client, host, port, topics, attach_ids=(), attach=None, received=None,
+               registry=None, backoff=None, connect_timeout=CONNECT_TIMEOUT,
+               clock=time.monotonic, name='mqtt-session'):
+    super().__init__(name=name, daemon=True)
+    self.create_client = create_client
+    self.host = host
+    self.port = port
+    self.topics = list(topics)
+    self.attach_ids = list(attach_ids)
+    self.attach = attach
+    self.received = received
+    self.backoff = backoff or Backoff()
+    self.connect_timeout = connect_timeout
+    self.clock = clock
+    self.active = None
+    self.pending = None
+    self.next_attempt = clock()
+    self.rotate_requested = False
+    # monotonic time the last connection was lost, None while online or before the first
+    self.offline_since = None
+    # message rate while the lost connection was up
+    self.rate = 0.0
+    self.reconnects = 0
+    self.missed = 0
+    self.subscribed = threading.Event()
+    self._wakeup = threading.Event()
+    self._stopped = threading.Event()
+    if registry is not None:
+      self.recovery = registry.histogram('servo_mqtt_recovery_seconds',
+                                         'Time from losing the MQTT connection to being subscribed again',
+                                         bounds=RECOVERY_BUCKETS)
+      registry.counter_func('servo_mqtt_reconnects_total', 'MQTT reconnections after a lost connection',
+                            lambda: self.reconnects)
+      registry.counter_func('servo_mqtt_missed_messages_total',
+                            'Messages estimated missed while MQTT was offline, from the rate before',
+                            lambda: self.missed)
+      registry.gauge_func('servo_mqtt_connected', '1 while subscribed to the MQTT bridge',
+                          lambda: 1 if self.subscribed.is_set() else 0)
+    else:
+      self.recovery = None
+
+  @property
+  def client(self):
+    """The subscribed paho client, None while offline."""
+    active = self.active
+    return active.client if active is not None else None
+
+  def wake(self):
+    self._wakeup.set()
+
+  def rotate(self):
+    """Replaces the client, make-before-break, e.g. before its JWT expires."""
+    self.rotate_requested = True
+    self.wake()
+
+  def run(self):
+    logger = logging.getLogger(__name__)
+    while not self._stopped.is_set():
+      try:
+        self.step()
+      except Exception as e:
+        logger.error('MQTT session step failed: {}'.format(e))
+        self._retry_later(self.clock())
+      self._wakeup.wait(self._timeout())
+      self._wakeup.clear()
+
+  def _timeout(self):
+    """Seconds until the next deadline or attempt, at most TICK."""
+    timeout = TICK
+    if self.pending is not None:
+      timeout = min(timeout, self.pending.deadline - self.clock())
+    elif self.active is None or self.rotate_requested:
+      timeout = min(timeout, self.next_attempt - self.clock())
+    return max(timeout, 0.0)
+
+  def step(self):
+    """Advances the state machine, called on the supervisor thread."""
+    logger = logging.getLogger(__name__)
+    now = self.clock()
+    pending = self.pending
+    if pending is not None:
+      if pending.failed() or now > pending.deadline:
+        logger.info('MQTT connection attempt failed, rc {}'.format(pending.rc))
+        self.pending = None
+        self._drop(pending)
+        if pending.rotation and self.active is not None:
+          self.rotate_requested = True
+        elif pending.rotation and self.offline_since is None:
+          # the old client was dropped for this one, which did not make it
+          self.offline_since = now
+          self.subscribed.clear()
+        self._retry_later(now)
+      else:
+        if pending.phase == Connection.CONNECTING and pending.rc == 0:
+          pending.phase = Connection.ATTACHING
+          pending.attachments = [self.attach(pending.client, device_id)
+                                 for device_id in self.attach_ids]
+        if pending.phase == Connection.ATTACHING and all(
+           attachment.is_published() for attachment in pending.attachments):
+          # one SUBSCRIBE packet for all config, commands and errors topics
+          pending.client.subscribe(self.topics)
+          pending.phase = Connection.SUBSCRIBED
+          self._promote(pending, now)
+
+    active = self.active
+    if active is not None and active.disconnected:
+      self.active = None
+      self._drop(active)
+      if self.received is not None and now > active.connected_at:
+        self.rate = (self.received() - active.received_at) / (now - active.connected_at)
+      pending = self.pending
+      # the broker drops the old client once a rotated one with its id connects,
+      # often before that one's CONNACK, the outage starts only if it fails
+      if pending is None or not pending.rotation or pending.failed():
+        logger.warning('MQTT connection lost')
+        self.offline_since = now
+        self.subscribed.clear()
+        if pending is None:
+          self._retry_later(now)
+
+    if self.pending is None and now >= self.next_attempt and (
+       self.active is None or self.rotate_requested):
+      self.rotate_requested = False
+      self._connect(now)
+
+  def _connect(self, now):
+    logger = logging.getLogger(__name__)
+    connection = Connection(self, now + self.connect_timeout, self.active is not None)
+    self.pending = connection
+    # a new client mints a new JWT, the old one may have expired while offline
+    connection.client = self.create_client(connection)
+    logger.info('Connecting to {}:{}'.format(self.host, self.port))
+    connection.client.connect_async(self.host, self.port)
+    connection.client.loop_start()
+
+  def _promote(self, connection, now):
+    logger = logging.getLogger(__name__)
+    old = self.active
+    self.active = connection
+    self.pending = None
+    connection.connected_at = now
+    connection.received_at = self.received() if self.received is not None else 0
+    if old is not None:
+      self._drop(old)
+      logger.info('MQTT client rotated')
+    if self.offline_since is not None:
+      outage = now - self.offline_since
+      missed = int(self.rate * outage)
+      self.reconnects += 1
+      self.missed += missed
+      if self.recovery is not None:
+        self.recovery.observe(outage)
+      logger.info('MQTT recovered after {:.2f}s, about {} messages missed'.format(outage, missed))
+      self.offline_since = None
+    self.backoff.reset()
+    self.subscribed.set()
+
+  def _retry_later(self, now):
+    delay = self.backoff.next()
+    self.next_attempt = now + delay
+    logging.getLogger(__name__).info('Reconnecting in {:.1f}s'.format(delay))
+
+  def _drop(self, connection):
+    client = connection.client
+    if client is None:
+      return
+    # stops paho's own reconnect, a new client takes over
+    try:
+      client.disconnect()
+    finally:
+      client.loop_stop()
+
+  def stop(self):
+    self._stopped.set()
+    self.wake()
+    self.join()
+    for connection in (self.pending, self.active):
+      if connection is not None:
+        self._drop(connection)
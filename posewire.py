@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import json
+import struct
+
+from actuator import Pose
+
+GOGGLE_DIRECTION = 'goggle_direction'
+
+# Compact binary format, little-endian, 21 bytes:
+#   uint8   type tag, 0x01 for goggle_direction
+#   int64   head.last_seen (epoch_milliseconds)
+#   float32 roll, pitch (tilt), yaw (pan)
+# The tag can never start a JSON document, so receivers detect the format
+# from the first byte.
+GOGGLE_DIRECTION_TAG = 0x01
+POSE_STRUCT = struct.Struct('<qfff')
+POSE_SIZE = 1 + POSE_STRUCT.size
+
+# JSON message format:
+#{
+#  "links": [],
+#  "head": {
+#      "links": [],
+#      "type": "goggle_direction",
+#      "last_seen": 1557746562 (epoch_milliseconds)
+#  },
+#  "body": {
+#      "roll": 0.0,
+#      "pitch": 0.0, (tilt)
+#      "yaw": 0.7853981633974483 (pan)
+#  }
+#}
+
+
+class UnknownMessageType(ValueError):
+  """Raised for well-formed messages that are not goggle_direction poses."""
+
+
+def decode_json(raw):
+  """Decodes a goggle_direction JSON envelope.
+
+  Args:
+    raw: The message payload, str or bytes.
+  Returns:
+    The Pose carried by the message.
+  Raises:
+    UnknownMessageType: If head.type is not goggle_direction.
+    ValueError, KeyError, TypeError: If the payload is not a valid envelope.
+  """
+  data = json.loads(raw)
+  head = data['head']
+  if head.get('type') != GOGGLE_DIRECTION:
+    raise UnknownMessageType(head.get('type'))
+  body = data['body']
+  return Pose(head['last_seen'], body['roll'], body['pitch'], body['yaw'])
+
+
+def decode_binary(raw):
+  """Decodes a binary goggle_direction pose.
+
+  Unpacks straight from the payload buffer, bytes or memoryview, without
+  copying it.
+
+  Raises:
+    UnknownMessageType: If the type tag is not goggle_direction.
+    ValueError: If the payload does not have the binary pose size.
+  """
+  if raw[0] != GOGGLE_DIRECTION_TAG:
+    raise UnknownMessageType(raw[0])
+  if len(raw) != POSE_SIZE:
+    raise ValueError('Binary pose of {} bytes, expected {}'.format(len(raw), POSE_SIZE))
+  return Pose._make(POSE_STRUCT.unpack_from(raw, 1))
+
+
+def decode(raw):
+  """Decodes a pose in either wire format, detected from the first byte.
+
+  Raises:
+    The exceptions of decode_binary() or decode_json().
+  """
+  if raw[0] == GOGGLE_DIRECTION_TAG:
+    return decode_binary(raw)
+  return decode_json(raw)
+
+
+def encode_binary(pose):
+  """Encodes a Pose in the binary format."""
+  return bytes((GOGGLE_DIRECTION_TAG,)) + POSE_STRUCT.pack(
+         pose.last_seen, pose.roll, pose.pitch, pose.yaw)
+
+
+def encode_json(pose):
+  """Encodes a Pose as a goggle_direction JSON envelope, e.g. for testing."""
+  return json.dumps({
+    'links': [],
+    'head': {'links': [], 'type': GOGGLE_DIRECTION, 'last_seen': pose.last_seen},
+    'body': {'roll': pose.roll, 'pitch': pose.pitch, 'yaw': pose.yaw},
+  }).encode('utf-8')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import array
+import math
+import time
+
+from actuator import Pose
+
+# defaults for the predict_* keys of the [io] config
+DEFAULTS = {
+  'predict': 'no',
+  'predict_alpha': 0.5,
+  'predict_beta': 0.1,
+  # seconds from a write until the servo has moved there
+  'predict_delay': 0.15,
+  # never extrapolate further than this, e.g. when messages stop
+  'predict_max_lead': 0.3,
+}
+# residuals kept for the prediction error metric
+ERROR_WINDOW = 64
+
+
+class AlphaBetaFilter(object):
+  """Alpha-beta filter estimating one angle and its angular velocity."""
+
+  __slots__ = ('alpha', 'beta', 'x', 'v', 'residuals', 'count')
+
+  def __init__(self, alpha, beta):
+    self.alpha = alpha
+    self.beta = beta
+    self.x = None
+    self.v = 0.0
+    # ring of the last ERROR_WINDOW residuals
+    self.residuals = array.array('d', [0.0]) * ERROR_WINDOW
+    self.count = 0
+
+  def update(self, x, dt):
+    """Adds a measurement taken dt seconds after the previous one."""
+    if self.x is None:
+      self.x = x
+      return
+    x_pred = self.x + self.v * dt
+    # shortest way round, yaw can wrap at +-pi
+    r = (x - x_pred + math.pi) % (2 * math.pi) - math.pi
+    self.residuals[self.count % ERROR_WINDOW] = r
+    self.count += 1
+    self.x = x_pred + self.alpha * r
+    if dt > 0:
+      self.v += self.beta / dt * r
+
+  def predict(self, lead):
+    return self.x + self.v * lead
+
+  def rms_error(self):
+    n = min(self.count, ERROR_WINDOW)
+    if n == 0:
+      return 0.0
+    return math.sqrt(sum(r * r for r in self.residuals[:n]) / n)
+
+
+class PosePredictor(object):
+  """Extrapolates poses to where the head will be when the servos get there.
+
+  Angular velocities come from alpha-beta filters timed on head.last_seen.
+  predict() extrapolates the newest pose by the local time since it was
+  taken in plus the actuator delay, so the goggle and Pi clocks do not need
+  to agree. Lead is capped by max_lead.
+  """
+
+  def __init__(self, alpha, beta, delay, max_lead, clock=time.monotonic):
+    self.delay = delay
+    self.max_lead = max_lead
+    self.clock = clock
+    self.filters = (AlphaBetaFilter(alpha, beta), AlphaBetaFilter(alpha, beta),
+                    AlphaBetaFilter(alpha, beta))
+    self.last_seen = None
+    self.received = None
+    self.lead = 0.0
+    self.lead_sum = 0.0
+    self.predictions = 0
+
+  @classmethod
+  def from_config(cls, section):
+    """Returns a predictor configured by the [io] section, or None if disabled."""
+    def get(key):
+      return section.get(key, DEFAULTS[key])
+
+    if str(get('predict')).lower() not in ('yes', 'true', 'on', '1'):
+      return None
+    return cls(float(get('predict_alpha')), float(get('predict_beta')),
+               float(get('predict_delay')), float(get('predict_max_lead')))
+
+  def update(self, pose):
+    """Feeds a newly taken pose into the filters."""
+    dt = 0.0 if self.last_seen is None else (pose.last_seen - self.last_seen) / 1000.0
+    roll, pitch, yaw = self.filters
+    roll.update(pose.roll, dt)
+    pitch.update(pose.pitch, dt)
+    yaw.update(pose.yaw, dt)
+    self.last_seen = pose.last_seen
+    self.received = self.clock()
+
+  def predict(self):
+    """Returns the pose extrapolated to now plus the actuator delay."""
+    lead = self.clock() - self.received + self.delay
+    if lead > self.max_lead:
+      lead = self.max_lead
+    self.lead = lead
+    self.lead_sum += lead
+    self.predictions += 1
+    roll, pitch, yaw = self.filters
+    return Pose(self.last_seen + int(lead * 1000),
+                roll.predict(lead), pitch.predict(lead), yaw.predict(lead))
+
+  def stats(self):
+    roll, pitch, yaw = self.filters
+    return {'lead_ms': 1000.0 * self.lead,
+            'lead_mean_ms': 1000.0 * self.lead_sum / (self.predictions or 1),
+            'pitch_rms_error': pitch.rms_error(),
+            'yaw_rms_error': yaw.rms_error(),
+            'roll_rms_error': roll.rms_error()}
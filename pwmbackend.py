@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import array
+import os
+import time
+
+# 19.2MHz / 192 / 2000 = 50Hz, i.e. 20ms frames with 10us steps
+PWM_CLOCK = 192
+PWM_RANGE = 2000
+
+
+class PwmBackend(object):
+  """Interface between the servo code and the PWM outputs.
+
+  Pulse widths are written in PWM range steps, 150 is 1.5ms on a 20ms frame.
+  """
+
+  def setup(self, pins):
+    """Configures pins as 50Hz PWM outputs."""
+    raise NotImplementedError
+
+  def write(self, pin, value):
+    """Sets the pulse width on pin."""
+    raise NotImplementedError
+
+  def close(self):
+    """Releases the outputs."""
+    pass
+
+
+class WiringPiBackend(PwmBackend):
+  """Hardware PWM through wiringpi, using GPIO pin numbering."""
+
+  def __init__(self):
+    # imported here so the other backends work without wiringpi and /proc/cpuinfo
+    import wiringpi
+    self.wiringpi = wiringpi
+    # bind straight to the C function, no extra call on the hot path
+    self.write = wiringpi.pwmWrite
+
+  def setup(self, pins):
+    wiringpi = self.wiringpi
+    # use 'GPIO naming'
+    wiringpi.wiringPiSetupGpio()
+    for pin in pins:
+      wiringpi.pinMode(pin, wiringpi.GPIO.PWM_OUTPUT)
+    # set PWM mode  to milliseconds
+    wiringpi.pwmSetMode(wiringpi.GPIO.PWM_MODE_MS)
+    # divide down clock for 20ms period
+    wiringpi.pwmSetClock(PWM_CLOCK)
+    wiringpi.pwmSetRange(PWM_RANGE)
+
+
+class Pca9685Backend(PwmBackend):
+  """16 channel PCA9685 I2C PWM board, pins are channel numbers 0 to 15.
+
+  Pulse widths keep the PWM range steps of the other backends and are scaled
+  to the board's 4096 counts per 20ms frame.
+  """
+
+  MODE1 = 0x00
+  PRESCALE = 0xfe
+  LED0_ON_L = 0x06
+  # 25MHz internal oscillator / 4096 / 50Hz - 1
+  PRESCALE_50HZ = 121
+  COUNTS = 4096
+
+  def __init__(self, bus=1, address=0x40):
+    # imported here so the other backends work without smbus
+    import smbus
+    self.bus = smbus.SMBus(int(bus))
+    self.address = int(address, 0) if isinstance(address, str) else address
+    self.scale = self.COUNTS / float(PWM_RANGE)
+
+  def setup(self, pins):
+    bus = self.bus
+    # the prescaler can only be set while the oscillator sleeps
+    bus.write_byte_data(self.address, self.MODE1, 0x10)
+    bus.write_byte_data(self.address, self.PRESCALE, self.PRESCALE_50HZ)
+    # wake up with register auto increment
+    bus.write_byte_data(self.address, self.MODE1, 0x20)
+    time.sleep(0.0005)
+    bus.write_byte_data(self.address, self.MODE1, 0xa0)
+
+  def write(self, pin, value):
+    off = int(value * self.scale)
+    # on at count 0, off at count off
+    self.bus.write_i2c_block_data(self.address, self.LED0_ON_L + 4 * pin,
+                                  [0, 0, off & 0xff, off >> 8])
+
+  def close(self):
+    self.bus.close()
+
+
+class SysfsPwmBackend(PwmBackend):
+  """Hardware PWM through the kernel's /sys/class/pwm interface, no wiringpi.
+
+  Pins are GPIO numbers of the Pi's PWM pins, or channel numbers of the
+  chip. Channels are exported and set to a 20ms period once, the duty_cycle
+  files stay open and every write is one os.pwrite of a nanosecond value
+  encoded in advance for each of the PWM_RANGE steps. Values end in a
+  newline, so the first line of a regular file standing in for duty_cycle
+  is the last value written.
+
+  Needs dtoverlay=pwm-2chan in config.txt. root can be a temporary
+  directory with the same layout for testing.
+  """
+
+  # GPIO pin to channel of pwmchip0 with dtoverlay=pwm-2chan
+  GPIO_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+  PERIOD_NS = 20000000
+  STEP_NS = PERIOD_NS // PWM_RANGE
+  # seconds to wait for udev to create an exported channel
+  EXPORT_TIMEOUT = 1.0
+
+  def __init__(self, chip=0, root='/sys/class/pwm'):
+    self.path = os.path.join(root, 'pwmchip{}'.format(chip))
+    self.encoded = [('{}\n'.format(value * self.STEP_NS)).encode('ascii')
+                    for value in range(PWM_RANGE + 1)]
+    self.fds = {}
+
+  def _channel_path(self, pin):
+    return os.path.join(self.path, 'pwm{}'.format(self.GPIO_CHANNELS.get(pin, pin)))
+
+  def _write_file(self, path, value):
+    with open(path, 'w') as f:
+      f.write(str(value))
+
+  def setup(self, pins):
+    for pin in pins:
+      channel_path = self._channel_path(pin)
+      if not os.path.isdir(channel_path):
+        self._write_file(os.path.join(self.path, 'export'), self.GPIO_CHANNELS.get(pin, pin))
+        deadline = time.monotonic() + self.EXPORT_TIMEOUT
+        while not os.access(os.path.join(channel_path, 'duty_cycle'), os.W_OK):
+          if time.monotonic() > deadline:
+            raise OSError('PWM channel {} was not exported'.format(channel_path))
+          time.sleep(0.01)
+      # the duty cycle may not exceed the period, lower it before a new period
+      self._write_file(os.path.join(channel_path, 'duty_cycle'), 0)
+      self._write_file(os.path.join(channel_path, 'period'), self.PERIOD_NS)
+      self._write_file(os.path.join(channel_path, 'enable'), 1)
+      if pin not in self.fds:
+        self.fds[pin] = os.open(os.path.join(channel_path, 'duty_cycle'), os.O_WRONLY)
+
+  def write(self, pin, value):
+    os.pwrite(self.fds[pin], self.encoded[value], 0)
+
+  def close(self):
+    # the outputs keep their last pulse width, as with wiringpi
+    for fd in self.fds.values():
+      os.close(fd)
+    self.fds.clear()
+
+
+class RecordingBackend(PwmBackend):
+  """In-memory backend that timestamps every write, no hardware needed.
+
+  Writes go into preallocated arrays used as a ring of capacity entries, so
+  recording does not allocate. count keeps growing past capacity, only the
+  newest capacity writes are kept.
+  """
+
+  def __init__(self, capacity=65536, clock=time.perf_counter):
+    self.capacity = capacity
+    self.clock = clock
+    self.times = array.array('d', [0.0]) * capacity
+    self.pins = array.array('i', [0]) * capacity
+    self.values = array.array('i', [0]) * capacity
+    self.count = 0
+    self.pins_setup = []
+
+  def setup(self, pins):
+    self.pins_setup = list(pins)
+
+  def write(self, pin, value):
+    i = self.count % self.capacity
+    self.times[i] = self.clock()
+    self.pins[i] = pin
+    self.values[i] = value
+    self.count += 1
+
+  def records(self):
+    """Returns the kept writes as (time, pin, value) tuples, oldest first."""
+    start = max(0, self.count - self.capacity)
+    return [(self.times[i % self.capacity], self.pins[i % self.capacity],
+             self.values[i % self.capacity]) for i in range(start, self.count)]
+
+  def clear(self):
+    self.count = 0
+
+
+BACKENDS = {
+  'wiringpi': WiringPiBackend,
+  'pca9685': Pca9685Backend,
+  'sysfs': SysfsPwmBackend,
+  'recording': RecordingBackend,
+}
+
+
+def create_backend(name, **kwargs):
+  """Creates the PWM backend configured by [io] backend.
+
+  kwargs are passed on to the backend, e.g. bus and address for pca9685,
+  chip for sysfs.
+  """
+  try:
+    backend_class = BACKENDS[name]
+  except KeyError:
+    raise ValueError('Unknown PWM backend {}, expected one of {}'.format(
+                     name, ', '.join(sorted(BACKENDS))))
+  return backend_class(**kwargs)
+
+
+def backend_config(section):
+  """Returns the backend name and options of an [io] style section.
+
+  Options are the <backend>_<option> keys, e.g. pca9685_address = 0x41.
+  """
+  name = section.get('backend', 'wiringpi')
+  prefix = name + '_'
+  options = dict((key[len(prefix):], value) for key, value in section.items()
+                 if key.startswith(prefix))
+  return name, options
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import time
+
+from actuator import DEFAULT_CONTROL_RATE, PoseMailbox, create_actuator
+from actuatorprocess import ActuatorProcess
+from calibration import recalibrate
+from latencytracer import LatencyTracer
+from metrics import PipelineMetrics
+from predictor import PosePredictor
+from sequencer import Sequencer
+from pwmbackend import RecordingBackend, backend_config, create_backend
+from servoaxis import ServoAxis
+from shmslot import SharedPoseSlot
+
+# per-device sections are named [io.<device id>]
+SECTION_PREFIX = 'io.'
+
+
+class Rig(object):
+  """One pan/tilt head driven for a device id.
+
+  Owns the head's axes, its head.last_seen Sequencer, pose mailbox and
+  actuator worker, so heads never share ordering or wait on each other.
+  Transports count messages and time stages in the rig's PipelineMetrics,
+  labelled with the device id, and record() how long each message took to
+  hand over, giving per-device throughput and latency, and the actuator
+  traces each pose's head.last_seen for a LatencyMonitor. With a recorder,
+  record_pose() appends each decoded pose to the rig's flight recorder.
+
+  With processes = 2 the actuator runs in an ActuatorProcess driving the
+  backend of section, poses go to it through a SharedPoseSlot, and backend
+  and axes here are stand-ins that write nothing.
+  """
+
+  def __init__(self, device_id, backend, tilt_axis, pan_axis, pose_angles,
+               control_rate=DEFAULT_CONTROL_RATE, predictor=None, registry=None,
+               section=None, processes=1, actuator_cpu=None, clock=time.perf_counter):
+    self.device_id = device_id
+    # the [io] style section the rig is calibrated from
+    self.section = dict(section or {})
+    self.backend = backend
+    self.tilt_axis = tilt_axis
+    self.pan_axis = pan_axis
+    self.pose_angles = pose_angles
+    # FlightRecorder of the received poses, None to not record
+    self.recorder = None
+    self.processes = processes
+    self.mailbox = SharedPoseSlot() if processes > 1 else PoseMailbox()
+    self.metrics = PipelineMetrics(registry, [tilt_axis, pan_axis], {'device': device_id})
+    self.sequencer = Sequencer()
+    self.metrics.sequencer(self.sequencer)
+    self.metrics.mailbox(self.mailbox)
+    self.tracer = LatencyTracer()
+    if processes > 1:
+      self.metrics.shared_slot(self.mailbox)
+      self.mailbox.bind_tracer(self.tracer)
+      self.actuator = ActuatorProcess(self.mailbox, [tilt_axis, pan_axis], self.section,
+                                      pose_angles, actuator_cpu,
+                                      name='actuator-{}'.format(device_id))
+    else:
+      self.actuator = create_actuator(self.mailbox, [tilt_axis, pan_axis], pose_angles,
+                                      control_rate, predictor, self.metrics.actuate,
+                                      self.tracer)
+      self.actuator.name = 'control-{}'.format(device_id)
+    self.clock = clock
+    self.handle_time_sum = 0.0
+    self.handle_time_max = 0.0
+    self.started = None
+
+  @classmethod
+  def from_config(cls, device_id, section, pose_angles, backends=None, registry=None):
+    """Creates the rig from an [io] style config section.
+
+    Args:
+      device_id: The device the rig's messages are addressed to.
+      section: A configparser section, or any mapping of string values.
+      pose_angles: Function returning the (tilt, pan) angles of a Pose.
+      backends: Dict of backends already created for other rigs, keyed by
+        backend name and options. Rigs on the same PWM board share one.
+      registry: The metrics Registry to expose the rig's metrics in.
+    """
+    processes = int(section.get('processes', 1))
+    actuator_cpu = section.get('actuator_cpu', '')
+    if processes > 1:
+      # the actuator process opens the real backend
+      backend = RecordingBackend(capacity=1)
+    else:
+      name, options = backend_config(section)
+      key = (name, tuple(sorted(options.items())))
+      if backends is None:
+        backends = {}
+      if key not in backends:
+        backends[key] = create_backend(name, **options)
+      backend = backends[key]
+    return cls(device_id, backend,
+               ServoAxis.from_config('tilt', section, backend.write),
+               ServoAxis.from_config('pan', section, backend.write),
+               pose_angles,
+               control_rate=float(section.get('control_rate', DEFAULT_CONTROL_RATE)),
+               predictor=PosePredictor.from_config(section),
+               registry=registry,
+               section=section,
+               processes=processes,
+               actuator_cpu=int(actuator_cpu) if actuator_cpu else None)
+
+  def __repr__(self):
+    backend = type(self.backend).__name__
+    if self.processes > 1:
+      backend = '{} in {}'.format(self.section.get('backend', 'wiringpi'), self.actuator.process.name)
+    return 'Rig({} on {} pins {} and {})'.format(
+           self.device_id, backend, self.tilt_axis.pin, self.pan_axis.pin)
+
+  def start(self, started=None):
+    """Starts the actuator, started is the monotonic start-up time of the process."""
+    self.started = time.monotonic()
+    self.metrics.startup(self.actuator, self.started if started is None else started)
+    self.actuator.start()
+
+  def stop(self):
+    self.actuator.stop()
+    recorder, self.recorder = self.recorder, None
+    if recorder is not None:
+      recorder.close()
+
+  def recalibrate(self, section):
+    """Recalibrates the running rig from a new [io] style section.
+
+    Raises:
+      ValueError, ZeroDivisionError: If section holds an invalid calibration,
+        the rig keeps running on the old one then.
+    """
+    section = dict(section)
+    self.tilt_axis, self.pan_axis = recalibrate(self.actuator, self.backend, section)
+    if self.processes > 1:
+      self.actuator.recalibrate(section)
+    self.section = section
+
+  def pulse_widths(self):
+    """Returns the (tilt, pan) pulse widths last written, 0 before the first."""
+    if self.processes > 1:
+      return self.mailbox.pulse_widths()
+    # unsynchronized reads of ints the actuator thread assigns, never a lock
+    return self.tilt_axis.last_pw or 0, self.pan_axis.last_pw or 0
+
+  def record(self, start):
+    """Records a message handed over, start is its clock() at receipt."""
+    elapsed = self.clock() - start
+    self.handle_time_sum += elapsed
+    if elapsed > self.handle_time_max:
+      self.handle_time_max = elapsed
+
+  def record_pose(self, received, pose, flags=0):
+    """Appends a decoded pose and the pulse widths it maps to to the recorder."""
+    recorder = self.recorder
+    if recorder is not None:
+      tilt, pan = self.pose_angles(pose)
+      recorder.record(received, pose, self.tilt_axis.pulse_width(tilt),
+                      self.pan_axis.pulse_width(pan), flags)
+
+  def stats(self):
+    elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+    metrics = self.metrics
+    received = metrics.received.value
+    stats = {'received': received,
+             'messages_per_s': received / elapsed if elapsed > 0 else 0.0,
+             'malformed': metrics.malformed.value,
+             'handle_us_mean': 1e6 * self.handle_time_sum / (received or 1),
+             'handle_us_max': 1e6 * self.handle_time_max}
+    stats.update(self.sequencer.stats())
+    stats.update(self.mailbox.stats())
+    stats.update(self.actuator.stats())
+    if self.processes == 1:
+      stats['tilt_writes'] = self.tilt_axis.writes
+      stats['pan_writes'] = self.pan_axis.writes
+    return stats
+
+
+def rig_sections(config_parser, default_device_id):
+  """Returns (device id, section) pairs for the rigs in a config.
+
+  Each [io.<device id>] section is one rig, with keys it does not set taken
+  from [io]. Without any, [io] is the single rig of default_device_id.
+  """
+  io = dict(config_parser['io']) if config_parser.has_section('io') else {}
+  sections = []
+  for name in config_parser.sections():
+    if name.startswith(SECTION_PREFIX):
+      section = dict(io)
+      section.update(config_parser[name])
+      sections.append((name[len(SECTION_PREFIX):], section))
+  if not sections:
+    sections.append((default_device_id, io))
+  return sections
+
+
+def setup_backends(rigs):
+  """Sets up each backend once for the pins of all its rigs.
+
+  Returns:
+    The distinct backends, to be closed on shutdown.
+  Raises:
+    ValueError: If two axes use the same pin of a backend.
+  """
+  backends = []
+  pins = {}
+  for rig in rigs:
+    backend = rig.backend
+    if id(backend) not in pins:
+      backends.append(backend)
+      pins[id(backend)] = []
+    for axis in (rig.tilt_axis, rig.pan_axis):
+      if axis.pin in pins[id(backend)]:
+        raise ValueError('{} {} pin {} is already in use'.format(rig.device_id, axis.name, axis.pin))
+      pins[id(backend)].append(axis.pin)
+  for backend in backends:
+    backend.setup(pins[id(backend)])
+  return backends
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import os
+import socket
+import time
+
+# monotonic time this module was imported, early in every entry point
+STARTED = time.monotonic()
+
+
+def notify(state):
+  """Sends a state such as 'READY=1' to systemd, see sd_notify(3).
+
+  Returns:
+    False if not run by systemd with Type=notify, or the send failed.
+  """
+  address = os.environ.get('NOTIFY_SOCKET')
+  if not address:
+    return False
+  if address.startswith('@'):
+    # abstract namespace socket
+    address = '\0' + address[1:]
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+      sock.sendto(state.encode('utf-8'), address)
+  except OSError:
+    return False
+  return True
+
+
+def ready(status):
+  """Tells systemd start-up is done. Returns the seconds since STARTED."""
+  elapsed = time.monotonic() - STARTED
+  notify('READY=1\nSTATUS={} after {:.2f}s'.format(status, elapsed))
+  return elapsed
+
+
+def status(text):
+  """Updates the status shown by systemctl status."""
+  return notify('STATUS={}'.format(text))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import collections
+import threading
+
+# message ids remembered for dropping redeliveries, a few seconds of poses
+DEDUP_CAPACITY = 1024
+
+
+class Sequencer(object):
+  """Thread-safe head.last_seen ordering and redelivery dedup for one head.
+
+  Transport callbacks may run on several threads. advance() compares and
+  advances last_seen under a lock, so of two racing poses only the newer
+  one can win. is_duplicate() remembers the last capacity message ids in an
+  LRU, at-least-once redeliveries are dropped before they are decoded.
+  """
+
+  def __init__(self, capacity=DEDUP_CAPACITY):
+    self._lock = threading.Lock()
+    self._ids = collections.OrderedDict()
+    self.capacity = capacity
+    self.last_seen = None
+    self.checked = 0
+    self.duplicates = 0
+    self.accepted = 0
+    self.reordered = 0
+
+  def is_duplicate(self, message_id):
+    """Returns True if message_id was seen recently, else remembers it."""
+    with self._lock:
+      self.checked += 1
+      ids = self._ids
+      if message_id in ids:
+        ids.move_to_end(message_id)
+        self.duplicates += 1
+        return True
+      ids[message_id] = None
+      if len(ids) > self.capacity:
+        ids.popitem(last=False)
+      return False
+
+  def advance(self, last_seen):
+    """Advances to last_seen. Returns False if a newer pose was seen already."""
+    with self._lock:
+      if self.last_seen is not None and last_seen < self.last_seen:
+        self.reordered += 1
+        return False
+      self.last_seen = last_seen
+      self.accepted += 1
+      return True
+
+  def stats(self):
+    with self._lock:
+      sequenced = self.accepted + self.reordered
+      return {'duplicates': self.duplicates,
+              'duplicate_rate': self.duplicates / float(self.checked or 1),
+              'reordered': self.reordered,
+              'reorder_rate': self.reordered / float(sequenced or 1)}
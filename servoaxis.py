@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import array
+import bisect
+
+# defaults for keys missing from the [io] config, HS-225MG on 20ms PWM frames
+DEFAULTS = {
+  'servo_max_pw': 252,
+  'servo_min_pw': 55.3,
+  'min_angle': -1.57,
+  'max_angle': 1.57,
+  'ratio': 1.0,
+  'deadband': 0,
+  'max_slew': 0,
+  # angle:pw calibration points, e.g. -1.57:55, 0:150, 1.57:252, overrides the above
+  'curve': '',
+}
+# default GPIO pin assignment
+DEFAULT_PINS = {
+  'tilt': 13,
+  'pan': 18,
+}
+# entries of the angle to pulse width lookup table, about 0.001rad apart over +-1.57
+LUT_SIZE = 4096
+
+
+def parse_curve(text):
+  """Parses 'angle:pw, angle:pw, ...' calibration points, angles in radians.
+
+  Raises:
+    ValueError: If a point is not a pair of numbers.
+  """
+  points = []
+  for point in text.split(','):
+    angle, pw = point.split(':')
+    points.append((float(angle), float(pw)))
+  return points
+
+
+def interpolate(points, x):
+  """Piecewise linear interpolation over (x, y) points sorted by x, clamped."""
+  i = bisect.bisect_right(points, (x, float('inf')))
+  if i == 0:
+    return points[0][1]
+  if i == len(points):
+    return points[-1][1]
+  (x0, y0), (x1, y1) = points[i - 1], points[i]
+  return y0 + (x - x0) * (y1 - y0) / (x1 - x0)
+
+
+class ServoAxis(object):
+  """One servo axis with its angle to pulse width map precomputed.
+
+  The map is a curve through calibration points, by default the two end
+  points of the servo, applied to the angle times ratio. It is compiled
+  once into a dense table over the unclamped angles, so the hot path is a
+  clamp, a subtract-multiply and a table lookup. Writes are skipped when the
+  quantized pulse width is within deadband PWM steps of the last one
+  written, most head-tracking jitter maps to the same step. Recalibration
+  builds new axes, compiling table and inverse curve afresh.
+  """
+
+  __slots__ = ('name', 'pin', 'ratio', 'min_angle', 'max_angle', 'min_pw', 'max_pw',
+               'curve', 'inverse', 'lut', 'lut_min', 'lut_max', 'lut_scale', 'pw_at_min',
+               'pw_at_max', 'deadband', 'max_slew', 'write', 'last_pw', 'writes', 'skipped')
+
+  def __init__(self, name, pin, max_pw, min_pw, max_angle, min_angle, ratio=1.0,
+               deadband=0, max_slew=0, write=None, curve=None):
+    """curve is a list of (angle, pw) points replacing the min/max pair.
+
+    Raises:
+      ValueError: If curve has fewer than two points, two at the same angle
+        or pulse widths that are not strictly monotonic.
+      ZeroDivisionError: If ratio is 0.
+    """
+    self.name = name
+    self.pin = pin
+    # servo angle per pose angle
+    self.ratio = ratio
+    if curve:
+      curve = sorted(curve)
+      (min_angle, min_pw), (max_angle, max_pw) = curve[0], curve[-1]
+    else:
+      curve = [(min_angle, min_pw), (max_angle, max_pw)]
+    if len(curve) < 2:
+      raise ValueError('{} curve needs two points or more'.format(name))
+    steps = [(a1 - a0, pw1 - pw0) for (a0, pw0), (a1, pw1) in zip(curve, curve[1:])]
+    if any(angle_step <= 0 for angle_step, _ in steps) or not (
+       all(pw_step > 0 for _, pw_step in steps) or all(pw_step < 0 for _, pw_step in steps)):
+      raise ValueError('{} curve is not strictly monotonic: {}'.format(name, curve))
+    self.curve = curve
+    # the curve is monotonic, so it inverts by swapping the coordinates
+    self.inverse = sorted((curve_pw, angle) for angle, curve_pw in curve)
+    self.min_angle = min_angle
+    self.max_angle = max_angle
+    self.min_pw = min_pw
+    self.max_pw = max_pw
+    # the pose angles reaching the ends of the curve, a negative ratio swaps them
+    self.lut_min, self.lut_max = sorted((min_angle / ratio, max_angle / ratio))
+    # clamped angles map exactly onto the end points
+    self.pw_at_min = int(interpolate(curve, self.lut_min * ratio))
+    self.pw_at_max = int(interpolate(curve, self.lut_max * ratio))
+    step = (self.lut_max - self.lut_min) / LUT_SIZE
+    self.lut_scale = 1.0 / step
+    # each entry is the pulse width in the middle of its step of angles
+    self.lut = array.array('h', [int(interpolate(curve, (self.lut_min + (i + 0.5) * step) * ratio))
+                                 for i in range(LUT_SIZE)])
+    self.deadband = deadband
+    # fastest allowed motion in radians per second for the control loop, 0 is unlimited
+    self.max_slew = max_slew
+    self.write = write
+    self.last_pw = None
+    self.writes = 0
+    self.skipped = 0
+
+  @classmethod
+  def from_config(cls, name, section, write):
+    """Creates the axis from the <name>_* keys of an [io] config section.
+
+    Args:
+      name: The axis name, 'tilt' or 'pan', used as key prefix.
+      section: A configparser section, or any mapping of string values.
+      write: The pwmWrite(pin, value) style function driving the hardware.
+    """
+    def get(key):
+      return section.get('{}_{}'.format(name, key), DEFAULTS[key])
+
+    return cls(name,
+               int(section.get('{}_pin'.format(name), DEFAULT_PINS.get(name))),
+               float(get('servo_max_pw')),
+               float(get('servo_min_pw')),
+               float(get('max_angle')),
+               float(get('min_angle')),
+               ratio=float(get('ratio')),
+               deadband=int(get('deadband')),
+               max_slew=float(get('max_slew')),
+               write=write,
+               curve=parse_curve(get('curve')) if get('curve') else None)
+
+  def __repr__(self):
+    return ('ServoAxis({} pin {}, servo ratio {}, servo max pw {}, servo min pw {}, '
+            'max angle {}, min angle {}, deadband {}, max slew {}, curve {})').format(
+            self.name, self.pin, self.ratio, self.max_pw, self.min_pw,
+            self.max_angle, self.min_angle, self.deadband, self.max_slew,
+            ', '.join('{}:{}'.format(angle, pw) for angle, pw in self.curve))
+
+  def pulse_width(self, angle):
+    """Returns the quantized pulse width for an angle in radians, clamped."""
+    if angle <= self.lut_min:
+      return self.pw_at_min
+    if angle >= self.lut_max:
+      return self.pw_at_max
+    # just below lut_max the index can round up to LUT_SIZE
+    return self.lut[min(int((angle - self.lut_min) * self.lut_scale), LUT_SIZE - 1)]
+
+  def angle(self):
+    """Returns the angle of the last written pulse width, None before any write."""
+    if self.last_pw is None:
+      return None
+    return self.angle_at(self.last_pw)
+
+  def angle_at(self, pw):
+    """Returns the angle in radians the calibration maps to pulse width pw."""
+    return interpolate(self.inverse, pw) / self.ratio
+
+  def set_angle(self, angle):
+    """Moves the servo to angle. Returns False if the write was suppressed."""
+    pw = self.pulse_width(angle)
+    last_pw = self.last_pw
+    if last_pw is not None and -self.deadband <= pw - last_pw <= self.deadband:
+      self.skipped += 1
+      return False
+    self.write(self.pin, pw)
+    self.last_pw = pw
+    self.writes += 1
+    return True
+
+  def set_pulse_width(self, pw):
+    """Writes a raw pulse width, e.g. 150 to center the servo."""
+    self.write(self.pin, pw)
+    self.last_pw = pw
+    self.writes += 1
+
+  def stats(self):
+    return {'writes': self.writes, 'skipped': self.skipped}
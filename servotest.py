@@ -1,6 +1,9 @@
 # Servo Control
+import argparse
+import math
 import time
-import wiringpi
+
+from pwmbackend import create_backend
 
 #gpio pwm-ms
 #pio pwmc 192
@@ -9,35 +12,55 @@ import wiringpi
 #gpio -g pwm 18 150 #1.5ms middle
 #gpio -g pwm 18 200 #2.0ms right
 
-# use 'GPIO naming'
-wiringpi.wiringPiSetupGpio()
- 
-# set #13 & 18 to be PWM outputs
-wiringpi.pinMode(13, wiringpi.GPIO.PWM_OUTPUT)
-wiringpi.pinMode(18, wiringpi.GPIO.PWM_OUTPUT)
- 
-# set the PWM mode to milliseconds stype
-wiringpi.pwmSetMode(wiringpi.GPIO.PWM_MODE_MS)
- 
-# divide down clock for 50Hz
-wiringpi.pwmSetClock(192)
-wiringpi.pwmSetRange(2000)
- 
+parser = argparse.ArgumentParser(description='Drive the servos, or capture a calibration curve.')
+# wiringpi by default, 'recording' runs without a Pi
+parser.add_argument('backend', nargs='?', default='wiringpi')
+parser.add_argument('--sweep', choices=['tilt', 'pan'],
+                    help='step one axis through pulse widths and ask for the measured angles')
+parser.add_argument('--pin', type=int, help='pin of the swept axis, 13 for tilt, 18 for pan')
+parser.add_argument('--min-pw', type=int, default=55)
+parser.add_argument('--max-pw', type=int, default=252)
+parser.add_argument('--step', type=int, default=20, help='pulse width step of the sweep')
+args = parser.parse_args()
+
+backend = create_backend(args.backend)
+
+# set #13 & 18, and a swept --pin, to be PWM outputs, 50Hz in milliseconds style
+pins = [13, 18]
+if args.pin is not None and args.pin not in pins:
+  pins.append(args.pin)
+backend.setup(pins)
+
 delay_period = 0.05 #0.1 .. 0.001, slower .. faster
 
-#55 (0.55ms) .. 252 (2.52ms) 
+#55 (0.55ms) .. 252 (2.52ms)
 
-while True:  
-  wiringpi.pwmWrite(13, 98)
-  wiringpi.pwmWrite(15, 98)
-  time.sleep(delay_period)
+if args.sweep:
+  # the servo settles at each pulse width, read the angle off a protractor
+  pin = args.pin if args.pin is not None else {'tilt': 13, 'pan': 18}[args.sweep]
+  pws = list(range(args.min_pw, args.max_pw, args.step)) + [args.max_pw]
+  points = []
+  for pw in pws:
+    backend.write(pin, pw)
+    answer = input('pw {} ({:.2f}ms): angle in degrees, empty to skip: '.format(pw, pw / 100.0))
+    if answer.strip():
+      points.append((math.radians(float(answer)), pw))
+  backend.write(pin, 150)
+  # paste into the [io] section of config/parameters.conf
+  print('{}_curve = {}'.format(args.sweep, ', '.join(
+        '{:.4f}:{}'.format(angle, pw) for angle, pw in sorted(points))))
+else:
+  while True:
+    backend.write(13, 98)
+    backend.write(18, 98)
+    time.sleep(delay_period)
 #  for i, j in zip(range(55, 252, 1), range(252, 55, -1)):
-#    wiringpi.pwmWrite(13, i)
-#    wiringpi.pwmWrite(18, j)
+#    backend.write(13, i)
+#    backend.write(18, j)
 #    print('{}, {}'.format(i, j))
 #    time.sleep(delay_period)
 #  for i, j in zip(range(252, 55, -1), range(55, 252, 1)):
-#    wiringpi.pwmWrite(13, i)
-#    wiringpi.pwmWrite(18, j)
+#    backend.write(13, i)
+#    backend.write(18, j)
 #    print('{}, {}'.format(i, j))
-#    time.sleep(delay_period)
\ No newline at end of file
+#    time.sleep(delay_period)
@@ -29,7 +29,7 @@ setup(
     description='Camera tilt/pan demo for RPi w/Ubuntu',
     url='https://github.com/bugbiter/applied-cam-demo',
     long_description=get_long_description(),
-    py_modules=[package_name],
+    py_modules=[package_name, 'actuator', 'actuatorprocess', 'calibration', 'flightrecorder', 'latencytracer', 'logqueue', 'metrics', 'mqttsession', 'posewire', 'predictor', 'pwmbackend', 'rig', 'sdnotify', 'sequencer', 'servoaxis', 'shmslot', 'statetelemetry', 'subscribersettings', 'udptransport'],
     entry_points={
         'console_scripts': [
             'subservo = subservo:main'
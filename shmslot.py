@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import atexit
+import multiprocessing
+import struct
+import time
+
+from actuator import Pose
+from latencytracer import CAPACITY
+from metrics import LATENCY_BUCKETS
+
+try:
+  from multiprocessing import shared_memory
+except ImportError:
+  # Python < 3.8, the two-process mode is not available
+  shared_memory = None
+
+# Layout of the shared block, native byte order, 8 byte aligned:
+#   0    Q      sequence, counts the puts, under the slot's lock
+#   8    qdddd  last_seen, roll, pitch, yaw, monotonic time of the put
+#   48   q * 11 counters and the last pulse widths, see below
+#   136  d * 9  first applied (monotonic, 0 before), control loop and predictor stats
+#   208         histograms, each a q per bucket plus +Inf and a d sum
+#   then        LatencyTracer count q and CAPACITY d delays
+POSE = struct.Struct('=qdddd')
+POSE_OFFSET = 8
+COUNTERS_OFFSET = 48
+(DEPOSITED, STALE, TAKEN, CLOSED, APPLIED, ERRORS, TICKS, MISSED, TILT_PW, PAN_PW,
+ PREDICTIONS) = range(11)
+TIMES_OFFSET = 136
+(FIRST_APPLIED, JITTER_MAX, JITTER_SUM, CPU_TIME, LEAD, LEAD_SUM, ROLL_RMS, PITCH_RMS,
+ YAW_RMS) = range(9)
+HISTOGRAMS_OFFSET = 208
+# histogram slots: put to take latency, then one per axis for actuation
+LATENCY_HISTOGRAM = 0
+ACTUATE_HISTOGRAM = 1
+HISTOGRAMS = 3
+BUCKETS = len(LATENCY_BUCKETS) + 1
+HISTOGRAM_SIZE = 8 * (BUCKETS + 1)
+TRACE_OFFSET = HISTOGRAMS_OFFSET + HISTOGRAMS * HISTOGRAM_SIZE
+SIZE = TRACE_OFFSET + 8 * (1 + CAPACITY)
+
+
+class SharedPoseSlot(object):
+  """Newest-wins pose slot in shared memory, a PoseMailbox across processes.
+
+  The network process put()s decoded poses, the actuator process take()s
+  them, with the interface of PoseMailbox. Pose and sequence are only
+  accessed under cond, a multiprocessing Condition, whose lock is the
+  memory barrier between the processes. put() notifies it, so a blocking
+  take() sleeps until a pose arrives instead of polling.
+
+  Counters, the actuator stats and histograms live in the same block, so
+  the network process can expose what the actuator process measures.
+
+  The creating process makes the block and cond, the actuator process
+  attaches with name and the cond handed to it when it was spawned.
+
+  Raises:
+    RuntimeError: On Python < 3.8, without multiprocessing.shared_memory.
+  """
+
+  def __init__(self, name=None, cond=None):
+    if shared_memory is None:
+      raise RuntimeError('The two-process mode needs multiprocessing.shared_memory, Python 3.8 or newer')
+    self.owner = name is None
+    if self.owner:
+      self.shm = shared_memory.SharedMemory(create=True, size=SIZE)
+      self.cond = multiprocessing.get_context('spawn').Condition()
+      # after the last stats are logged and metrics scraped
+      atexit.register(self.release)
+    else:
+      # in a child process, sharing the resource tracker of the creating one
+      self.shm = shared_memory.SharedMemory(name=name)
+      self.cond = cond
+    buf = self.shm.buf
+    self._views = []
+    self.sequence = self._view(0, 8, 'Q')
+    self.counters = self._view(COUNTERS_OFFSET, TIMES_OFFSET, 'q')
+    self.times = self._view(TIMES_OFFSET, HISTOGRAMS_OFFSET, 'd')
+    self.buf = buf
+    self._last_seen = None
+    self._taken = 0
+    # put to take latency, observed by the reader
+    self.latency = None
+
+  @property
+  def name(self):
+    return self.shm.name
+
+  def _view(self, start, end, format):
+    view = self.shm.buf[start:end].cast(format)
+    self._views.append(view)
+    return view
+
+  def bind(self, index, histogram):
+    """Moves a metrics Histogram's buckets into histogram slot index."""
+    if len(histogram.counts) != BUCKETS:
+      raise ValueError('Histogram {} does not have the {} latency buckets'.format(histogram.name, BUCKETS))
+    start = HISTOGRAMS_OFFSET + index * HISTOGRAM_SIZE
+    histogram.counts = self._view(start, start + 8 * BUCKETS, 'q')
+    histogram.total = self._view(start + 8 * BUCKETS, start + HISTOGRAM_SIZE, 'd')
+    return histogram
+
+  def bind_latency(self, histogram):
+    """Shares the put to take latency histogram, observed by the taker."""
+    self.latency = self.bind(LATENCY_HISTOGRAM, histogram)
+    return self.latency
+
+  def bind_actuate(self, histograms):
+    """Shares the per axis actuation histograms, tilt then pan."""
+    return [self.bind(ACTUATE_HISTOGRAM + i, histogram) for i, histogram in enumerate(histograms)]
+
+  def bind_tracer(self, tracer):
+    """Moves a LatencyTracer's ring into the block, the taker's actuator traces into it."""
+    if len(tracer.delays) != CAPACITY:
+      raise ValueError('LatencyTracer does not have the capacity of {}'.format(CAPACITY))
+    tracer.count = self._view(TRACE_OFFSET, TRACE_OFFSET + 8, 'q')
+    tracer.delays = self._view(TRACE_OFFSET + 8, SIZE, 'd')
+    return tracer
+
+  def put(self, pose):
+    """Deposit a pose. Returns False if it is older than the newest seen."""
+    counters = self.counters
+    with self.cond:
+      if counters[CLOSED]:
+        return False
+      if self._last_seen is not None and pose.last_seen < self._last_seen:
+        counters[STALE] += 1
+        return False
+      POSE.pack_into(self.buf, POSE_OFFSET, pose.last_seen, pose.roll, pose.pitch, pose.yaw,
+                     time.monotonic())
+      self.sequence[0] += 1
+      self._last_seen = pose.last_seen
+      counters[DEPOSITED] += 1
+      self.cond.notify()
+    return True
+
+  def take(self, timeout=None):
+    """Return the newest pose not taken yet, or None on timeout or close."""
+    counters = self.counters
+    with self.cond:
+      sequence = self.sequence[0]
+      if sequence == self._taken and not counters[CLOSED]:
+        if timeout is None or timeout > 0:
+          self.cond.wait_for(lambda: self.sequence[0] != self._taken or counters[CLOSED], timeout)
+        sequence = self.sequence[0]
+      if sequence == self._taken:
+        return None
+      last_seen, roll, pitch, yaw, put_at = POSE.unpack_from(self.buf, POSE_OFFSET)
+      self._taken = sequence
+      counters[TAKEN] += 1
+    if self.latency is not None:
+      self.latency.observe(time.monotonic() - put_at)
+    return Pose(last_seen, roll, pitch, yaw)
+
+  def close(self):
+    """Wakes up a waiting taker and drops further puts, for shutdown."""
+    if self.buf is None:
+      return
+    with self.cond:
+      self.counters[CLOSED] = 1
+      self.cond.notify_all()
+
+  def publish_stats(self, actuator):
+    """Copies the stats of the actuator process' actuator into the block."""
+    counters = self.counters
+    counters[APPLIED] = actuator.applied
+    counters[ERRORS] = actuator.errors
+    counters[TICKS] = getattr(actuator, 'ticks', 0)
+    counters[MISSED] = getattr(actuator, 'missed', 0)
+    times = self.times
+    times[JITTER_MAX] = getattr(actuator, 'jitter_max', 0.0)
+    times[JITTER_SUM] = getattr(actuator, 'jitter_sum', 0.0)
+    times[CPU_TIME] = getattr(actuator, 'cpu_time', 0.0)
+    if actuator.first_applied is not None:
+      times[FIRST_APPLIED] = actuator.first_applied
+    predictor = actuator.predictor
+    if predictor is not None:
+      counters[PREDICTIONS] = predictor.predictions
+      times[LEAD] = predictor.lead
+      times[LEAD_SUM] = predictor.lead_sum
+      roll, pitch, yaw = predictor.filters
+      times[ROLL_RMS] = roll.rms_error()
+      times[PITCH_RMS] = pitch.rms_error()
+      times[YAW_RMS] = yaw.rms_error()
+    tilt_axis, pan_axis = actuator.axes
+    counters[TILT_PW] = tilt_axis.last_pw or 0
+    counters[PAN_PW] = pan_axis.last_pw or 0
+
+  def pulse_widths(self):
+    """Returns the (tilt, pan) pulse widths last written, 0 before the first."""
+    return self.counters[TILT_PW], self.counters[PAN_PW]
+
+  @property
+  def deposited(self):
+    return self.counters[DEPOSITED]
+
+  @property
+  def superseded(self):
+    # overwritten before the actuator process took them
+    return max(0, self.counters[DEPOSITED] - self.counters[TAKEN])
+
+  @property
+  def stale(self):
+    return self.counters[STALE]
+
+  @property
+  def first_applied(self):
+    first_applied = self.times[FIRST_APPLIED]
+    return first_applied if first_applied > 0 else None
+
+  def stats(self):
+    return {'deposited': self.deposited,
+            'superseded': self.superseded,
+            'stale': self.stale}
+
+  def actuator_stats(self, control=False, predictor=False):
+    """Returns the stats of the actuator process, those of Actuator.stats().
+
+    control adds the ControlLoop's, predictor the PosePredictor's.
+    """
+    counters = self.counters
+    times = self.times
+    stats = {'applied': counters[APPLIED], 'errors': counters[ERRORS]}
+    if predictor:
+      stats.update({'lead_ms': 1000.0 * times[LEAD],
+                    'lead_mean_ms': 1000.0 * times[LEAD_SUM] / (counters[PREDICTIONS] or 1),
+                    'pitch_rms_error': times[PITCH_RMS],
+                    'yaw_rms_error': times[YAW_RMS],
+                    'roll_rms_error': times[ROLL_RMS]})
+    if control:
+      ticks = counters[TICKS] or 1
+      stats.update({'ticks': counters[TICKS], 'missed': counters[MISSED],
+                    'jitter_mean_ms': 1000.0 * times[JITTER_SUM] / ticks,
+                    'jitter_max_ms': 1000.0 * times[JITTER_MAX],
+                    'cpu_per_tick_us': 1e6 * times[CPU_TIME] / ticks})
+    return stats
+
+  def release(self):
+    """Detaches from the block, the creating process also removes it."""
+    self.close()
+    if self.buf is None:
+      return
+    for view in self._views:
+      view.release()
+    self._views = []
+    self.buf = None
+    self.shm.close()
+    if self.owner:
+      try:
+        self.shm.unlink()
+      except FileNotFoundError:
+        pass
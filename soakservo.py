@@ -0,0 +1,564 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Soak and load test of the servo services against local stand-ins.
+
+Runs an entry point as a child process from a scratch directory with its
+own config/parameters.conf, the recording PWM backend and a metrics
+endpoint, sends goggle_direction poses at --rate, with --burst patterns,
+for --duration seconds and samples the child every --sample seconds:
+
+  pubsub  subservo.py with a FakeSubscriberClient delivering the poses in
+          the child, or the Pub/Sub emulator with --emulator HOST:PORT
+  mqtt    mqttservo.py against a plain MQTT broker at --broker HOST:PORT,
+          no TLS or JWT, --start-broker runs mosquitto. The client is
+          replaced every --rotate-minutes, as on a JWT refresh
+  udp     udpservo.py over loopback
+
+RSS, threads, open fds and CPU come from /proc of the child and its
+children, messages and the source to servo latency from its metrics.
+Samples go to --csv. After --warmup, the growth of each per hour, from a
+least squares fit, must stay under its --max-*-growth limit and messages
+must keep arriving, and the service has to stop cleanly on SIGINT, else
+the exit status is 1.
+
+  python3 soakservo.py udp --duration 14400 --rate 60 --burst 400:2:60
+"""
+
+import argparse
+import binascii
+import collections
+import concurrent.futures
+import configparser
+import csv
+import datetime
+import json
+import math
+import os
+import runpy
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+
+from actuator import Pose
+from posewire import encode_binary, encode_json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENTRY_POINTS = {'pubsub': 'subservo.py', 'mqtt': 'mqttservo.py', 'udp': 'udpservo.py'}
+DEVICE_ID = 'soak-goggles'
+PROJECT_ID = 'soak'
+TOPIC_ID = 'soak-poses'
+# seconds the child gets to serve metrics, and to exit on SIGINT
+START_TIMEOUT = 60
+STOP_TIMEOUT = 15
+Sample = collections.namedtuple('Sample', [
+         'elapsed', 'sent', 'messages', 'dropped', 'rss_mb', 'threads', 'fds', 'cpu_percent',
+         'p50_ms', 'p99_ms'])
+# sample field, --max-<option>-growth and its default per hour
+TRENDS = (
+  ('rss_mb', 'rss', 10.0),
+  ('threads', 'threads', 2.0),
+  ('fds', 'fds', 4.0),
+  ('cpu_percent', 'cpu', 5.0),
+  ('p99_ms', 'latency', 5.0),
+)
+
+
+class Traffic(object):
+  """Sends poses at rate per second, burst_rate for burst_seconds every burst_every."""
+
+  def __init__(self, rate, burst=None, encode=encode_json):
+    self.rate = rate
+    self.burst_rate, self.burst_seconds, self.burst_every = burst or (0.0, 0.0, 0.0)
+    self.encode = encode
+    self.sent = 0
+
+  def rate_at(self, elapsed):
+    if self.burst_every > 0 and elapsed % self.burst_every < self.burst_seconds:
+      return self.burst_rate
+    return self.rate
+
+  def run(self, send, duration, stopped):
+    """Sends until duration seconds passed or stopped is set."""
+    start = time.monotonic()
+    next_send = start
+    while not stopped.is_set():
+      now = time.monotonic()
+      elapsed = now - start
+      if elapsed >= duration:
+        return
+      if next_send > now:
+        stopped.wait(next_send - now)
+        continue
+      t = 0.05 * self.sent
+      send(self.encode(Pose(int(time.time() * 1000), 0.0, 0.5 * math.sin(t), 1.2 * math.sin(0.6 * t))))
+      self.sent += 1
+      next_send += 1.0 / self.rate_at(elapsed)
+      # after a stall, carry on at the rate instead of catching up in one burst
+      if next_send < now - 1.0:
+        next_send = now
+
+
+def parse_burst(text):
+  """Parses RATE:SECONDS:EVERY, e.g. 400:2:60 for 2s at 400/s every minute."""
+  burst_rate, burst_seconds, burst_every = (float(value) for value in text.split(':'))
+  return burst_rate, burst_seconds, burst_every
+
+
+class FakeMessage(object):
+  """A received Pub/Sub message, ack() or nack() releases its flow control slot."""
+
+  def __init__(self, data, message_id, release):
+    self.data = data
+    self.message_id = message_id
+    self.attributes = {}
+    self.publish_time = datetime.datetime.now(datetime.timezone.utc)
+    self._release = release
+
+  def ack(self):
+    release, self._release = self._release, None
+    if release is not None:
+      release()
+
+  nack = ack
+
+
+class FakeStreamingPullFuture(object):
+
+  def __init__(self):
+    self._cancelled = threading.Event()
+
+  def result(self, timeout=None):
+    if not self._cancelled.wait(timeout):
+      raise concurrent.futures.TimeoutError()
+    raise concurrent.futures.CancelledError()
+
+  def cancel(self):
+    self._cancelled.set()
+
+  def cancelled(self):
+    return self._cancelled.is_set()
+
+
+class FakeScheduler(object):
+
+  def __init__(self, executor=None):
+    self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+class FakeSubscriberClient(object):
+  """SubscriberClient delivering the poses of traffic to the callback in this process.
+
+  Messages go through the scheduler's executor like the streaming pull
+  does, at most flow_control.max_messages unacknowledged at a time.
+  """
+
+  # set before the service subscribes
+  traffic = None
+  duration = 0
+
+  def topic_path(self, project, topic):
+    return 'projects/{}/topics/{}'.format(project, topic)
+
+  def subscription_path(self, project, subscription):
+    return 'projects/{}/subscriptions/{}'.format(project, subscription)
+
+  def get_subscription(self, subscription):
+    return {'name': subscription}
+
+  def create_subscription(self, **kwargs):
+    return kwargs
+
+  def subscribe(self, subscription, callback, flow_control=None, scheduler=None):
+    future = FakeStreamingPullFuture()
+    executor = (scheduler or FakeScheduler()).executor
+    outstanding = threading.BoundedSemaphore(getattr(flow_control, 'max_messages', 10))
+    message_ids = iter(range(1, 1 << 62))
+
+    def deliver(payload):
+      # the stream pauses while max_messages are unacknowledged
+      while not outstanding.acquire(timeout=1.0):
+        if future.cancelled():
+          return
+      executor.submit(callback, FakeMessage(payload, str(next(message_ids)), outstanding.release))
+
+    threading.Thread(target=self.traffic.run, args=(deliver, self.duration, future._cancelled),
+                     name='fake-pubsub', daemon=True).start()
+    return future
+
+
+def install_fake_pubsub():
+  """Puts modules with the fakes in place of google.cloud.pubsub_v1 and google.api_core."""
+  modules = dict((name, types.ModuleType(name)) for name in (
+            'google', 'google.cloud', 'google.cloud.pubsub_v1', 'google.cloud.pubsub_v1.subscriber',
+            'google.cloud.pubsub_v1.subscriber.scheduler', 'google.api_core',
+            'google.api_core.exceptions'))
+  pubsub_v1 = modules['google.cloud.pubsub_v1']
+  pubsub_v1.SubscriberClient = FakeSubscriberClient
+  pubsub_v1.types = types.SimpleNamespace(FlowControl=types.SimpleNamespace)
+  pubsub_v1.subscriber = modules['google.cloud.pubsub_v1.subscriber']
+  pubsub_v1.subscriber.scheduler = modules['google.cloud.pubsub_v1.subscriber.scheduler']
+  pubsub_v1.subscriber.scheduler.ThreadScheduler = FakeScheduler
+  modules['google.api_core.exceptions'].NotFound = type('NotFound', (Exception,), {})
+  modules['google'].cloud = modules['google.cloud']
+  modules['google'].api_core = modules['google.api_core']
+  modules['google.cloud'].pubsub_v1 = pubsub_v1
+  modules['google.api_core'].exceptions = modules['google.api_core.exceptions']
+  sys.modules.update(modules)
+
+
+def run_fake_subservo(args):
+  """Child side of the fake pubsub stand-in, runs subservo.py with the fakes."""
+  install_fake_pubsub()
+  FakeSubscriberClient.traffic = Traffic(args.rate, args.burst, ENCODERS[args.format])
+  FakeSubscriberClient.duration = args.duration
+  # through the link, subservo finds its config next to sys.argv[0]
+  runpy.run_path(os.path.join(args.workdir, 'subservo.py'), run_name='__main__')
+
+
+def emulator_sender(host):
+  """Returns a function publishing a payload through the Pub/Sub emulator's REST API."""
+  topic_url = 'http://{}/v1/projects/{}/topics/{}'.format(host, PROJECT_ID, TOPIC_ID)
+  try:
+    urllib.request.urlopen(urllib.request.Request(topic_url, method='PUT'), timeout=10)
+  except urllib.error.HTTPError as e:
+    # 409, it exists already
+    if e.code != 409:
+      raise
+
+  def send(payload):
+    body = json.dumps({'messages': [{'data': binascii.b2a_base64(payload, newline=False)
+                                             .decode('ascii')}]}).encode('utf-8')
+    urllib.request.urlopen(urllib.request.Request(
+        topic_url + ':publish', body, {'Content-Type': 'application/json'}), timeout=10).read()
+  return send
+
+
+def mqtt_sender(broker):
+  """Returns a function publishing a payload as a command of the soak device, and the client."""
+  import paho.mqtt.client as mqtt
+  from udptransport import parse_address
+  client = mqtt.Client()
+  client.connect(*parse_address(broker))
+  client.loop_start()
+  topic = '/devices/{}/commands'.format(DEVICE_ID)
+  return lambda payload: client.publish(topic, payload, qos=0), client
+
+
+def free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+
+def write_config(args, workdir, metrics_port, udp_port, udp_key):
+  config_parser = configparser.RawConfigParser()
+  config_parser['telemetry'] = {
+    'project_id': PROJECT_ID,
+    'topic_id': TOPIC_ID,
+    'credentials_path': os.path.join(workdir, 'credentials.json'),
+    'subscription_cache': os.path.join(workdir, 'subscriptions.cache'),
+    'emulator_host': args.emulator or '',
+  }
+  config_parser['io'] = {'backend': 'recording', 'processes': str(args.processes)}
+  config_parser['metrics'] = {'listen': '127.0.0.1:{}'.format(metrics_port)}
+  config_parser['latency'] = {'interval': str(min(10.0, args.sample))}
+  # a small ring, full within the warmup so its pages do not read as growth
+  config_parser['recorder'] = {'path': 'poses-{device}.rec', 'capacity': '4096'}
+  config_parser['udp'] = {'listen': '127.0.0.1:{}'.format(udp_port), 'key': udp_key}
+  host, _, port = (args.broker or '127.0.0.1:1883').rpartition(':')
+  config_parser['mqtt'] = {
+    'device_id': DEVICE_ID,
+    'mqtt_bridge_hostname': host,
+    'mqtt_bridge_port': port,
+    'ca_certs': '',
+    'private_key_file': '',
+    'jwt_expires_minutes': str(args.rotate_minutes),
+  }
+  config_parser['state'] = {'interval': '10'}
+  os.makedirs(os.path.join(workdir, 'config'), exist_ok=True)
+  with open(os.path.join(workdir, 'config', 'parameters.conf'), 'w') as f:
+    config_parser.write(f)
+  shutil.copy(os.path.join(HERE, 'config', 'logging.json'), os.path.join(workdir, 'config'))
+
+
+def process_tree(pid):
+  """Returns pid and the pids of its children, e.g. the actuator process."""
+  pids = [pid]
+  for name in os.listdir('/proc'):
+    if name.isdigit():
+      try:
+        with open('/proc/{}/stat'.format(name)) as f:
+          if int(f.read().rpartition(')')[2].split()[1]) == pid:
+            pids.append(int(name))
+      except (IOError, IndexError, ValueError):
+        pass
+  return pids
+
+
+def read_process(pid):
+  """Returns RSS in kB, threads, open fds and CPU ticks of a process from /proc."""
+  status = {}
+  with open('/proc/{}/status'.format(pid)) as f:
+    for line in f:
+      key, _, value = line.partition(':')
+      status[key] = value.split()
+  with open('/proc/{}/stat'.format(pid)) as f:
+    fields = f.read().rpartition(')')[2].split()
+  # utime and stime, fields 14 and 15 of stat
+  ticks = int(fields[11]) + int(fields[12])
+  return (int(status.get('VmRSS', [0])[0]), int(status['Threads'][0]),
+          len(os.listdir('/proc/{}/fd'.format(pid))), ticks)
+
+
+def scrape(port):
+  """Returns the samples of a Prometheus text endpoint as (name, labels) -> value."""
+  values = {}
+  with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=5) as response:
+    for line in response.read().decode('utf-8').splitlines():
+      if not line or line.startswith('#'):
+        continue
+      metric, _, value = line.rpartition(' ')
+      name, _, labels = metric.partition('{')
+      values[(name, labels.rstrip('}'))] = float(value)
+  return values
+
+
+def metric_total(values, name):
+  return sum(value for (sample, _), value in values.items() if sample == name)
+
+
+def metric_quantile(values, quantile):
+  """The worst transport's source latency quantile in ms, NaN before the first report."""
+  found = [value for (sample, labels), value in values.items()
+           if sample == 'servo_source_latency_seconds' and 'quantile="{}"'.format(quantile) in labels
+           and not math.isnan(value)]
+  return 1000.0 * max(found) if found else float('nan')
+
+
+class Sampler(object):
+  """Samples the child and its children from /proc and its metrics endpoint."""
+
+  def __init__(self, pid, metrics_port, traffic):
+    self.pid = pid
+    self.metrics_port = metrics_port
+    self.traffic = traffic
+    self.started = time.monotonic()
+    self.last = None
+    self.ticks_per_second = os.sysconf('SC_CLK_TCK')
+
+  def sample(self):
+    now = time.monotonic()
+    rss = threads = fds = ticks = 0
+    for pid in process_tree(self.pid):
+      try:
+        process = read_process(pid)
+      except (IOError, OSError):
+        continue
+      rss += process[0]
+      threads += process[1]
+      fds += process[2]
+      ticks += process[3]
+    cpu = 0.0
+    if self.last is not None and now > self.last[0]:
+      cpu = 100.0 * (ticks - self.last[1]) / self.ticks_per_second / (now - self.last[0])
+    self.last = (now, ticks)
+    try:
+      values = scrape(self.metrics_port)
+    except Exception:
+      values = {}
+    return Sample(round(now - self.started, 1), self.traffic.sent if self.traffic else -1,
+                  int(metric_total(values, 'servo_messages_total')),
+                  int(metric_total(values, 'servo_dropped_poses_total')),
+                  round(rss / 1024.0, 2), threads, fds, round(cpu, 1),
+                  round(metric_quantile(values, 0.5), 2), round(metric_quantile(values, 0.99), 2))
+
+
+def growth_per_hour(points):
+  """Least squares slope of (seconds, value) points, per hour, None without a spread."""
+  points = [(t, value) for t, value in points if not math.isnan(value)]
+  n = len(points)
+  if n < 3:
+    return None
+  mean_t = sum(t for t, _ in points) / n
+  mean_v = sum(v for _, v in points) / n
+  variance = sum((t - mean_t) ** 2 for t, _ in points)
+  if variance == 0:
+    return None
+  return 3600.0 * sum((t - mean_t) * (v - mean_v) for t, v in points) / variance
+
+
+def check(samples, args, exitcode):
+  """Returns the failures of a run, empty if it passed."""
+  failures = []
+  if exitcode is not None:
+    failures.append('service exited early with status {}'.format(exitcode))
+  after = [sample for sample in samples if sample.elapsed >= args.warmup]
+  if len(after) < 3:
+    failures.append('{} samples after the {}s warmup, too few to judge trends'.format(
+                    len(after), args.warmup))
+    return failures
+  for field, option, _ in TRENDS:
+    growth = growth_per_hour([(sample.elapsed, getattr(sample, field)) for sample in after])
+    limit = getattr(args, 'max_{}_growth'.format(option))
+    print('{:<12} first {:>9} last {:>9} growth {:>9} per hour, limit {}'.format(
+          field, getattr(after[0], field), getattr(after[-1], field),
+          'n/a' if growth is None else '{:.2f}'.format(growth), limit))
+    if growth is not None and growth > limit:
+      failures.append('{} grows {:.2f} per hour, over the limit of {}'.format(field, growth, limit))
+  # the service must keep up with the traffic, not stall
+  window = [sample for sample in after if sample.elapsed >= after[-1].elapsed - args.stall]
+  if len(window) > 1 and window[-1].messages == window[0].messages:
+    failures.append('no messages received in the last {}s'.format(args.stall))
+  return failures
+
+
+ENCODERS = {'json': encode_json, 'binary': encode_binary}
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Soak test a servo service against local stand-ins.')
+  parser.add_argument('transport', choices=['pubsub', 'mqtt', 'udp', 'fake-subservo'])
+  parser.add_argument('--duration', type=float, default=3600.0, help='seconds of traffic')
+  parser.add_argument('--rate', type=float, default=60.0, help='poses sent per second')
+  parser.add_argument('--burst', type=parse_burst,
+                      help='RATE:SECONDS:EVERY, e.g. 400:2:60 for 2s at 400/s every minute')
+  parser.add_argument('--format', choices=sorted(ENCODERS), default='json')
+  parser.add_argument('--sample', type=float, default=10.0, help='seconds between samples')
+  parser.add_argument('--warmup', type=float, default=300.0,
+                      help='seconds left out of the trends, while caches and rings fill')
+  parser.add_argument('--stall', type=float, default=60.0,
+                      help='seconds without a message that fail the run')
+  parser.add_argument('--processes', type=int, default=1, help='[io] processes of the service')
+  parser.add_argument('--emulator', help='Pub/Sub emulator HOST:PORT instead of the fake client')
+  parser.add_argument('--broker', default='127.0.0.1:1883', help='plain MQTT broker HOST:PORT')
+  parser.add_argument('--start-broker', action='store_true', help='run mosquitto on the --broker port')
+  parser.add_argument('--rotate-minutes', type=float, default=1.0,
+                      help='MQTT client lifetime, rotated at 90 percent of it')
+  parser.add_argument('--workdir', help='scratch directory, a new temporary one by default')
+  parser.add_argument('--csv', help='file for the samples, soak.csv in the workdir by default')
+  for _, option, default in TRENDS:
+    parser.add_argument('--max-{}-growth'.format(option), type=float, default=default,
+                        help='per hour, default {}'.format(default))
+  args = parser.parse_args()
+
+  if args.transport == 'fake-subservo':
+    run_fake_subservo(args)
+    return
+
+  workdir = args.workdir or tempfile.mkdtemp(prefix='soakservo-')
+  metrics_port = free_port()
+  udp_port = free_port()
+  udp_key = binascii.hexlify(os.urandom(32)).decode('ascii')
+  write_config(args, workdir, metrics_port, udp_port, udp_key)
+  entry_point = os.path.join(workdir, ENTRY_POINTS[args.transport])
+  if not os.path.exists(entry_point):
+    # imports resolve next to the real script, config next to the link
+    os.symlink(os.path.join(HERE, ENTRY_POINTS[args.transport]), entry_point)
+  traffic = Traffic(args.rate, args.burst, ENCODERS[args.format])
+  if args.transport == 'pubsub' and not args.emulator:
+    command = [sys.executable, os.path.abspath(__file__), 'fake-subservo', '--workdir', workdir,
+               '--duration', str(args.duration), '--rate', str(args.rate),
+               '--format', args.format]
+    if args.burst:
+      command += ['--burst', ':'.join(str(value) for value in args.burst)]
+    # the child sends, counts are not known here
+    sender_traffic = None
+  else:
+    command = [sys.executable, entry_point]
+    sender_traffic = traffic
+
+  broker = None
+  if args.transport == 'mqtt' and args.start_broker:
+    broker = subprocess.Popen(['mosquitto', '-p', args.broker.rpartition(':')[2]],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+  csv_path = args.csv or os.path.join(workdir, 'soak.csv')
+  print('Soaking {} for {}s at {}/s{}, workdir {}'.format(
+        ENTRY_POINTS[args.transport], args.duration, args.rate,
+        ', bursts {}/s for {}s every {}s'.format(*args.burst) if args.burst else '', workdir))
+  log = open(os.path.join(workdir, 'service.log'), 'w')
+  child = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+  stopped = threading.Event()
+  samples = []
+  client = None
+  try:
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+      try:
+        scrape(metrics_port)
+        break
+      except Exception:
+        if child.poll() is not None or time.monotonic() > deadline:
+          raise RuntimeError('{} did not serve metrics, see {}'.format(
+                             ENTRY_POINTS[args.transport], log.name))
+        time.sleep(0.5)
+    if sender_traffic is not None:
+      if args.transport == 'udp':
+        from udptransport import UdpPoseSender
+        sender = UdpPoseSender(binascii.unhexlify(udp_key), ('127.0.0.1', udp_port))
+        send = sender.send
+      elif args.transport == 'mqtt':
+        send, client = mqtt_sender(args.broker)
+      else:
+        send = emulator_sender(args.emulator)
+      threading.Thread(target=traffic.run, args=(send, args.duration, stopped),
+                       name='traffic', daemon=True).start()
+    sampler = Sampler(child.pid, metrics_port, sender_traffic)
+    with open(csv_path, 'w', newline='') as csv_file:
+      writer = csv.writer(csv_file)
+      writer.writerow(Sample._fields)
+      end = time.monotonic() + args.duration
+      while time.monotonic() < end and child.poll() is None:
+        time.sleep(min(args.sample, max(0.0, end - time.monotonic())))
+        sample = sampler.sample()
+        samples.append(sample)
+        writer.writerow(sample)
+        csv_file.flush()
+        print('{:>8.0f}s received {:>9} rss {:>7.1f}MB threads {:>3} fds {:>3} cpu {:>5.1f}% '
+              'p99 {:>7.2f}ms'.format(sample.elapsed, sample.messages, sample.rss_mb,
+                                       sample.threads, sample.fds, sample.cpu_percent,
+                                       sample.p99_ms))
+  except KeyboardInterrupt:
+    print('Interrupted')
+  finally:
+    stopped.set()
+    exitcode = child.poll()
+    stop_status = None
+    if exitcode is None:
+      child.send_signal(signal.SIGINT)
+      try:
+        stop_status = child.wait(STOP_TIMEOUT)
+      except subprocess.TimeoutExpired:
+        child.kill()
+        child.wait()
+        stop_status = 'killed after {}s'.format(STOP_TIMEOUT)
+    log.close()
+    if client is not None:
+      client.disconnect()
+      client.loop_stop()
+    if broker is not None:
+      broker.terminate()
+      broker.wait()
+
+  failures = check(samples, args, exitcode)
+  # a service re-raising the interrupt exits by SIGINT, that is a clean stop too
+  if stop_status not in (None, 0, -signal.SIGINT):
+    failures.append('service did not stop cleanly on SIGINT: {}, see {}'.format(stop_status, log.name))
+  print('Samples in {}, service log in {}'.format(csv_path, log.name))
+  for failure in failures:
+    print('FAIL: {}'.format(failure))
+  if not failures:
+    print('PASS')
+  sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import array
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import STAGES
+
+# defaults for the [state] config
+DEFAULTS = {
+  # seconds between batches per device, 0 to disable, Cloud IoT takes at most 1 state/s
+  'interval': 10,
+  # servo positions sampled per second into each batch
+  'sample_rate': 5,
+  # 'state' for /devices/{id}/state, 'events' for /devices/{id}/events
+  'topic': 'state',
+  'qos': 1,
+}
+# caps the samples of a batch, later ones in a longer interval are left out
+MAX_SAMPLES = 1000
+# nice value of the publisher thread, below the receive and actuator threads
+LOW_PRIORITY = 10
+
+
+def quantile_bound(bounds, counts, q):
+  """Returns the bucket bound reaching fraction q of counts, None for +Inf or no counts."""
+  total = sum(counts)
+  if not total:
+    return None
+  target = q * total
+  cumulative = 0
+  for bound, count in zip(bounds, counts):
+    cumulative += count
+    if cumulative >= target:
+      return bound
+  return None
+
+
+class RigBatch(object):
+  """Servo positions and stage latency deltas of one rig since the last batch."""
+
+  def __init__(self, rig, capacity):
+    self.rig = rig
+    self.tilt_pw = array.array('h', [0]) * capacity
+    self.pan_pw = array.array('h', [0]) * capacity
+    self.size = 0
+    self.started = None
+    metrics = rig.metrics
+    self.stages = [(stage, getattr(metrics, stage)) for stage in STAGES]
+    self.stages += [('actuate_' + axis.name, histogram)
+                    for axis, histogram in zip((rig.tilt_axis, rig.pan_axis), metrics.actuate)]
+    self.last_counts = dict((stage, (array.array('q', histogram.counts), histogram.total[0]))
+                            for stage, histogram in self.stages)
+    self.last_received = metrics.received.value
+    # (client, MQTTMessageInfo) of the batch in flight
+    self.in_flight = None
+
+  def sample(self, now):
+    if self.size == 0:
+      self.started = now
+    if self.size < len(self.tilt_pw):
+      self.tilt_pw[self.size], self.pan_pw[self.size] = self.rig.pulse_widths()
+      self.size += 1
+
+  def payload(self, sample_period):
+    """Returns the batch as compact JSON and starts the next one."""
+    rig = self.rig
+    stages = {}
+    for stage, histogram in self.stages:
+      counts = array.array('q', histogram.counts)
+      total = histogram.total[0]
+      last_counts, last_total = self.last_counts[stage]
+      delta = [count - last for count, last in zip(counts, last_counts)]
+      self.last_counts[stage] = (counts, total)
+      count = sum(delta)
+      if count:
+        p99 = quantile_bound(histogram.bounds, delta, 0.99)
+        # count, mean and p99 bucket bound in microseconds, -1 for +Inf
+        stages[stage] = [count, round(1e6 * (total - last_total) / count, 1),
+                         round(1e6 * p99, 1) if p99 is not None else -1]
+    received = rig.metrics.received.value
+    tilt_pw = self.tilt_pw[:self.size].tolist()
+    pan_pw = self.pan_pw[:self.size].tolist()
+    batch = {
+      't': round(self.started or time.time(), 3),
+      'dt': round(sample_period, 3),
+      'last_seen': rig.sequencer.last_seen,
+      'received': received - self.last_received,
+      'tilt_pw': tilt_pw,
+      'pan_pw': pan_pw,
+      # angles the calibration puts at the pulse widths, 0 before the first write
+      'tilt': [round(rig.tilt_axis.angle_at(pw), 3) if pw else 0.0 for pw in tilt_pw],
+      'pan': [round(rig.pan_axis.angle_at(pw), 3) if pw else 0.0 for pw in pan_pw],
+      'stages': stages,
+    }
+    self.last_received = received
+    self.size = 0
+    return json.dumps(batch, separators=(',', ':'))
+
+
+class StatePublisher(threading.Thread):
+  """Publishes batches of where each rig's servos point to /devices/{id}/state.
+
+  A low priority thread samples the axes' last written pulse widths at
+  sample_rate and, every interval, publishes one compact JSON batch per
+  rig with the angles they map to, the messages received and the count,
+  mean and p99 of every stage latency since the last batch.
+
+  Inbound commands never wait for it: only one batch per rig is in flight,
+  a batch due while the previous one is unacknowledged or while offline is
+  dropped and counted, so paho's outgoing queue stays short.
+
+  client_source is a function returning the connected paho client or None,
+  set before start().
+  """
+
+  def __init__(self, rigs, interval=DEFAULTS['interval'], sample_rate=DEFAULTS['sample_rate'],
+               topic=DEFAULTS['topic'], qos=DEFAULTS['qos'], registry=None, name='state'):
+    super().__init__(name=name, daemon=True)
+    self.interval = interval
+    self.sample_period = 1.0 / sample_rate
+    self.topic = topic
+    self.qos = qos
+    self.client_source = None
+    capacity = min(MAX_SAMPLES, int(interval * sample_rate) + 1)
+    self.batches = [RigBatch(rig, capacity) for rig in rigs]
+    self.published = 0
+    self.dropped = 0
+    self._stopped = threading.Event()
+    if registry is not None:
+      registry.counter_func('servo_state_batches_total', 'State batches published',
+                            lambda: self.published)
+      registry.counter_func('servo_state_dropped_batches_total',
+                            'State batches dropped while offline or with one in flight',
+                            lambda: self.dropped)
+
+  @classmethod
+  def from_config(cls, section, rigs, registry=None):
+    """Returns the publisher of a [state] config section, or None if disabled."""
+    interval = float(section.get('interval', DEFAULTS['interval']))
+    if interval <= 0:
+      return None
+    topic = section.get('topic', DEFAULTS['topic'])
+    if topic not in ('state', 'events'):
+      raise ValueError('[state] topic must be state or events, not {}'.format(topic))
+    return cls(rigs, interval, float(section.get('sample_rate', DEFAULTS['sample_rate'])),
+               topic, int(section.get('qos', DEFAULTS['qos'])), registry)
+
+  def run(self):
+    logger = logging.getLogger(__name__)
+    try:
+      # Linux threads are tasks with their own nice value
+      os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), LOW_PRIORITY)
+    except (AttributeError, OSError) as e:
+      logger.info('State publisher keeps the normal priority: {}'.format(e))
+    next_publish = time.monotonic() + self.interval
+    while not self._stopped.wait(self.sample_period):
+      now = time.time()
+      for batch in self.batches:
+        batch.sample(now)
+      if time.monotonic() >= next_publish:
+        next_publish += self.interval
+        try:
+          self.publish()
+        except Exception as e:
+          logger.error('Failed publishing state: {}'.format(e))
+
+  def publish(self):
+    """Publishes the batch of every rig, or drops it under backpressure."""
+    logger = logging.getLogger(__name__)
+    client = self.client_source() if self.client_source is not None else None
+    for batch in self.batches:
+      payload = batch.payload(self.sample_period)
+      in_flight = batch.in_flight
+      if client is None or (in_flight is not None and in_flight[0] is client
+                            and not in_flight[1].is_published()):
+        self.dropped += 1
+        logger.debug('Dropping state batch of %s', batch.rig.device_id)
+        continue
+      info = client.publish('/devices/{}/{}'.format(batch.rig.device_id, self.topic),
+                            payload, qos=self.qos)
+      batch.in_flight = (client, info)
+      self.published += 1
+
+  def stop(self):
+    self._stopped.set()
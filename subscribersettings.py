@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# defaults for the streaming pull keys of the [telemetry] config, tuned for
+# latency: the mailbox keeps only the newest pose, so a deep outstanding
+# window only adds queueing in front of it
+DEFAULTS = {
+  # messages and bytes leased but not yet acked before the stream pauses
+  'max_messages': 10,
+  'max_bytes': 65536,
+  # callback threads, 1 or 2
+  'workers': 1,
+  # ack 'before' decoding and actuating, or 'after' the pose is handed over
+  'ack': 'before',
+  # ack deadline of a newly created subscription, 10 to 600 seconds
+  'ack_deadline': 10,
+  # seconds a message is kept leased before it is given up
+  'max_lease_duration': 60,
+  # host:port of a local Pub/Sub emulator, empty for the real service
+  'emulator_host': '',
+}
+MAX_WORKERS = 2
+
+
+class SubscriberSettings(object):
+  """Streaming pull flow control, callback scheduler and ack settings.
+
+  The google-cloud-pubsub defaults favour throughput: a window of 1000
+  outstanding messages, a 10 thread callback pool and acks at the end of
+  the callback. For head tracking a small window, one or two callback
+  threads and acks before the work keep the delay to the newest pose low.
+  """
+
+  def __init__(self, max_messages, max_bytes, workers, ack_before, ack_deadline,
+               max_lease_duration, emulator_host=''):
+    if not 1 <= workers <= MAX_WORKERS:
+      raise ValueError('workers must be 1 to {}, got {}'.format(MAX_WORKERS, workers))
+    self.max_messages = max_messages
+    self.max_bytes = max_bytes
+    self.workers = workers
+    self.ack_before = ack_before
+    self.ack_deadline = ack_deadline
+    self.max_lease_duration = max_lease_duration
+    self.emulator_host = emulator_host
+
+  @classmethod
+  def from_config(cls, section):
+    """Creates the settings from a [telemetry] config section."""
+    def get(key):
+      return section.get(key, DEFAULTS[key])
+
+    ack = str(get('ack')).lower()
+    if ack not in ('before', 'after'):
+      raise ValueError('ack must be before or after, got {}'.format(ack))
+    return cls(int(get('max_messages')), int(get('max_bytes')), int(get('workers')),
+               ack == 'before', int(get('ack_deadline')), int(get('max_lease_duration')),
+               get('emulator_host'))
+
+  def flow_control(self):
+    """Returns the pubsub_v1 FlowControl for subscribe()."""
+    # imported here so this module loads without the cloud client
+    from google.cloud import pubsub_v1
+    return pubsub_v1.types.FlowControl(max_messages=self.max_messages,
+                                       max_bytes=self.max_bytes,
+                                       max_lease_duration=self.max_lease_duration)
+
+  def scheduler(self):
+    """Returns a callback scheduler bounded to the configured worker threads."""
+    import concurrent.futures
+    from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+    return ThreadScheduler(executor=executor)
+
+  def __str__(self):
+    return ('max_messages {}, max_bytes {}, workers {}, ack {}, ack_deadline {}s, '
+            'max_lease_duration {}s{}'.format(
+            self.max_messages, self.max_bytes, self.workers,
+            'before' if self.ack_before else 'after', self.ack_deadline,
+            self.max_lease_duration,
+            ', emulator ' + self.emulator_host if self.emulator_host else ''))
@@ -1,48 +1,62 @@
 #!/usr/bin/env python3
 # coding=utf-8
 
+# sdnotify first, its import time is the start of time to ready and first actuation
+import sdnotify
 import configparser
 import json
 import logging
-import logging.config
 import math
 import os
 import sys
 import time
-import wiringpi
-from google.cloud import pubsub_v1
+
+from actuator import DEFAULT_CONTROL_RATE, PoseMailbox, create_actuator
+from actuatorprocess import ActuatorProcess
+from calibration import ConfigWatcher, recalibrate
+from flightrecorder import FLAG_OUT_OF_SEQUENCE, FlightRecorder
+from latencytracer import LatencyMonitor, LatencyTracer
+from logqueue import configure_logging
+from metrics import DEFAULT_LISTEN, PipelineMetrics, Registry, serve
+from posewire import UnknownMessageType, decode
+from predictor import PosePredictor
+from pwmbackend import RecordingBackend, backend_config, create_backend
+from sequencer import Sequencer
+from servoaxis import ServoAxis
+from shmslot import SharedPoseSlot
+from subscribersettings import SubscriberSettings
 
 __version__ = '0.0.2'
 
 # globals
-# default GPIO pin assignment
-tilt_servo_max_pw = 252
-tilt_servo_min_pw = 55.3
-tilt_min_angle = -1.57
-tilt_max_angle = 1.57
-tilt_ratio = 1.0
-tilt_pin = 13
-pan_servo_max_pw = 252
-pan_servo_min_pw = 55.3
-pan_min_angle = -1.57
-pan_max_angle = 1.57
-pan_ratio = 1.0
-pan_pin = 18
+# module logger for the per-message paths, looked up once
+logger = logging.getLogger(__name__)
+
+# servo axes, built from the [io] config in main()
+tilt_axis = None
+pan_axis = None
+
+# newest decoded pose, drained by the actuator thread, or process with [io] processes = 2
+pose_mailbox = PoseMailbox()
+# head.last_seen ordering and redelivery dedup, shared by the callback threads
+sequencer = Sequencer()
+# ack on receipt, the default since [telemetry] ack exists, or after the pose is
+# handed over as before it with ack = after
+ack_before = True
+# per-stage latencies and message counters, served by the [metrics] endpoint
+registry = Registry()
+pipeline_metrics = None
+# always-on FlightRecorder of the received poses, see [recorder]
+recorder = None
 
 def main():
   # [START main]
-  global tilt_pin
-  global pan_pin
-  global tilt_ratio
-  global pan_ratio
-  global tilt_servo_max_pw
-  global tilt_servo_min_pw
-  global pan_servo_max_pw
-  global pan_servo_min_pw
-  global tilt_max_angle
-  global tilt_min_angle
-  global pan_max_angle
-  global pan_min_angle
+  global tilt_axis
+  global pan_axis
+  global pose_mailbox
+  global ack_before
+  global pipeline_metrics
+  global recorder
 
   # If the module is executed as a script __name__ will be '__main__' and sys.argv[0] 
   # will be the full path of the module.
@@ -59,7 +73,8 @@ def main():
   #  remove("subservologging.log")
   with open(loggerconfig_file_path, 'r') as logging_configuration_file:
     config_dict = json.load(logging_configuration_file)
-  logging.config.dictConfig(config_dict)
+  # records are formatted and written by a background listener
+  configure_logging(config_dict)
   # Log that the logger was configured
   logger = logging.getLogger(__name__)
   logger.info('Logging configured')
@@ -78,156 +93,262 @@ def main():
     logger.info('Read pubsub project {}, and topic {}'.format(project_id, topic_id))
   except:
     logger.error('Exception when reading telemetry parameters from {}'.format(config_file_path))
+  try:
+    subscriber_settings = SubscriberSettings.from_config(config_parser['telemetry'])
+  except Exception as e:
+    logger.error('Exception when reading subscriber settings, using defaults: {}'.format(e))
+    subscriber_settings = SubscriberSettings.from_config({})
+  ack_before = subscriber_settings.ack_before
+  if subscriber_settings.emulator_host:
+    # picked up by SubscriberClient, the emulator needs no credentials
+    os.environ['PUBSUB_EMULATOR_HOST'] = subscriber_settings.emulator_host
+  logger.info('Subscriber {}'.format(subscriber_settings))
   try:
     config_parser.read(config_file_path)
-    tilt_pin = int(config_parser['io']['tilt_pin'])
-    pan_pin = int(config_parser['io']['pan_pin'])
-    tilt_ratio = float(config_parser['io']['tilt_ratio'])
-    pan_ratio = float(config_parser['io']['pan_ratio'])
-    tilt_servo_max_pw = float(config_parser['io']['tilt_servo_max_pw'])
-    tilt_servo_min_pw = float(config_parser['io']['tilt_servo_min_pw'])
-    pan_servo_max_pw = float(config_parser['io']['pan_servo_max_pw'])
-    pan_servo_min_pw = float(config_parser['io']['pan_servo_min_pw'])
-    tilt_max_angle = float(config_parser['io']['tilt_max_angle'])
-    tilt_min_angle = float(config_parser['io']['tilt_min_angle'])
-    pan_max_angle = float(config_parser['io']['pan_max_angle'])
-    pan_min_angle = float(config_parser['io']['pan_min_angle'])
-    logger.info('Tilt pin {}, servo ratio {}, servo max pw {}, servo min pw {}, max angle {}, min angle {}'.format(tilt_pin, tilt_ratio, tilt_servo_max_pw, tilt_servo_min_pw, tilt_max_angle, tilt_min_angle))
-    logger.info('Pan pin {}, servo ratio {}, servo max pw {}, servo min pw {}, max angle {}, min angle {}'.format(pan_pin, pan_ratio, pan_servo_max_pw, pan_servo_min_pw, pan_max_angle, pan_min_angle))
+    processes = int(config_parser['io'].get('processes', 1))
+    actuator_cpu = config_parser['io'].get('actuator_cpu', '')
+    if processes > 1:
+      # the actuator process opens the real backend, the axes here write nothing
+      backend = RecordingBackend(capacity=1)
+    else:
+      name, options = backend_config(config_parser['io'])
+      backend = create_backend(name, **options)
+    tilt_axis = ServoAxis.from_config('tilt', config_parser['io'], backend.write)
+    pan_axis = ServoAxis.from_config('pan', config_parser['io'], backend.write)
+    control_rate = float(config_parser['io'].get('control_rate', DEFAULT_CONTROL_RATE))
+    predictor = PosePredictor.from_config(config_parser['io'])
   except:
     logger.error('Exception when reading io parameters from {}'.format(config_file_path))
+    processes = 1
+    backend = create_backend('wiringpi')
+    tilt_axis = ServoAxis.from_config('tilt', {}, backend.write)
+    pan_axis = ServoAxis.from_config('pan', {}, backend.write)
+    control_rate = DEFAULT_CONTROL_RATE
+    predictor = None
+  logger.info('PWM backend {}, control rate {} Hz, predictor {}'.format(
+              type(backend).__name__, control_rate, 'on' if predictor else 'off'))
+  logger.info('Tilt {}'.format(tilt_axis))
+  logger.info('Pan {}'.format(pan_axis))
 
   # sanity check
-  if 'GOOGLE_APPLICATION_CREDENTIALS' in os.environ:
+  if 'PUBSUB_EMULATOR_HOST' in os.environ:
+    logger.info('$PUBSUB_EMULATOR_HOST: {}'.format(os.environ['PUBSUB_EMULATOR_HOST']))
+  elif 'GOOGLE_APPLICATION_CREDENTIALS' in os.environ:
     logger.info('$GOOGLE_APPLICATION_CREDENTIALS: {}'.format(os.environ['GOOGLE_APPLICATION_CREDENTIALS']))
   else:
     logger.error('Could not find $GOOGLE_APPLICATION_CREDENTIALS')
     # should exit!
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/home/ubuntu/agent-key.json'
   
-  # init GPIO
-  wiringpi.wiringPiSetupGpio()
-  # set GPIO13 and GPIO18  to be PWM outputs
-  wiringpi.pinMode(tilt_pin, wiringpi.GPIO.PWM_OUTPUT)
-  wiringpi.pinMode(pan_pin, wiringpi.GPIO.PWM_OUTPUT)
-  # set PWM mode  to milliseconds
-  wiringpi.pwmSetMode(wiringpi.GPIO.PWM_MODE_MS)
-  # divide down clock for 20ms period
-  wiringpi.pwmSetClock(192)
-  wiringpi.pwmSetRange(2000)
-  # set PWM outputs to center position (1.5 ms)
-  wiringpi.pwmWrite(tilt_pin, 150)
-  wiringpi.pwmWrite(pan_pin, 150)
-
-  # set up PubSub subscription
+  # [recorder] path empty to disable
+  try:
+    recorder = FlightRecorder.from_config(
+               config_parser['recorder'] if config_parser.has_section('recorder') else {},
+               path_here, 'pubsub', 'roll-yaw')
+  except Exception as e:
+    logger.error('Failed opening the flight recorder: {}'.format(e))
+
+  # init PWM, 20ms period on the tilt and pan pins
+  backend.setup([tilt_axis.pin, pan_axis.pin])
+  # set PWM outputs to center position (1.5 ms), before the slow network setup
+  tilt_axis.set_pulse_width(150)
+  pan_axis.set_pulse_width(150)
+  sdnotify.status('Servos centered')
+
+  # metrics endpoint, [metrics] listen = host:port or unix:<path>, empty to disable
+  if processes > 1:
+    pose_mailbox = SharedPoseSlot()
+  pipeline_metrics = PipelineMetrics(registry, [tilt_axis, pan_axis])
+  pipeline_metrics.sequencer(sequencer)
+  pipeline_metrics.mailbox(pose_mailbox)
+  try:
+    listen = config_parser.get('metrics', 'listen', fallback=DEFAULT_LISTEN)
+    metrics_server = serve(registry, listen)
+  except Exception as e:
+    logger.error('Failed serving metrics: {}'.format(e))
+    metrics_server = None
+
+  # start the actuator, transport callbacks only decode, deposit and ack
+  tracer = LatencyTracer()
+  if processes > 1:
+    pipeline_metrics.shared_slot(pose_mailbox)
+    pose_mailbox.bind_tracer(tracer)
+    actuator = ActuatorProcess(pose_mailbox, [tilt_axis, pan_axis], config_parser['io'],
+                               __pose_angles, int(actuator_cpu) if actuator_cpu else None)
+  else:
+    actuator = create_actuator(pose_mailbox, [tilt_axis, pan_axis], __pose_angles,
+                               control_rate, predictor, pipeline_metrics.actuate, tracer)
+  pipeline_metrics.startup(actuator, sdnotify.STARTED)
+  actuator.start()
+
+  # head.last_seen to servo write latency, [latency] interval = 0 to disable
+  latency_monitor = LatencyMonitor.from_config(
+                    config_parser['latency'] if config_parser.has_section('latency') else {}, registry)
+  if latency_monitor is not None:
+    latency_monitor.add(tracer, 'pubsub', 'pubsub')
+    latency_monitor.start()
+
+  # apply [io] calibration changes in parameters.conf without a restart
+  def reload_config(config_parser):
+    global tilt_axis
+    global pan_axis
+    tilt_axis, pan_axis = recalibrate(actuator, backend, config_parser['io'])
+    if processes > 1:
+      actuator.recalibrate(config_parser['io'])
+    logger.info('Recalibrated tilt {}'.format(tilt_axis))
+    logger.info('Recalibrated pan {}'.format(pan_axis))
+  config_watcher = ConfigWatcher(config_file_path, reload_config)
+  config_watcher.start()
+
+  # set up PubSub subscription, the client and gRPC take seconds to import on a Pi
+  from google.cloud import pubsub_v1
   subscriber = pubsub_v1.SubscriberClient()
   topic_path = subscriber.topic_path(project_id, topic_id)
   subscription_path = subscriber.subscription_path(project_id, topic_id)
-  # create the pull subscription
+  cache_path = config_parser.get('telemetry', 'subscription_cache',
+                                 fallback=os.path.join(path_here, 'config/subscriptions.cache'))
   try:
-    subscription = subscriber.create_subscription(subscription_path, topic_path)
+    __ensure_subscription(subscriber, subscription_path, topic_path,
+                          subscriber_settings.ack_deadline, cache_path)
   except Exception as e:
-    logger.info('Failed creating subscription: {}'.format(e))
+    logger.info('Failed checking subscription: {}'.format(e))
   # subscribe
   try:
-    future = subscriber.subscribe(subscription_path, callback=__subscriber_callback)
+    future = subscriber.subscribe(subscription_path, callback=__subscriber_callback,
+                                  flow_control=subscriber_settings.flow_control(),
+                                  scheduler=subscriber_settings.scheduler())
+    logger.info('Ready after {:.2f}s'.format(sdnotify.ready('Subscribed to {}'.format(subscription_path))))
     while True:
       try:
         future.result()
       except KeyboardInterrupt:
         future.cancel()
-        raise
+        logger.info('Keyboard interrupt')
+        break
   except Exception as e:
-    logger.error('Failed subscribing to {}'.format(subscription_path))
+    logger.error('Failed subscribing to {}: {}'.format(subscription_path, e))
+    # the subscription may be gone, check it again on the next start
+    __forget_subscription(subscription_path, cache_path)
+  finally:
+    config_watcher.stop()
+    if latency_monitor is not None:
+      latency_monitor.stop()
+    actuator.stop()
+    logger.info('Actuator {}, sequencer {}, mailbox {}'.format(
+                actuator.stats(), sequencer.stats(), pose_mailbox.stats()))
+    logger.info('Tilt writes {}, pan writes {}'.format(tilt_axis.stats(), pan_axis.stats()))
+    backend.close()
+    if recorder is not None:
+      recorder.close()
+    if metrics_server is not None:
+      metrics_server.shutdown()
   #  [END main]
 
-def __subscriber_callback(message):
-  # [START __subscriber_callback]
-  global tilt_servo_max_pw
-  global tilt_servo_min_pw
-  global tilt_max_angle
-  global tilt_min_angle
-  global tilt_ratio
-  global tilt_pin
-  global pan_servo_max_pw
-  global pan_servo_min_pw
-  global pan_max_angle
-  global pan_min_angle
-  global pan_ratio
-  global pan_pin
+def __ensure_subscription(subscriber, subscription_path, topic_path, ack_deadline, cache_path):
+  # [START __ensure_subscription]
+  # subscriptions known to exist, one path per line, skips the round trip on boot
+  try:
+    with open(cache_path, 'r') as cache_file:
+      if subscription_path in cache_file.read().split():
+        logger.info('Subscription {} cached'.format(subscription_path))
+        return
+  except IOError:
+    pass
+  from google.api_core import exceptions
+  try:
+    subscriber.get_subscription(subscription=subscription_path)
+  except exceptions.NotFound:
+    subscriber.create_subscription(name=subscription_path, topic=topic_path,
+                                   ack_deadline_seconds=ack_deadline)
+    logger.info('Created subscription {}'.format(subscription_path))
+  with open(cache_path, 'a') as cache_file:
+    cache_file.write(subscription_path + '\n')
+  # [END __ensure_subscription]
 
-  logger = logging.getLogger(__name__)
+def __forget_subscription(subscription_path, cache_path):
+  # [START __forget_subscription]
+  try:
+    with open(cache_path, 'r') as cache_file:
+      paths = cache_file.read().split()
+    with open(cache_path, 'w') as cache_file:
+      cache_file.writelines(path + '\n' for path in paths if path != subscription_path)
+  except IOError:
+    pass
+  # [END __forget_subscription]
 
-  #{
-  #  "links": [],
-  #  "head": {
-  #      "links": [],
-  #      "type": "goggle_direction",
-  #      "last_seen": 1557746562 (epoch_milliseconds)
-  #  },
-  #  "body": {
-  #      "roll": 0.0,
-  #      "pitch": 0.0, (tilt)
-  #      "yaw": 0.7853981633974483 (pan)
-  #  }
-  #}
+def __subscriber_callback(message):
+  # [START __subscriber_callback]
+  # per-message logging is %-style, formatted by the log listener only if enabled
+  clock = time.perf_counter
+  metrics = pipeline_metrics
+  metrics.received.inc()
+  received = time.time()
   try:
-    logger.debug('PubSub message received')
-    data = json.loads(message.data)
-    if data['head'].get('type') != 'goggle_direction':
-      logger.debug('Unknown message type')
-      message.ack()
-      return
-  except:
-    logger.error('Could not understand message: {}'.format(message.data))
+    # publish to callback, across the Pub/Sub and local clocks
+    metrics.receive.observe(received - message.publish_time.timestamp())
+  except Exception:
+    pass
+  # with ack_before a lost message is never redelivered, the next pose supersedes it anyway
+  if ack_before:
+    start = clock()
     message.ack()
-    return
+    metrics.ack.observe(clock() - start)
+  # goggle_direction message, JSON or binary, see posewire.py
   try:
-    if data['head'].get('last_seen') < __subscriber_callback.last_seen:
-      logger.debug('Skip this message - out of sequence, head: {}, last seen: {}'.format(data['head']['last_seen'], __subscriber_callback.last_seen))
-      message.ack()
+    # at-least-once delivery, drop redeliveries before decoding them
+    if sequencer.is_duplicate(message.message_id):
+      logger.debug('Skip this message - duplicate %s', message.message_id)
+      return
+    start = clock()
+    try:
+      logger.debug('PubSub message received')
+      pose = decode(message.data)
+    except UnknownMessageType:
+      metrics.unknown.inc()
+      logger.debug('Unknown message type')
+      return
+    except KeyError as e:
+      metrics.malformed.inc()
+      logger.info('Message does not contain %s. Skip this', e)
+      return
+    except:
+      metrics.malformed.inc()
+      logger.error('Could not understand message: %r', message.data)
+      return
+    decoded = clock()
+    metrics.decode.observe(decoded - start)
+    # compare and advance in one step, callbacks run on the scheduler's threads
+    if not sequencer.advance(pose.last_seen):
+      logger.debug('Skip this message - out of sequence, head: %s, last seen: %s', pose.last_seen, sequencer.last_seen)
+      __record_pose(received, pose, FLAG_OUT_OF_SEQUENCE)
       return
-  except AttributeError:
-    logger.debug('First message since the start')
-  except KeyError:
-    logger.info('Message does not contain head.last_seen. Skip this')
-    message.ack()
-    return
-  except:
-    logger.error('Some weird exception checking the pubsub message head.last_seen. Skip this')
-    message.ack()
-    return
-  __subscriber_callback.last_seen = data['head']['last_seen']
-  #logger.debug('Last seen {}'.format(__subscriber_callback.last_seen))
 
-  try:
-    __set_angle(tilt_pin, -data['body']['roll'], tilt_ratio, tilt_servo_max_pw, tilt_servo_min_pw, tilt_max_angle, tilt_min_angle)
-    __set_angle(pan_pin, data['body']['yaw'], pan_ratio, pan_servo_max_pw, pan_servo_min_pw, pan_max_angle, pan_min_angle)
-  except Exception as e:
-    logger.error('Failed to set tilt/pan: {}'.format(e))
-  message.ack()
+    # hand the pose over to the actuator thread, superseded poses are dropped there
+    pose_mailbox.put(pose)
+    metrics.sequence.observe(clock() - decoded)
+    # after the hand-over, the actuator does not wait for the recorder
+    __record_pose(received, pose)
+  finally:
+    # every message is acked, skipped ones too
+    if not ack_before:
+      start = clock()
+      message.ack()
+      metrics.ack.observe(clock() - start)
   # [END __subscriber_callback]
 
-def __set_angle(pin, angle, ratio, max_pw, min_pw, max_angle, min_angle):
-  # [START __set_angle]
-  logger = logging.getLogger(__name__)
+def __record_pose(received, pose, flags=0):
+  # [START __record_pose]
+  # the pose and the pulse widths it maps to, appended to the flight recorder
+  if recorder is not None:
+    tilt, pan = __pose_angles(pose)
+    recorder.record(received, pose, tilt_axis.pulse_width(tilt), pan_axis.pulse_width(pan), flags)
+  # [END __record_pose]
 
-  logger.debug('Angle {} on pin {}'.format(angle, pin))
-  if angle < min_angle:
-    angle = min_angle
-    logger.debug('Truncate angle < min')
-  elif angle > max_angle:
-    angle = max_angle
-    logger.debug('Truncate angle > max')
-
-  #angle_scaled = angle * ratio
-  #logger.debug('Angle scaled {}'.format(angle_scaled))
-  servo_delta = max_pw - min_pw
-  angle_delta = max_angle - min_angle
-  pw = ((angle - min_angle) * servo_delta / angle_delta) + min_pw
-  #logger.debug('PW {} pin {}'.format(pw, pin))
-  wiringpi.pwmWrite(pin, int(pw))
-  # [END __set_angle]
+def __pose_angles(pose):
+  # [START __pose_angles]
+  # tilt and pan angles for a pose, applied on the actuator thread
+  return (-pose.roll, pose.yaw)
+  # [END __pose_angles]
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# sdnotify first, its import time is the start of time to ready and first actuation
+import sdnotify
+import configparser
+import json
+import logging
+import os
+import sys
+import threading
+
+from calibration import ConfigWatcher
+from flightrecorder import FlightRecorder
+from latencytracer import LatencyMonitor
+from logqueue import configure_logging
+from metrics import DEFAULT_LISTEN, Registry, serve
+from rig import Rig, setup_backends
+from udptransport import UdpPoseReceiver
+
+__version__ = '0.0.1'
+
+# globals
+# module logger, looked up once
+logger = logging.getLogger(__name__)
+
+# per-stage latencies and message counters, served by the [metrics] endpoint
+registry = Registry()
+# How often the rig stats are logged, in seconds.
+STATS_INTERVAL = 60
+
+def main():
+  # [START main]
+  # If the module is executed as a script __name__ will be '__main__' and sys.argv[0]
+  # will be the full path of the module.
+  if __name__ == '__main__':
+      path_here = os.path.split(sys.argv[0])[0]
+  # Else the module was imported and it has a __file__ attribute that will be the full path of the module.
+  else:
+      path_here = os.path.split(__file__)[0]
+
+  # configure logging
+  loggerconfig_file_path = os.path.join(path_here, 'config/logging.json')
+  with open(loggerconfig_file_path, 'r') as logging_configuration_file:
+    config_dict = json.load(logging_configuration_file)
+  # records are formatted and written by a background listener
+  configure_logging(config_dict)
+  logger.info('Logging configured')
+
+  # read config
+  config_parser = configparser.RawConfigParser()
+  config_file_path = os.path.join(path_here, 'config/parameters.conf')
+  logger.info('Config path: {}'.format(config_file_path))
+  config_parser.read(config_file_path)
+  try:
+    rig = Rig.from_config('goggles', config_parser['io'], __pose_angles, registry=registry)
+  except:
+    logger.error('Exception when reading io parameters from {}'.format(config_file_path))
+    rig = Rig.from_config('goggles', {}, __pose_angles, registry=registry)
+  logger.info('{}, actuator {}, predictor {}'.format(
+              rig, type(rig.actuator).__name__, 'on' if rig.actuator.predictor else 'off'))
+  logger.info('Tilt {}'.format(rig.tilt_axis))
+  logger.info('Pan {}'.format(rig.pan_axis))
+
+  # the LAN transport is useless without its key, fail before touching the servos
+  udp_section = config_parser['udp'] if config_parser.has_section('udp') else {}
+  receiver = UdpPoseReceiver.from_config(udp_section, rig)
+
+  # always-on flight recorder of the received poses, [recorder] path empty to disable
+  try:
+    rig.recorder = FlightRecorder.from_config(
+                   config_parser['recorder'] if config_parser.has_section('recorder') else {},
+                   path_here, rig.device_id, 'pitch-yaw')
+  except Exception as e:
+    logger.error('Failed opening the flight recorder: {}'.format(e))
+
+  # init PWM, 20ms period on the tilt and pan pins
+  backends = setup_backends([rig])
+  # set PWM outputs to center position (1.5 ms)
+  rig.tilt_axis.set_pulse_width(150)
+  rig.pan_axis.set_pulse_width(150)
+  rig.start(sdnotify.STARTED)
+
+  # metrics endpoint, [metrics] listen = host:port or unix:<path>, empty to disable
+  try:
+    metrics_server = serve(registry, config_parser.get('metrics', 'listen', fallback=DEFAULT_LISTEN))
+  except Exception as e:
+    logger.error('Failed serving metrics: {}'.format(e))
+    metrics_server = None
+
+  # head.last_seen to servo write latency, [latency] interval = 0 to disable
+  latency_monitor = LatencyMonitor.from_config(
+                    config_parser['latency'] if config_parser.has_section('latency') else {}, registry)
+  if latency_monitor is not None:
+    latency_monitor.add(rig.tracer, 'udp', rig.device_id)
+    latency_monitor.start()
+
+  # apply [io] calibration changes in parameters.conf without a restart
+  def reload_config(config_parser):
+    section = dict(config_parser['io']) if config_parser.has_section('io') else {}
+    if section != rig.section:
+      rig.recalibrate(section)
+      logger.info('Recalibrated {}: {}, {}'.format(rig, rig.tilt_axis, rig.pan_axis))
+  config_watcher = ConfigWatcher(config_file_path, reload_config)
+  config_watcher.start()
+
+  stopped = threading.Event()
+  try:
+    logger.info('Listening for pose datagrams on {}'.format(receiver.sock.getsockname()))
+    receiver.start()
+    logger.info('Ready after {:.2f}s'.format(sdnotify.ready('Listening for pose datagrams')))
+    while not stopped.wait(STATS_INTERVAL):
+      logger.info('Rig {} {}'.format(rig.device_id, rig.stats()))
+  except KeyboardInterrupt:
+    logger.info('Keyboard interrupt')
+  finally:
+    config_watcher.stop()
+    if latency_monitor is not None:
+      latency_monitor.stop()
+    receiver.stop()
+    rig.stop()
+    logger.info('Rig {} {}'.format(rig.device_id, rig.stats()))
+    for backend in backends:
+      backend.close()
+    if metrics_server is not None:
+      metrics_server.shutdown()
+  logger.info('Exiting')
+  #  [END main]
+
+def __pose_angles(pose):
+  # [START __pose_angles]
+  # tilt and pan angles for a pose, applied on the actuator thread
+  return (pose.pitch, pose.yaw)
+  # [END __pose_angles]
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+import binascii
+import hashlib
+import hmac
+import logging
+import socket
+import threading
+import time
+
+from flightrecorder import FLAG_OUT_OF_SEQUENCE
+from posewire import GOGGLE_DIRECTION_TAG, UnknownMessageType, decode_binary, decode_json
+
+# defaults for the [udp] config
+DEFAULTS = {
+  'listen': '0.0.0.0:5005',
+  # pre-shared HMAC key, hex encoded, or a file holding it
+  'key': '',
+  'key_file': '',
+}
+# Datagram format: a goggle_direction pose, JSON or binary as in posewire.py,
+# followed by the 32 byte HMAC-SHA256 of the pose under the pre-shared key.
+DIGEST = hashlib.sha256
+TAG_SIZE = DIGEST().digest_size
+# larger datagrams are truncated and fail authentication
+MAX_DATAGRAM = 2048
+
+
+def sign(key, payload):
+  """Returns the datagram carrying payload, authenticated with key."""
+  return bytes(payload) + hmac.new(key, payload, DIGEST).digest()
+
+
+def verify(key, datagram):
+  """Returns the payload of an authentic datagram, or None.
+
+  The payload is a slice of datagram, a memoryview stays a memoryview.
+  """
+  if len(datagram) <= TAG_SIZE:
+    return None
+  payload = datagram[:-TAG_SIZE]
+  if not hmac.compare_digest(hmac.new(key, payload, DIGEST).digest(), datagram[-TAG_SIZE:]):
+    return None
+  return payload
+
+
+def load_key(section):
+  """Returns the pre-shared key of a [udp] config section.
+
+  Raises:
+    ValueError: If neither key nor key_file is set.
+  """
+  key = section.get('key', DEFAULTS['key'])
+  key_file = section.get('key_file', DEFAULTS['key_file'])
+  if not key and key_file:
+    with open(key_file, 'r') as f:
+      key = f.read().strip()
+  if not key:
+    raise ValueError('[udp] needs a key or key_file, an unauthenticated transport is not supported')
+  return binascii.unhexlify(key)
+
+
+def parse_address(listen):
+  host, port = listen.rsplit(':', 1)
+  return host, int(port)
+
+
+class UdpPoseReceiver(threading.Thread):
+  """Receives authenticated pose datagrams on the LAN and hands them to a rig.
+
+  Datagrams are read into one preallocated buffer. Datagrams failing the
+  HMAC check are counted and dropped before decoding. Authentic ones go
+  through the rig's decode, head.last_seen sequencing and mailbox, the same
+  as the cloud transports.
+  """
+
+  def __init__(self, sock, key, rig, name='udp'):
+    super().__init__(name=name, daemon=True)
+    self.sock = sock
+    self.key = key
+    self.rig = rig
+    self.buffer = bytearray(MAX_DATAGRAM)
+    self.unauthenticated = rig.metrics.registry.counter(
+                           'servo_unauthenticated_datagrams_total',
+                           'UDP datagrams failing the HMAC check', rig.metrics.labels)
+    self._stopped = threading.Event()
+
+  @classmethod
+  def from_config(cls, section, rig):
+    """Binds the [udp] listen address and returns the receiver."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(parse_address(section.get('listen', DEFAULTS['listen'])))
+    return cls(sock, load_key(section), rig)
+
+  def run(self):
+    logger = logging.getLogger(__name__)
+    view = memoryview(self.buffer)
+    clock = time.perf_counter
+    while not self._stopped.is_set():
+      try:
+        size = self.sock.recv_into(view)
+      except OSError as e:
+        if not self._stopped.is_set():
+          logger.error('UDP receive failed: {}'.format(e))
+        break
+      start = clock()
+      self.handle(view[:size])
+      self.rig.record(start)
+
+  def handle(self, datagram):
+    """Authenticates, decodes and sequences one datagram."""
+    logger = logging.getLogger(__name__)
+    rig = self.rig
+    metrics = rig.metrics
+    clock = time.perf_counter
+    received = time.time()
+    metrics.received.inc()
+    payload = verify(self.key, datagram)
+    if payload is None:
+      self.unauthenticated.inc()
+      logger.debug('Dropping unauthenticated datagram')
+      return
+    start = clock()
+    try:
+      if payload[0] == GOGGLE_DIRECTION_TAG:
+        pose = decode_binary(payload)
+      else:
+        pose = decode_json(payload.tobytes())
+    except UnknownMessageType:
+      metrics.unknown.inc()
+      logger.debug('Unknown message type')
+      return
+    except Exception:
+      metrics.malformed.inc()
+      logger.error('Could not understand datagram: %r', payload.tobytes())
+      return
+    decoded = clock()
+    metrics.decode.observe(decoded - start)
+    if not rig.sequencer.advance(pose.last_seen):
+      logger.debug('Skip this datagram - out of sequence, head: %s, last seen: %s', pose.last_seen, rig.sequencer.last_seen)
+      rig.record_pose(received, pose, FLAG_OUT_OF_SEQUENCE)
+      return
+    # hand the pose over to the rig's actuator thread, superseded poses are dropped there
+    rig.mailbox.put(pose)
+    metrics.sequence.observe(clock() - decoded)
+    rig.record_pose(received, pose)
+
+  def stop(self):
+    self._stopped.set()
+    # unblocks recv_into
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self.sock.close()
+
+
+class UdpPoseSender(object):
+  """Sends authenticated pose datagrams, e.g. from the goggles or for testing."""
+
+  def __init__(self, key, address):
+    self.key = key
+    self.address = address
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def send(self, payload):
+    """Sends an encoded pose, see posewire.encode_binary and encode_json."""
+    self.sock.sendto(sign(self.key, payload), self.address)
+
+  def close(self):
+    self.sock.close()